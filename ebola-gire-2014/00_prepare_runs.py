@@ -4,12 +4,17 @@ from Bio import Entrez
 import datetime
 import numpy as np
 import scipy as sp
-import xml.etree.ElementTree as ET
 import re
 import shutil
 import sys
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))  # For `paper_tools`
+from paper_tools.beast_xml import read_beast_xml, check_same_taxa_order
+from paper_tools.dates import parse_genbank_date, unparse_date_range
+from paper_tools.fasta import FastaWriter
+from paper_tools.partitions import read_partition_map, build_gather_index, reassemble
+
 if len(sys.argv) != 3:
     sys.stderr.write("Usage: ./00_prepare_runs.py <email-address-for-Entrez> <path_to_1259657_file_s3.zip>\n")
     sys.stderr.write("  NOTE: you may need to manually download the original data from https://www.science.org/doi/10.1126/science.1259657, supplementary file S3 (1259657_file_s3.zip)\n");
@@ -48,19 +53,14 @@ if do_unzip:
 # We'll extract the essentials of the run in `2014_GN.SL_SRD.HKY_strict_ctmc.exp.xml`.  The original data is split into two partitions (genic and intergenic), but this particular BEAST run treats both partitions together.  However, the relation to site indices of the reference genome used in the paper (KJ660346) is totally scrambled.
 
 print("\nReading sequence data from BEAST XML file...")
-beastXml = ET.parse(beast_file_path.as_posix())
-xmlTaxa = [taxon for taxon in beastXml.find("taxa")]
-xmlAlignments = beastXml.findall("alignment")
+xmlTaxa, xmlAlignments = read_beast_xml(beast_file_path)
+xmlAlignments = list(xmlAlignments.values())
 print(f'Found {len(xmlAlignments)} alignments and {len(xmlTaxa)} taxa')
 
 # Check that taxa are listed in the same order in <taxa> section and in alignments
-taxaIds = [taxon.get('id') for taxon in xmlTaxa]
-alignment1IdRefs = [s.find('taxon').get('idref') for s in xmlAlignments[0].findall('sequence')]
-alignment2IdRefs = [s.find('taxon').get('idref') for s in xmlAlignments[1].findall('sequence')]
-if taxaIds != alignment1IdRefs:
-    raise ValueError("Taxa listed in a different order in <taxa> section and in first alignment?")
-if taxaIds != alignment2IdRefs:
-    raise ValueError("Taxa listed in a different order in <taxa> section and in second alignment?")
+taxaIds = [taxon.taxon_id for taxon in xmlTaxa]
+check_same_taxa_order(taxaIds, xmlAlignments[0])
+check_same_taxa_order(taxaIds, xmlAlignments[1])
 
 # We try to unscramble the genic vs intergenic partition by aligning everything (manually) to the KJ660346 reference
 # genome used in Fig 4 of the paper (in the end, that should make it so that the reference to "position 10,218" in the
@@ -113,96 +113,6 @@ if scratch_ref_fasta_path.exists():
     do_convert = False
     print(f'[SKIPPING] {scratch_ref_fasta_path} already exist')
 
-def parse_genbank_date(gb_date):
-    """
-    Parses a date from GenBank to a pair of min and max dates, encoded as ((yyyy, mm, dd), (yyyy, mm, dd)) min-max tuples.
-    
-    Formats recognized from GenBank:
-    * 1978
-    * 09-Nov-2017
-    * Nov-2017
-    * 2019-01-16
-    * 2018-08
-    """
-    
-    months = {
-        'jan': 1,
-        'feb': 2,
-        'mar': 3,
-        'apr': 4,
-        'may': 5,
-        'jun': 6,
-        'jul': 7,
-        'aug': 8,
-        'sep': 9,
-        'oct': 10,
-        'nov': 11,
-        'dec': 12
-    }
-    
-    # 1978
-    if m := re.match(r'^(\d\d\d\d)$', gb_date):
-        yyyy = int(m[1])
-        return ((yyyy, 1, 1), (yyyy+1, 1, 1))
-        
-    # Nov-2017
-    if m := re.match(r'^(\w\w\w)-(\d\d\d\d)$', gb_date):
-        if m[1].lower() in months:
-            yyyy = int(m[2])
-            mm = months[m[1].lower()]
-            min_date = (yyyy, mm, 1)
-            if mm < 12:
-                max_date = (yyyy, mm+1, 1)
-            else:
-                max_date = (yyyy+1, 1, 1)
-            return (min_date, max_date)
-        
-    # 09-Nov-2017
-    if m := re.match(r'^(\d\d)-(\w\w\w)-(\d\d\d\d)$', gb_date):
-        if m[2].lower() in months:
-            yyyy = int(m[3])
-            mm = months[m[2].lower()]
-            dd = int(m[1])
-            return ((yyyy, mm, dd), (yyyy, mm, dd))
-        
-    # 2019-01-16
-    if m := re.match(r'^(\d\d\d\d)-(\d\d)-(\d\d)$', gb_date):
-        yyyy = int(m[1])
-        mm = int(m[2])
-        dd = int(m[3])
-        return ((yyyy, mm, dd), (yyyy, mm, dd))
-        
-    # 2018-08
-    if m := re.match(r'^(\d\d\d\d)-(\d\d)$', gb_date):
-        yyyy = int(m[1])
-        mm = int(m[2])
-        min_date = (yyyy, mm, 1)
-        if mm < 12:
-            max_date = (yyyy, mm+1, 1)
-        else:
-            max_date = (yyyy+1, 1, 1)
-        return (min_date, max_date)
-        
-    # Nothing
-    return ((1900, 1, 1), (1900, 1, 1))
-
-def unparse_date_range(date_range):
-    (min_date, max_date) = date_range
-    (yyyy1, mm1, dd1) = min_date
-    (yyyy2, mm2, dd2) = max_date
-
-    if min_date == max_date:
-        return f'{yyyy1:04d}-{mm1:02d}-{dd1:02d}'
-
-    if min_date == (yyyy1, 1, 1) and max_date == (yyyy1+1, 1, 1):
-        return f'{yyyy1:04d}'
-
-    if ((min_date == (yyyy1, mm1, 1) and max_date == (yyyy1, mm1+1, 1)) or
-        (min_date == (yyyy1, 12, 1) and max_date == (yyyy1+1, 1, 1))):
-        return f'{yyyy1:04d}-{mm1:02d}'
-
-    return f'{yyyy1:04d}-{mm1:02d}-{dd1:02d}/{yyyy2:04d}-{mm2:02d}-{dd2:02d}'
-
 def gb_to_fasta(in_gb_xml_f, out_fasta_f, default_assembly_name='UNKNOWN'):
     records = Entrez.parse(in_gb_xml_f)
     for record in records:
@@ -247,7 +157,7 @@ if input_fasta_path.exists():
     print(f'[SKIPPING] {input_fasta_path} already exist')
 
 if do_reassembly:
-    # The following map was manually rebuilt by carefully realigning the GenBank reference sequence (GB)
+    # The map in `partition_map.tsv` was manually rebuilt by carefully realigning the GenBank reference sequence (GB)
     # to each of the two partitions (genic = P1, intergenic = P2):
     #
     # GB: [    1,   470) -> P2: [    1,   470): CGGACACACA...AATTCCGAGT
@@ -268,44 +178,25 @@ if do_reassembly:
     # GB: [11581, 18220) -> P1: [ 7879, 14518): ATGGCTACAC...GTTCGATTGA
     # GB: [18220, 18960) -> P2: [ 3704,  4444): ATAACCGTGC...TGTGTGTCCA
     
-    with open(input_fasta_path, 'w') as f:
-        for (taxon, s1, s2) in zip(xmlTaxa,
-                                   xmlAlignments[0].findall('sequence'),
-                                   xmlAlignments[1].findall('sequence')):
-            taxonId = taxon.get('id')
+    partitions = {
+        'P1': [s.seq for s in xmlAlignments[0]],
+        'P2': [s.seq for s in xmlAlignments[1]],
+    }
+    gather_index = build_gather_index(read_partition_map('partition_map.tsv'),
+                                      {name: len(seqs[0]) for name, seqs in partitions.items()})
+
+    # Now realign every taxon to KJ660346 according to the above map
+    finalSeqs = reassemble(partitions, gather_index)
+    
+    with FastaWriter(input_fasta_path) as f:
+        for taxon, finalSeq in zip(xmlTaxa, finalSeqs):
+            taxonId = taxon.taxon_id
             _, gbId, internalId, geo, date = taxonId.split('|')
-            p1 = re.sub(r"\s+", "", ''.join(s1.itertext()))
-            p2 = re.sub(r"\s+", "", ''.join(s2.itertext()))
-            
-            # Now realign this to KJ660346 according to the above map
-            finalSeq = ''.join([
-                p2[    1-1:   470-1],  # [    1,   470)
-                p1[    1-1:  2221-1],  # [  470,  2690)
-                p2[  470-1:   909-1],  # [ 2690,  3129)
-                p1[ 2221-1:  3244-1],  # [ 3129,  4152)
-                p2[  909-1:  1236-1],  # [ 4152,  4479)
-                p1[ 3244-1:  4225-1],  # [ 4479,  5460)
-                p2[ 1236-1:  1815-1],  # [ 5460,  6039)
-                p1[ 4225-1:  5110-1],  # [ 6039,  6924)
-                p1[ 5111-1:  6255-1],  # [ 6924,  8068)
-                "N"*1,                 # [ 8068,  8069)
-                p2[ 1815-1:  2255-1],  # [ 8069,  8509)
-                p1[ 6256-1:  7123-1],  # [ 8509,  9376)
-                p2[ 2255-1:  3224-1],  # [ 9376, 10345)
-                p1[ 7123-1:  7879-1],  # [10345, 11101)
-                p2[ 3224-1:  3704-1],  # [11101, 11581)
-                p1[ 7879-1: 14518-1],  # [11581, 18220)
-                p2[ 3704-1:  4444-1],  # [18220, 18960)
-            ])
-            
-            f.write('>')
-            f.write(f'{gbId}-{internalId}|{date}')
-            f.write('\n')
-            f.write(finalSeq)
-            f.write('\n')
+            f.write(f'{gbId}-{internalId}|{date}', finalSeq)
             
     print(f'Reconstituted multiple sequence alignment written to {input_fasta_path}')
 
+
 # Prepare metadata file
 # =====================
 print("\nPreparing metadata...")
@@ -319,7 +210,7 @@ if do_metadata:
     with open(input_metadata_path, 'w') as f:
         f.write('id,Geo\n')
         for taxon in xmlTaxa:
-            taxonId = taxon.get('id')
+            taxonId = taxon.taxon_id
             _, gbId, internalId, geo, date = taxonId.split('|')
             
             f.write(f'{gbId}-{internalId},{geo}\n')
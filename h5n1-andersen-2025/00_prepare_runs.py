@@ -19,9 +19,13 @@ from collections import defaultdict
 import re
 from pathlib import Path
 import subprocess
-import datetime
 import sys
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))  # For `paper_tools`
+from paper_tools.align import AlignmentCache, align_to_reference
+from paper_tools.dates import parse_genbank_date, unparse_date_range
+from paper_tools.fasta import read_fasta, FastaWriter
+
 if len(sys.argv) != 2:
     sys.stderr.write("Usage: ./00_prepare_runs.py <email-address-for-Entrez>\n")
     sys.exit(1)
@@ -42,26 +46,6 @@ refseq_srr = 'SRR28752635'  # Found in metadata/genbank_mapping.tsv
 ordered_segments = ['PB2', 'PB1', 'PA', 'HA', 'NP', 'NA', 'MP', 'NS']
 segments_set = set(ordered_segments)
 
-# Helper routines
-# ===============
-def read_fasta(path):
-    seqs = []
-    current_seq_id = ''
-    current_seq = ''
-    with open(path, 'r') as raw_f:
-        for line in raw_f:
-            if line.startswith('>'):
-                if current_seq:
-                    seqs.append((current_seq_id, current_seq))
-                current_seq_id = line[1:].strip()
-                current_seq = ''
-            else:
-                current_seq += line.strip()
-        if current_seq:
-            seqs.append((current_seq_id, current_seq))
-    return seqs
-
-
 # Prepare directory structure
 # ===========================
 raw_path = Path('raw')
@@ -296,96 +280,6 @@ if do_fetch:
 # Extract dates and geos from GenBank where available
 # ===================================================
 print("\nParsing dates and geos from GenBank (where available)...")
-def parse_genbank_date(gb_date):
-    """
-    Parses a date from GenBank to a pair of min and max dates, encoded as ((yyyy, mm, dd), (yyyy, mm, dd)) min-max tuples.
-    
-    Formats recognized from GenBank:
-    * 1978
-    * 09-Nov-2017
-    * Nov-2017
-    * 2019-01-16
-    * 2018-08
-    """
-    
-    months = {
-        'jan': 1,
-        'feb': 2,
-        'mar': 3,
-        'apr': 4,
-        'may': 5,
-        'jun': 6,
-        'jul': 7,
-        'aug': 8,
-        'sep': 9,
-        'oct': 10,
-        'nov': 11,
-        'dec': 12
-    }
-    
-    # 1978
-    if m := re.match(r'^(\d\d\d\d)$', gb_date):
-        yyyy = int(m[1])
-        return ((yyyy, 1, 1), (yyyy+1, 1, 1))
-        
-    # Nov-2017
-    if m := re.match(r'^(\w\w\w)-(\d\d\d\d)$', gb_date):
-        if m[1].lower() in months:
-            yyyy = int(m[2])
-            mm = months[m[1].lower()]
-            min_date = (yyyy, mm, 1)
-            if mm < 12:
-                max_date = (yyyy, mm+1, 1)
-            else:
-                max_date = (yyyy+1, 1, 1)
-            return (min_date, max_date)
-        
-    # 09-Nov-2017
-    if m := re.match(r'^(\d\d)-(\w\w\w)-(\d\d\d\d)$', gb_date):
-        if m[2].lower() in months:
-            yyyy = int(m[3])
-            mm = months[m[2].lower()]
-            dd = int(m[1])
-            return ((yyyy, mm, dd), (yyyy, mm, dd))
-        
-    # 2019-01-16
-    if m := re.match(r'^(\d\d\d\d)-(\d\d)-(\d\d)$', gb_date):
-        yyyy = int(m[1])
-        mm = int(m[2])
-        dd = int(m[3])
-        return ((yyyy, mm, dd), (yyyy, mm, dd))
-        
-    # 2018-08
-    if m := re.match(r'^(\d\d\d\d)-(\d\d)$', gb_date):
-        yyyy = int(m[1])
-        mm = int(m[2])
-        min_date = (yyyy, mm, 1)
-        if mm < 12:
-            max_date = (yyyy, mm+1, 1)
-        else:
-            max_date = (yyyy+1, 1, 1)
-        return (min_date, max_date)
-        
-    # Nothing
-    return ((1900, 1, 1), (1900, 1, 1))
-
-def unparse_date_range(date_range):
-    (min_date, max_date) = date_range
-    (yyyy1, mm1, dd1) = min_date
-    (yyyy2, mm2, dd2) = max_date
-
-    if min_date == max_date:
-        return f'{yyyy1:04d}-{mm1:02d}-{dd1:02d}'
-
-    if min_date == (yyyy1, 1, 1) and max_date == (yyyy1+1, 1, 1):
-        return f'{yyyy1:04d}'
-
-    if ((min_date == (yyyy1, mm1, 1) and max_date == (yyyy1, mm1+1, 1)) or
-        (min_date == (yyyy1, 12, 1) and max_date == (yyyy1+1, 1, 1))):
-        return f'{yyyy1:04d}-{mm1:02d}'
-
-    return f'{yyyy1:04d}-{mm1:02d}-{dd1:02d}/{yyyy2:04d}-{mm2:02d}-{dd2:02d}'
-
 def extract_gb_collection_dates_and_geo(in_gb_xml_f):
     result_dates = {}
     result_geos = {}
@@ -547,7 +441,7 @@ for seg in ordered_segments:
                 continue
             fasta.write(f'>{srr_2_final_long_id[srr]}|{srr_2_final_date[srr]}\n')
             srr_fasta_file_path = data_repo_path / 'fasta' / f'{srr}_{seg}_cns.fa'
-            srr_fasta = read_fasta(srr_fasta_file_path)
+            srr_fasta = list(read_fasta(srr_fasta_file_path))
             assert len(srr_fasta) == 1
             fasta_id, seq = srr_fasta[0]
             fasta.write(f'{seq}\n')
@@ -569,15 +463,15 @@ for seg in ordered_segments:
         "--version"
     ])
     
-    with open(scratch_aligned_fasta_path, 'w') as f:
-        subprocess.run([
-            path_to_mafft.as_posix(),
-            "--thread", "-1",
-            "--auto",
-            "--addfragments", scratch_raw_genomes_fasta_path.as_posix(),
-            "--keeplength",
-            scratch_ref_fasta_path.as_posix(),
-        ], stdout=f)
+    # Only distinct genomes are aligned (several mafft processes side by side, each on a shard of them),
+    # then copied back out to every sequence
+    identical_groups_path = scratch_path / f'identical_groups_{seg}.tsv'
+    groups, _ = align_to_reference(read_fasta(scratch_raw_genomes_fasta_path),
+                                   AlignmentCache(scratch_ref_fasta_path),
+                                   scratch_aligned_fasta_path, path_to_mafft,
+                                   identical_groups_path=identical_groups_path)
+    print(f'{groups.num_records} sequences, {groups.num_distinct} distinct '
+          + f'(groups of identical sequences in {identical_groups_path})')
 
 # Make final concatenated alignments
 # ==================================
@@ -605,7 +499,7 @@ if aligned_all_fasta_path.exists():
     print(f'[SKIPPING] File exists')
 else:
     seg_fastas = [read_fasta(scratch_path / f'aligned_{seg}.fasta') for seg in ordered_segments]
-    with open(aligned_all_fasta_path, 'w') as f:
+    with FastaWriter(aligned_all_fasta_path) as f:
         for (i,per_seg_id_seq_pairs) in enumerate(zip(*seg_fastas)):
             first_id_line = per_seg_id_seq_pairs[0][0]
             assert all(id_line == first_id_line for (id_line,seg_seq) in per_seg_id_seq_pairs)
@@ -625,8 +519,7 @@ else:
             if first_id_line.split('|')[0] in bogus_ids:
                 print(f'Removing gross outlier {first_id_line.strip()} after visual inspection')
             else:
-                f.write(f'>{first_id_line.strip()}\n')
-                f.write(f"{''.join(seg_seq.strip() for (id_line,seg_seq) in per_seg_id_seq_pairs)}\n")
+                f.write(first_id_line.strip(), ''.join(seg_seq for (id_line,seg_seq) in per_seg_id_seq_pairs))
 
                 
 aligned_all_full_dates_only_fasta_path = delphy_inputs_path / f'h5n1-andersen-{commit_hash}-ALL_full_dates_only.fasta'
@@ -635,7 +528,7 @@ if aligned_all_full_dates_only_fasta_path.exists():
     print(f'[SKIPPING] File exists')
 else:
     seg_fastas = [read_fasta(scratch_path / f'aligned_{seg}.fasta') for seg in ordered_segments]
-    with open(aligned_all_full_dates_only_fasta_path, 'w') as f:
+    with FastaWriter(aligned_all_full_dates_only_fasta_path) as f:
         for (i,per_seg_id_seq_pairs) in enumerate(zip(*seg_fastas)):
             first_id_line = per_seg_id_seq_pairs[0][0]
             assert all(id_line == first_id_line for (id_line,seg_seq) in per_seg_id_seq_pairs)
@@ -645,8 +538,7 @@ else:
                 if first_id_line.split('|')[0] in bogus_ids:
                     print(f'Removing gross outlier {first_id_line.strip()} after visual inspection')
                 else:
-                    f.write(f'>{first_id_line.strip()}\n')
-                    f.write(f"{''.join(seg_seq.strip() for (id_line,seg_seq) in per_seg_id_seq_pairs)}\n")
+                    f.write(first_id_line.strip(), ''.join(seg_seq for (id_line,seg_seq) in per_seg_id_seq_pairs))
 
 # Prepare metadata file
 # =====================
@@ -2,7 +2,12 @@
 
 from pathlib import Path
 import subprocess
-import xml.etree.ElementTree as ET
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))  # For `paper_tools`
+from paper_tools.beast_xml import read_beast_xml, check_same_taxa_order
+from paper_tools.fasta import FastaWriter
+from paper_tools.partitions import merge_partitions
 
 # Prepare directory structure
 # ===========================
@@ -34,24 +39,17 @@ if not beast_file_path.exists():
 # Extract sequences from BEAST file
 # =================================
 print("\nReading sequence data from BEAST XML file...")
-beastXml = ET.parse(beast_file_path.as_posix())
-alignments = beastXml.findall("alignment")
-apobec3_alignment = [a for a in alignments if a.get('id') == 'apobec3_alignment'][0]
-non_apobec3_alignment = [a for a in alignments if a.get('id') == 'non_apobec3_alignment'][0]
+_, alignments = read_beast_xml(beast_file_path)
+apobec3_alignment = alignments['apobec3_alignment']
+non_apobec3_alignment = alignments['non_apobec3_alignment']
 
 included_sequences = []
 
 # Check that sequences are listed in the same order in both alignments
-for apo, nonapo in zip(apobec3_alignment.findall('sequence'),
-                       non_apobec3_alignment.findall('sequence')):
-    apo_id = apo.find("taxon").get("idref")
-    non_apo_id = nonapo.find("taxon").get("idref")
-    
-    if apo_id != non_apo_id:
-        raise ValueError(f'Sequences in BEAST files alignments listed in different order (first discrepancy: {apo_id} vs {non_apo_id})')
+check_same_taxa_order([s.taxon_id for s in apobec3_alignment], non_apobec3_alignment)
 
-for d in apobec3_alignment.findall('sequence'):
-    theId = d.find("taxon").get('idref')
+for d in apobec3_alignment:
+    theId = d.taxon_id
     theDate = theId.split('|')[-1]
     
     # Skip the 1 GISAID sequence
@@ -80,37 +78,31 @@ if input_fasta_path.exists():
     print(f'[SKIPPING] {input_fasta_path} already exist')
 
 if do_reassembly:
-    with open(input_fasta_path, 'w') as f:
-        for apo, nonApo in zip(apobec3_alignment.findall('sequence'),
-                               non_apobec3_alignment.findall('sequence')):
-            apoId = apo.find("taxon").get("idref")
-            nonApoId = nonApo.find("taxon").get("idref")
-            
-            if apoId != nonApoId:
-                raise ValueError('APO and non-APO sequences with different ids?')
-            
-            theId = apoId
-            theDate = theId.split('|')[-1]
-    
-            if apoId not in included_sequences:
-                continue
-    
-            apoSeq = ''.join(t for t in apo.itertext()).strip()
-            nonApoSeq = ''.join(t for t in nonApo.itertext()).strip()
-            states = []
-            for apoState, nonApoState in zip(apoSeq, nonApoSeq):
-                if apoState == 'N':
-                    states.append(nonApoState)
-                else:
-                    states.append(apoState)
-            
-            seq = ''.join(states)
-                
-            f.write('>')
-            f.write(theId)
-            f.write('\n')
-            f.write(seq)
-            f.write('\n')
+    fastaIds = []
+    apoSeqs = []
+    nonApoSeqs = []
+    for apo, nonApo in zip(apobec3_alignment, non_apobec3_alignment):
+        apoId = apo.taxon_id
+        nonApoId = nonApo.taxon_id
+        
+        if apoId != nonApoId:
+            raise ValueError('APO and non-APO sequences with different ids?')
+        
+        theId = apoId
+        theDate = theId.split('|')[-1]
+
+        if apoId not in included_sequences:
+            continue
+
+        fastaIds.append(theId)
+        apoSeqs.append(apo.seq)
+        nonApoSeqs.append(nonApo.seq)
+
+    # Non-APOBEC3 states fill in wherever the APOBEC3 partition has an N
+    seqs = merge_partitions([apoSeqs, nonApoSeqs])
+    with FastaWriter(input_fasta_path) as f:
+        for fastaId, seq in zip(fastaIds, seqs):
+            f.write(fastaId, seq)
 
 
 # Prepare metadata file
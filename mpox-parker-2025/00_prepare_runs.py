@@ -3,8 +3,16 @@
 from pathlib import Path
 import subprocess
 import xml.etree.ElementTree as ET
+import sys
 import zipfile
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))  # For `paper_tools`
+from paper_tools.beast_xml import read_beast_xml, check_same_taxa_order
+from paper_tools.fasta import FastaWriter
+from paper_tools.partitions import merge_partitions
+from paper_tools.xml_rewrite import (Rule, REMOVE, XmlIndex, apply_rules, child_idref,
+                                    has_id, has_idref, has_label, child_has_idref, rename, rename_child)
+
 # Prepare directory structure
 # ===========================
 raw_path = Path('raw')
@@ -37,34 +45,23 @@ if not orig_beast_zip_file_path.exists():
 print("\nReading sequence data from BEAST XML file...")
 with zipfile.ZipFile(orig_beast_zip_file_path.as_posix(), 'r') as archive:
     with archive.open('Mpox_2epoch_combinedDTA.xml', 'r') as f:
-        beastXml = ET.parse(f)
-alignments = beastXml.findall("alignment")
-apobec3_alignment = [a for a in alignments if a.get('id') == 'apobec3_alignment'][0]
-non_apobec3_alignment = [a for a in alignments if a.get('id') == 'non_apobec3_alignment'][0]
+        main_taxa, alignments = read_beast_xml(f, taxa_id='taxa')  # Streamed straight out of the zip file
+apobec3_alignment = alignments['apobec3_alignment']
+non_apobec3_alignment = alignments['non_apobec3_alignment']
 
 included_sequences = []
 
 # Check that sequences are listed in the same order in both alignments
-for apo, nonapo in zip(apobec3_alignment.findall('sequence'),
-                       non_apobec3_alignment.findall('sequence')):
-    apo_id = apo.find("taxon").get("idref")
-    non_apo_id = nonapo.find("taxon").get("idref")
-    
-    if apo_id != non_apo_id:
-        raise ValueError(f'Sequences in BEAST files alignments listed in different order (first discrepancy: {apo_id} vs {non_apo_id})')
+check_same_taxa_order([s.taxon_id for s in apobec3_alignment], non_apobec3_alignment)
 
 
 # First extract state & region from BEAST XML
 id_2_state = {}
 id_2_region = {}
 
-taxas = beastXml.findall("taxa")
-main_taxa_xml = [t for t in taxas if t.get('id') == 'taxa'][0]  # First taxa element with id "taxa"
-for taxon_xml in main_taxa_xml:
-    theId = taxon_xml.get('id')
-    attrs = taxon_xml.findall('attr')
-    id_2_state[theId] = [a for a in attrs if a.get('name') == 'State'][0].text.strip()
-    id_2_region[theId] = [a for a in attrs if a.get('name') == 'Region'][0].text.strip()
+for taxon in main_taxa:  # Taxa in the (first) <taxa> element with id "taxa"
+    id_2_state[taxon.taxon_id] = taxon.attrs['State']
+    id_2_region[taxon.taxon_id] = taxon.attrs['Region']
 
 if False:   # Debugging
     for state in sorted(set(id_2_state.values())):
@@ -91,8 +88,8 @@ def validate_date(date_str):
         raise ValueError(f'Invalid date string: {date_str}')
     return date_str
 
-for d in apobec3_alignment.findall('sequence'):
-    theId = d.find("taxon").get('idref')
+for d in apobec3_alignment:
+    theId = d.taxon_id
     theDate = validate_date(theId.split('|')[-1])  # All dates in the BEAST XML pass, so we use them as-is later
 
     # Skip GISAID sequences
@@ -145,40 +142,32 @@ if input_fasta_path.exists():
     print(f'[SKIPPING] {input_fasta_path} already exists')
 
 if do_reassembly:
-    with open(input_fasta_path, 'w') as f:
+    fastaIds = []
+    apoSeqs = []
+    nonApoSeqs = []
+    for apo, nonApo in zip(apobec3_alignment, non_apobec3_alignment):
+        apoId = apo.taxon_id
+        nonApoId = nonApo.taxon_id
         
-        for apo, nonApo in zip(apobec3_alignment.findall('sequence'),
-                               non_apobec3_alignment.findall('sequence')):
-            apoId = apo.find("taxon").get("idref")
-            nonApoId = nonApo.find("taxon").get("idref")
-            
-            if apoId != nonApoId:
-                raise ValueError('APO and non-APO sequences with different ids?')
-            
-            lastBarIndex = apoId.rindex('|')
-            theId, theDate = apoId[:lastBarIndex], apoId[lastBarIndex+1:]
-    
-            if apoId not in included_sequences:
-                continue
-
-            apoSeq = ''.join(t for t in apo.itertext()).strip()
-            nonApoSeq = ''.join(t for t in nonApo.itertext()).strip()
-            states = []
-            for apoState, nonApoState in zip(apoSeq, nonApoSeq):
-                if apoState == 'N':
-                    states.append(nonApoState)
-                else:
-                    states.append(apoState)
-            
-            seq = ''.join(states)
-                
-            f.write('>')
-            fastaId = f'{shorten_id(apoId)}|{theId}|{theDate}'  # Extract simple unique id for web UI and metadata
-            f.write(fastaId)
-            f.write('\n')
-            f.write(seq)
-            f.write('\n')
-                
+        if apoId != nonApoId:
+            raise ValueError('APO and non-APO sequences with different ids?')
+        
+        lastBarIndex = apoId.rindex('|')
+        theId, theDate = apoId[:lastBarIndex], apoId[lastBarIndex+1:]
+
+        if apoId not in included_sequences:
+            continue
+
+        fastaIds.append(f'{shorten_id(apoId)}|{theId}|{theDate}')  # Extract simple unique id for web UI and metadata
+        apoSeqs.append(apo.seq)
+        nonApoSeqs.append(nonApo.seq)
+
+    # Non-APOBEC3 states fill in wherever the APOBEC3 partition has an N
+    seqs = merge_partitions([apoSeqs, nonApoSeqs])
+    with FastaWriter(input_fasta_path) as f:
+        for fastaId, seq in zip(fastaIds, seqs):
+            f.write(fastaId, seq)
+
 
 # Prepare metadata file
 # =====================
@@ -257,8 +246,7 @@ if do_metadata:
 # ===============================================================================================================
 # This is a bit nasty, but at least you see all the changes clearly.
 #
-# WARNING: beastXml is modified in place, so won't reflect the original contents of the BEAST XML
-# from the mpox paper repo after this block.   That's why this is the last step.
+# This is the only step that needs the full document tree, so we only parse the whole BEAST XML here.
 
 beast_run_path = Path('beast_run')
 beast_run_path.mkdir(parents=True, exist_ok=True)
@@ -271,297 +259,138 @@ if beast_path.exists():
     print(f'[SKIPPING] {beast_path} already exists')
 
 if do_beast:
+    with zipfile.ZipFile(orig_beast_zip_file_path.as_posix(), 'r') as archive:
+        with archive.open('Mpox_2epoch_combinedDTA.xml', 'r') as f:
+            beastXml = ET.parse(f)
     root = beastXml.getroot()
 
-    # Remove excluded taxa
-    for taxa in root.findall('taxa'):
-        if taxa.get('id') != 'taxa':
-            continue
-        to_remove = [t for t in taxa.findall('taxon') if t.get('id') not in included_sequences]
-        for t in to_remove:
-            #print(f'Removing {t.get("id")}')
-            taxa.remove(t)
-            
-    # Remove excluded taxa from alignments
-    for alignment in root.findall('alignment'):
-        to_remove = []
-        for sequence in alignment.findall('sequence'):
-            seq_id = sequence.find('taxon').get('idref')
-            if seq_id not in included_sequences:
-                #print(f'Removing {seq_id} from {alignment.get("id")}')
-                to_remove.append(sequence)
-        for s in to_remove:
-            alignment.remove(s)
-        
-    # Remove excluded taxa from treeModel's uncertain leafHeights
-    treeModel = root.find('treeModel')
-    to_remove = []
-    for elem in treeModel:
-        if elem.tag == 'leafHeight' and elem.get('taxon') not in included_sequences:
-            to_remove.append(elem)
-    
-    for e in to_remove:
-        treeModel.remove(e)
-
-    # Remove DTA attributes from taxa
-    for taxa in root.findall('taxa'):
-        if taxa.get('id') != 'taxa':
-            continue
-        for taxon in taxa.findall('taxon'):
-            subelems = list(taxon.iter())
-            for elem in subelems:
-                if elem.tag == 'attr':
-                    taxon.remove(elem)
-                    
-    # Remove top-level "ingroup" and "outgroup" taxa and everything associated with them
-    to_remove = [t for t in beastXml.findall('taxa') if t.get('id') in ["ingroup", "outgroup"]]
-    for t in to_remove:
-        root.remove(t)
-    
-    to_remove = []
-    for tmrcaStatistic in root.findall('tmrcaStatistic'):
-        theId = tmrcaStatistic.get('id')
-        if 'ingroup' in theId or 'outgroup' in theId:
-            to_remove.append(tmrcaStatistic)
-    
-    for coal in root.findall('coalescentLikelihood'):
-        if coal.get('id') == 'coalescent.outgroup':
-            to_remove.append(coal)
-    
-        if coal.get('id') == 'coalescent.ingroup':
-            coal.set('id', 'coalescent')
-            coal.find('include').find('taxa').set('idref', 'taxa')
-    
-    for m in root.findall('localClockModel'):
-        if m.get('id') == 'apobec3.branchRates':
-            m.clear()
-            m.tag = 'strictClockBranchRates'
-            m.set('id', 'apobec3.branchRates')
-            r = ET.Element('rate')
-            r.append(ET.Element('parameter', {'idref': 'apobec3.clock.rate'}))
-            m.append(r)
-    
-    for e in root.findall('productParameter'):
-        if e.get('id') == 'apobec3.stem.time':
-            to_remove.append(e)
-    
-    for e in root.findall('sumParameter'):
-        if e.get('id') == 'apobec3.transition.time':
-            to_remove.append(e)
-    
-    for e in root.findall('ageStatistic'):
-        if e.get('id') == 'age(apobec3.transition)':
-            to_remove.append(e)
-    
-    for e in root.findall('rateStatistic'):
-        if e.get('id') == 'apobec3.meanRate':
-            e.find('localClockModel').tag = 'strictClockBranchRates'
-    for e in root.findall('ancestralTreeLikelihood'):
-        e.tag = 'treeDataLikelihood'
-        if e.get('id') == 'apobec3.treeLikelihood':
-            e.find('localClockModel').tag = 'strictClockBranchRates'
-    
-    for e in to_remove:
-        root.remove(e)
-
-    # Remove DTA-related elements
-    to_remove = []
-    for e in root.findall('generalDataType'):
-        if e.get('id') in ['Region.dataType', 'State.dataType']:
-            to_remove.append(e)
-    for e in root.findall('attributePatterns'):
-        if e.get('id') in ['Region.pattern', 'State.pattern']:
-            to_remove.append(e)
-    for e in root.findall('generalSubstitutionModel'):
-        if e.get('id') in ['Region.model', 'State.model']:
-            to_remove.append(e)
-    for e in root.findall('sumStatistic'):
-        if e.get('id') in ['Region.nonZeroRates', 'State.nonZeroRates']:
-            to_remove.append(e)
-    for e in root.findall('productStatistic'):
-        if e.get('id') in ['Region.actualRates', 'State.actualRates']:
-            to_remove.append(e)
-    for e in root.findall('siteModel'):
-        if e.get('id') in ['Region.siteModel', 'State.siteModel']:
-            to_remove.append(e)
-    for e in root.findall('markovJumpsTreeLikelihood'):
-        if e.get('id') in ['Region.treeLikelihood', 'State.treeLikelihood']:
-            to_remove.append(e)
-    
-    for e in to_remove:
-        root.remove(e)
-    
-    
-    
-    mcmc = root.find('mcmc')
-    joint = mcmc.find('joint')
-    
-    prior = joint.find('prior')
-    to_remove = []
-    for elem in prior:
-        # DTA
-        if (elem.tag == 'ctmcScalePrior' and 
-            elem.find('ctmcScale').find('parameter').get('idref') in ['Region.clock.rate', 'State.clock.rate']):
-            to_remove.append(elem)
-        if elem.tag == 'poissonPrior' and elem.find('statistic').get('idref') in ['Region.nonZeroRates', 'State.nonZeroRates']:
-            to_remove.append(elem)
-        if elem.tag == 'uniformPrior' and elem.find('parameter').get('idref') in ['Region.frequencies', 'State.frequencies']:
-            to_remove.append(elem)
-        if elem.tag == 'cachedPrior' and elem.find('parameter').get('idref') in ['Region.rates', 'State.rates']:
-            to_remove.append(elem)
-        if elem.tag == 'uniformPrior' and elem.find('parameter').get('idref') in ['Region.root.frequencies', 'State.root.frequencies']:
-            to_remove.append(elem)
-        if elem.tag == 'strictClockBranchRates' and elem.get('idref') in ['Region.branchRates', 'State.branchRates']:
-            to_remove.append(elem)
-        if elem.tag == 'generalSubstitutionModel' and elem.get('idref') in ['Region.model', 'State.model']:
-            to_remove.append(elem)
-
-        # Spillover
-        if elem.tag == 'uniformPrior' and elem.find('parameter').get('idref') == 'apobec3.stem.proportion':
-            to_remove.append(elem)
-        if elem.tag == 'oneOnXPrior' and elem.find('parameter').get('idref') == 'constant.popSize':
-            to_remove.append(elem)
-        if elem.tag == 'coalescentLikelihood' and elem.get('idref') == 'coalescent.outgroup':
-            to_remove.append(elem)
-        if elem.tag == 'coalescentLikelihood' and elem.get('idref') == 'coalescent.ingroup':
-            elem.set('idref', 'coalescent')
-        if elem.tag == 'localClockModel' and elem.get('idref') == 'apobec3.branchRates':
-            elem.tag = 'strictClockBranchRates'
-        
-    for e in to_remove:
-        prior.remove(e)
-    
-    
-    likelihood = joint.find('likelihood')
-    to_remove = []
-    for elem in likelihood:
-        # DTA
-        if elem.tag == 'markovJumpsTreeLikelihood' and elem.get('idref') in ['Region.treeLikelihood', 'State.treeLikelihood']:
-            to_remove.append(elem)
-        if elem.tag == 'ancestralTreeLikelihood' and elem.get('idref') == 'apobec3.treeLikelihood':
-            elem.tag = 'treeDataLikelihood'
-        
-    for e in to_remove:
-        likelihood.remove(e)
-
-    to_remove = []
-    for elem in root:
-        if elem.tag == 'strictClockBranchRates' and elem.get('id') in ['Region.branchRates', 'State.branchRates']:
-            to_remove.append(elem)
-        if elem.tag == 'rateStatistic' and elem.get('id') in ['Region.meanRate', 'State.meanRate']:
-            to_remove.append(elem)
-    
-    for t in to_remove:
-        root.remove(t)
-    
-    operators = root.find('operators')
-    to_remove = []
-    for op in operators:
-        # DTA
-        if op.tag == 'scaleOperator' and op.find('parameter').get('idref') in ['Region.clock.rate', 'State.clock.rate']:
-            to_remove.append(op)
-        if op.tag == 'upDownOperator' and op.find('down').find('parameter').get('idref') in ['Region.clock.rate', 'State.clock.rate']:
-            to_remove.append(op)
-        if op.tag == 'scaleOperator' and op.find('parameter').get('idref') in ['Region.rates', 'State.rates']:
-            to_remove.append(op)
-        if op.tag == 'bitFlipOperator' and op.find('parameter').get('idref') in ['Region.indicators', 'State.indicators']:
-            to_remove.append(op)
-        if op.tag == 'deltaExchange' and op.find('parameter').get('idref') in ['Region.root.frequencies', 'State.root.frequencies']:
-            to_remove.append(op)
-    
-        # Spillover
-        if op.tag == 'scaleOperator' and op.find('parameter').get('idref') == 'constant.popSize':
-            to_remove.append(op)
-        if op.tag == 'randomWalkOperator' and op.find('parameter').get('idref') == 'apobec3.stem.proportion':
-            to_remove.append(op)
-        if op.tag == 'uniformOperator' and op.find('parameter').get('idref') not in [f'age({s})' for s in included_sequences]:
-            to_remove.append(op)
-
-    for t in to_remove:
-        operators.remove(t)
-
-    to_remove = []
-    for log in mcmc.findall('log'):
-        if log.get('id') in ['Mpox_2poch_combined.RegionrateMatrixLog', 'Mpox_2poch_combined.StaterateMatrixLog']:
-            to_remove.append(log)
-    for logTree in mcmc.findall('logTree'):
-        if logTree.get('fileName') in ['Mpox_2poch_combined.Region.history.trees', 'Mpox_2poch_combined.State.history.trees']:
-            to_remove.append(logTree)
-        if logTree.get('id') == 'treeFileLog':
-            for trait in logTree.findall('trait'):
-                if trait.get('tag') == 'apobec3.rate':
-                    for m in trait.findall('localClockModel'):
-                        m.tag = 'strictClockBranchRates'
-    for l in to_remove:
-        mcmc.remove(l)
-    
-    for log in mcmc.findall('log'):
-        to_remove = []
-        for elem in log:
-            # DTA
-            if elem.tag == 'column' and elem.get('label') in ['Region.clock.rate', 'State.clock.rate']:
-                to_remove.append(elem)
-            if elem.tag == 'column' and elem.get('label') in ['Region.nonZeroRates', 'State.nonZeroRates']:
-                to_remove.append(elem)
-            if elem.tag == 'rateStatistic' and elem.get('idref') in ['Region.meanRate', 'State.meanRate']:
-                to_remove.append(elem)
-            if elem.tag == 'parameter' and elem.get('idref') in ['Region.rates', 'State.rates']:
-                to_remove.append(elem)
-            if elem.tag == 'parameter' and elem.get('idref') in ['Region.indicators', 'State.indicators']:
-                to_remove.append(elem)
-            if elem.tag == 'parameter' and elem.get('idref') in ['Region.nonZeroRates', 'State.nonZeroRates']:
-                to_remove.append(elem)
-            if elem.tag == 'parameter' and elem.get('idref') in ['Region.clock.rate', 'State.clock.rate']:
-                to_remove.append(elem)
-            if elem.tag == 'strictClockBranchRates' and elem.get('idref') in ['Region.branchRates', 'State.branchRates']:
-                to_remove.append(elem)
-            if elem.tag == 'sumStatistic' and elem.get('idref') in ['Region.nonZeroRates', 'State.nonZeroRates']:
-                to_remove.append(elem)
-            if elem.tag == 'markovJumpsTreeLikelihood' and elem.get('idref') in ['Region.treeLikelihood', 'State.treeLikelihood']:
-                to_remove.append(elem)
-    
-            # Spillover
-            if elem.tag == 'column' and elem.get('label') == 'age(ingroup)':
-                to_remove.append(elem)
-            if elem.tag == 'column' and elem.get('label') == 'stem.proportion':
-                to_remove.append(elem)
-            if elem.tag == 'column' and elem.get('label') == 'age(transition)':
-                to_remove.append(elem)
-            if elem.tag == 'tmrcaStatistic' and elem.get('idref') in ['tmrca(ingroup)', 'tmrca(outgroup)', 'age(ingroup)', 'age(outgroup)']:
-                to_remove.append(elem)
-            if elem.tag == 'parameter' and elem.get('idref') == 'apobec3.stem.proportion':
-                to_remove.append(elem)
-            if elem.tag == 'parameter' and elem.get('idref') == 'apobec3.transition.time':
-                to_remove.append(elem)
-            if elem.tag == 'ageStatistic' and elem.get('idref') == 'age(apobec3.transition)':
-                to_remove.append(elem)
-            if elem.tag == 'parameter' and elem.get('idref') == 'constant.popSize':
-                to_remove.append(elem)
-            if (elem.tag == 'parameter' and
-                elem.get('idref').startswith('age') and
-                elem.get('idref') not in [f'age({s})' for s in included_sequences]):
-                to_remove.append(elem)
-            if elem.tag == 'ancestralTreeLikelihood' and elem.get('idref') == 'apobec3.treeLikelihood':
-                elem.tag = 'treeDataLikelihood'
-            if elem.tag == 'localClockModel' and elem.get('idref') == 'apobec3.branchRates':
-                elem.tag = 'strictClockBranchRates'
-            if elem.tag == 'coalescentLikelihood' and elem.get('idref') == 'coalescent.outgroup':
-                to_remove.append(elem)
-            if elem.tag == 'coalescentLikelihood' and elem.get('idref') == 'coalescent.ingroup':
-                elem.set('idref', 'coalescent')
-    
-        for elem in to_remove:
-            log.remove(elem)
+    included = set(included_sequences)
+    included_ages = {f'age({s})' for s in included_sequences}
+
+    def dta_traits(suffix):
+        return {f'Region.{suffix}', f'State.{suffix}'}
+
+    def make_strict_clock(m, parent):
+        m.clear()
+        m.tag = 'strictClockBranchRates'
+        m.set('id', 'apobec3.branchRates')
+        r = ET.Element('rate')
+        r.append(ET.Element('parameter', {'idref': 'apobec3.clock.rate'}))
+        m.append(r)
+
+    def rename_ingroup_coalescent(coal, parent):
+        coal.set('id', 'coalescent')
+        coal.find('include').find('taxa').set('idref', 'taxa')
+
+    rules = [
+        # Remove excluded taxa, from the taxa list, the alignments and treeModel's uncertain leafHeights
+        Rule('taxa', 'taxon', lambda t, taxa: taxa.get('id') == 'taxa' and t.get('id') not in included, REMOVE),
+        Rule('alignment', 'sequence', lambda s, a: child_idref(s, 'taxon') not in included, REMOVE),
+        Rule('treeModel', 'leafHeight', lambda e, tm: e.get('taxon') not in included, REMOVE),
+
+        # Remove DTA attributes from taxa
+        Rule('taxa/taxon', 'attr', lambda a, t: index.parent[t].get('id') == 'taxa', REMOVE),
+
+        # Remove top-level "ingroup" and "outgroup" taxa and everything associated with them
+        Rule('.', 'taxa', has_id('ingroup', 'outgroup'), REMOVE),
+        Rule('.', 'tmrcaStatistic', lambda e, root: 'ingroup' in e.get('id') or 'outgroup' in e.get('id'), REMOVE),
+        Rule('.', 'coalescentLikelihood', has_id('coalescent.outgroup'), REMOVE),
+        Rule('.', 'coalescentLikelihood', has_id('coalescent.ingroup'), rename_ingroup_coalescent),
+        Rule('.', 'localClockModel', has_id('apobec3.branchRates'), make_strict_clock),
+        Rule('.', 'productParameter', has_id('apobec3.stem.time'), REMOVE),
+        Rule('.', 'sumParameter', has_id('apobec3.transition.time'), REMOVE),
+        Rule('.', 'ageStatistic', has_id('age(apobec3.transition)'), REMOVE),
+        Rule('.', 'rateStatistic', has_id('apobec3.meanRate'), rename_child('localClockModel', 'strictClockBranchRates')),
+        Rule('.', 'ancestralTreeLikelihood', has_id('apobec3.treeLikelihood'), rename_child('localClockModel', 'strictClockBranchRates')),
+        Rule('.', 'ancestralTreeLikelihood', None, rename('treeDataLikelihood')),
+
+        # Remove DTA-related elements
+        Rule('.', 'generalDataType', has_id(*dta_traits('dataType')), REMOVE),
+        Rule('.', 'attributePatterns', has_id(*dta_traits('pattern')), REMOVE),
+        Rule('.', 'generalSubstitutionModel', has_id(*dta_traits('model')), REMOVE),
+        Rule('.', 'sumStatistic', has_id(*dta_traits('nonZeroRates')), REMOVE),
+        Rule('.', 'productStatistic', has_id(*dta_traits('actualRates')), REMOVE),
+        Rule('.', 'siteModel', has_id(*dta_traits('siteModel')), REMOVE),
+        Rule('.', 'markovJumpsTreeLikelihood', has_id(*dta_traits('treeLikelihood')), REMOVE),
+        Rule('.', 'strictClockBranchRates', has_id(*dta_traits('branchRates')), REMOVE),
+        Rule('.', 'rateStatistic', has_id(*dta_traits('meanRate')), REMOVE),
+
+        # Priors: DTA
+        Rule('mcmc/joint/prior', 'ctmcScalePrior', child_has_idref(['ctmcScale', 'parameter'], dta_traits('clock.rate')), REMOVE),
+        Rule('mcmc/joint/prior', 'poissonPrior', child_has_idref(['statistic'], dta_traits('nonZeroRates')), REMOVE),
+        Rule('mcmc/joint/prior', 'uniformPrior', child_has_idref(['parameter'], dta_traits('frequencies')), REMOVE),
+        Rule('mcmc/joint/prior', 'cachedPrior', child_has_idref(['parameter'], dta_traits('rates')), REMOVE),
+        Rule('mcmc/joint/prior', 'uniformPrior', child_has_idref(['parameter'], dta_traits('root.frequencies')), REMOVE),
+        Rule('mcmc/joint/prior', 'strictClockBranchRates', has_idref(*dta_traits('branchRates')), REMOVE),
+        Rule('mcmc/joint/prior', 'generalSubstitutionModel', has_idref(*dta_traits('model')), REMOVE),
+
+        # Priors: spillover
+        Rule('mcmc/joint/prior', 'uniformPrior', child_has_idref(['parameter'], {'apobec3.stem.proportion'}), REMOVE),
+        Rule('mcmc/joint/prior', 'oneOnXPrior', child_has_idref(['parameter'], {'constant.popSize'}), REMOVE),
+        Rule('mcmc/joint/prior', 'coalescentLikelihood', has_idref('coalescent.outgroup'), REMOVE),
+        Rule('mcmc/joint/prior', 'coalescentLikelihood', has_idref('coalescent.ingroup'),
+             lambda e, parent: e.set('idref', 'coalescent')),
+        Rule('mcmc/joint/prior', 'localClockModel', has_idref('apobec3.branchRates'), rename('strictClockBranchRates')),
+
+        # Likelihood: DTA
+        Rule('mcmc/joint/likelihood', 'markovJumpsTreeLikelihood', has_idref(*dta_traits('treeLikelihood')), REMOVE),
+        Rule('mcmc/joint/likelihood', 'ancestralTreeLikelihood', has_idref('apobec3.treeLikelihood'), rename('treeDataLikelihood')),
+
+        # Operators: DTA
+        Rule('operators', 'scaleOperator', child_has_idref(['parameter'], dta_traits('clock.rate')), REMOVE),
+        Rule('operators', 'upDownOperator', child_has_idref(['down', 'parameter'], dta_traits('clock.rate')), REMOVE),
+        Rule('operators', 'scaleOperator', child_has_idref(['parameter'], dta_traits('rates')), REMOVE),
+        Rule('operators', 'bitFlipOperator', child_has_idref(['parameter'], dta_traits('indicators')), REMOVE),
+        Rule('operators', 'deltaExchange', child_has_idref(['parameter'], dta_traits('root.frequencies')), REMOVE),
+
+        # Operators: spillover
+        Rule('operators', 'scaleOperator', child_has_idref(['parameter'], {'constant.popSize'}), REMOVE),
+        Rule('operators', 'randomWalkOperator', child_has_idref(['parameter'], {'apobec3.stem.proportion'}), REMOVE),
+        Rule('operators', 'uniformOperator', lambda op, parent: child_idref(op, 'parameter') not in included_ages, REMOVE),
+
+        # Loggers
+        Rule('mcmc', 'log', has_id('Mpox_2poch_combined.RegionrateMatrixLog', 'Mpox_2poch_combined.StaterateMatrixLog'), REMOVE),
+        Rule('mcmc', 'logTree', lambda e, mcmc: e.get('fileName') in ['Mpox_2poch_combined.Region.history.trees',
+                                                                       'Mpox_2poch_combined.State.history.trees'], REMOVE),
+        Rule('mcmc/logTree/trait', 'localClockModel',
+             lambda m, trait: trait.get('tag') == 'apobec3.rate' and index.parent[trait].get('id') == 'treeFileLog',
+             rename('strictClockBranchRates')),
+
+        # Log columns: DTA
+        Rule('mcmc/log', 'column', has_label(*dta_traits('clock.rate'), *dta_traits('nonZeroRates')), REMOVE),
+        Rule('mcmc/log', 'rateStatistic', has_idref(*dta_traits('meanRate')), REMOVE),
+        Rule('mcmc/log', 'parameter', has_idref(*dta_traits('rates'), *dta_traits('indicators'),
+                                                *dta_traits('nonZeroRates'), *dta_traits('clock.rate')), REMOVE),
+        Rule('mcmc/log', 'strictClockBranchRates', has_idref(*dta_traits('branchRates')), REMOVE),
+        Rule('mcmc/log', 'sumStatistic', has_idref(*dta_traits('nonZeroRates')), REMOVE),
+        Rule('mcmc/log', 'markovJumpsTreeLikelihood', has_idref(*dta_traits('treeLikelihood')), REMOVE),
+
+        # Log columns: spillover
+        Rule('mcmc/log', 'column', has_label('age(ingroup)', 'stem.proportion', 'age(transition)'), REMOVE),
+        Rule('mcmc/log', 'tmrcaStatistic', has_idref('tmrca(ingroup)', 'tmrca(outgroup)', 'age(ingroup)', 'age(outgroup)'), REMOVE),
+        Rule('mcmc/log', 'parameter', has_idref('apobec3.stem.proportion', 'apobec3.transition.time', 'constant.popSize'), REMOVE),
+        Rule('mcmc/log', 'ageStatistic', has_idref('age(apobec3.transition)'), REMOVE),
+        Rule('mcmc/log', 'parameter',
+             lambda e, log: e.get('idref').startswith('age') and e.get('idref') not in included_ages, REMOVE),
+        Rule('mcmc/log', 'ancestralTreeLikelihood', has_idref('apobec3.treeLikelihood'), rename('treeDataLikelihood')),
+        Rule('mcmc/log', 'localClockModel', has_idref('apobec3.branchRates'), rename('strictClockBranchRates')),
+        Rule('mcmc/log', 'coalescentLikelihood', has_idref('coalescent.outgroup'), REMOVE),
+        Rule('mcmc/log', 'coalescentLikelihood', has_idref('coalescent.ingroup'), lambda e, parent: e.set('idref', 'coalescent')),
+    ]
+
+    index = XmlIndex(root)
+    apply_rules(root, rules)
 
     # Only modeling exponential growth post-spillover
     root.remove(root.find('constantSize'))
-    startingTree = root.find('coalescentTree')
-    assert startingTree.get('id') == 'startingTree'
+    startingTree = index.by_id['startingTree']
+    assert startingTree.tag == 'coalescentTree'
     startingTree.find('taxa').set('idref', 'taxa')
     startingTree.find('constantSize').set('idref', 'exponential')
     startingTree.remove(startingTree.find('coalescentTree'))
 
     # And without DTA & spillover, we don't need very long chains at all to reach high ESSs
+    mcmc = root.find('mcmc')
     mcmc.set('chainLength', '50000000') # was '400000000' in original file (8x longer!)
 
     beastXml.write(beast_path.as_posix())
@@ -0,0 +1,4 @@
+# Helpers shared by the per-dataset scripts in this repo.
+#
+# The dataset scripts are run from inside their own directories (e.g., `cd sars-cov-2-lemieux; ./00_prepare_runs.py`),
+# so they put the repo root on `sys.path` before importing anything from here.
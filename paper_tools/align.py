@@ -0,0 +1,244 @@
+# Reference-guided alignment with mafft, with a content-addressed cache
+# =====================================================================
+#
+# With `mafft --addfragments <fragments> --keeplength <ref>`, every fragment is aligned to the (fixed) reference
+# independently of the other fragments, and insertions relative to the reference are dropped.  So the aligned form
+# of a sequence depends only on the sequence itself and on the reference, and can be cached under the pair
+# (sha256 of the reference, sha256 of the sequence).  Datasets built up incrementally (e.g., the cumulative
+# week-by-week GISAID inputs) then only ever align each distinct genome once, and identical genomes within a
+# dataset are only aligned once too (see `dedup.py`).
+#
+# The cache for a reference lives in `<cache_dir>/<reference hash>.<mafft signature>.fasta`, whose record ids are
+# sequence hashes; the signature hashes the output of `mafft --version` and the alignment options, so upgrading
+# mafft or changing how it's run starts a fresh cache.  The file is only ever appended to; a record truncated by an
+# interrupted run is cut off when the cache is loaded, so that the next append starts on a record boundary.
+#
+# For the same reason, a big set of fragments can be split into shards that are aligned by separate mafft processes
+# running side by side, each with a few threads, and the outputs concatenated back in input order.  mafft's own
+# multithreading scales poorly beyond a handful of threads, so this is how big inputs get to use all the cores.
+#
+# Usage: python3 -m paper_tools.align <fragments.fasta> <ref.fasta> <out_aligned.fasta> [path_to_mafft]
+
+import concurrent.futures
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from paper_tools.dedup import SequenceGroups, sequence_hash
+from paper_tools.fasta import read_fasta, FastaWriter
+
+DEFAULT_THREADS_PER_SHARD = 4
+MAFFT_OPTIONS = ['--auto', '--keeplength']  # Besides `--thread` and `--addfragments`
+MIN_SHARD_SIZE = 20  # Below this many fragments per shard, the cost of starting up mafft isn't worth it
+
+
+def mafft_signature(path_to_mafft):
+    """Short hash of the mafft version (as reported by `mafft --version`) and of `MAFFT_OPTIONS`."""
+    result = subprocess.run([Path(path_to_mafft).as_posix(), '--version'], capture_output=True, text=True)
+    version = (result.stdout + result.stderr).strip()  # mafft reports its version on stderr
+    return sequence_hash('\n'.join([version, *MAFFT_OPTIONS]))[:16]
+
+
+class AlignmentCache:
+    """
+    Aligned sequences keyed by the hash of their unaligned form, for alignments against the reference in
+    `ref_fasta_path` by the mafft at `path_to_mafft`.  If `cache_dir` is None, the cache only lives in memory.
+    """
+    def __init__(self, ref_fasta_path, cache_dir=None, path_to_mafft='mafft'):
+        self.ref_id, ref_seq = next(read_fasta(ref_fasta_path))
+        self.ref_fasta_path = Path(ref_fasta_path)
+        self.ref_seq = ref_seq
+        self.ref_hash = sequence_hash(ref_seq)
+        self.ref_len = len(ref_seq)
+        self.aligned = {}  # Key: sequence hash, Value: aligned sequence (the reference itself is under `ref_hash`)
+
+        self.path = None
+        if cache_dir is not None:
+            Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            self.path = Path(cache_dir) / f'{self.ref_hash}.{mafft_signature(path_to_mafft)}.fasta'
+            if self.path.exists():
+                self._load()
+
+    def _load(self):
+        """Reads the cache file, cutting it off after the last complete record (e.g., if a run was interrupted)."""
+        # `FastaWriter` puts each sequence on a single line, so a complete record is exactly two full lines
+        good_size = 0
+        with open(self.path, 'rb') as f:
+            lines = iter(f)
+            for header in lines:
+                seq = next(lines, b'')
+                if not (header.startswith(b'>') and seq.endswith(b'\n') and len(seq) == self.ref_len + 1
+                        and not seq.startswith(b'>')):
+                    break
+                self.aligned[header[1:].decode('ascii').strip()] = seq[:-1].decode('ascii')
+                good_size += len(header) + len(seq)
+        if good_size < self.path.stat().st_size:
+            with open(self.path, 'r+b') as f:
+                f.truncate(good_size)
+
+    def __contains__(self, seq_hash):
+        return seq_hash in self.aligned
+
+    def __len__(self):
+        return len(self.aligned)
+
+    def add(self, new_aligned):
+        """Adds the (seq_hash, aligned_seq) pairs in the dict `new_aligned` to the cache (and its file)."""
+        for seq_hash, aligned_seq in new_aligned.items():
+            if len(aligned_seq) != self.ref_len:
+                raise ValueError(f'Aligned sequence {seq_hash} has length {len(aligned_seq)}, '
+                                 f'expected {self.ref_len} (the length of {self.ref_id})')
+        self.aligned.update(new_aligned)
+        if self.path is not None:
+            with FastaWriter(self.path, mode='ab') as w:
+                w.write_all(new_aligned.items())
+
+
+def run_mafft_add_fragments(path_to_mafft, fragments_fasta_path, ref_fasta_path, out_path, threads=-1):
+    """Runs `mafft --addfragments <fragments> --keeplength <ref>`, writing the alignment to `out_path`."""
+    with open(out_path, 'w') as f:
+        subprocess.run([
+            Path(path_to_mafft).as_posix(),
+            "--thread", str(threads),
+            *MAFFT_OPTIONS,
+            "--addfragments", Path(fragments_fasta_path).as_posix(),
+            Path(ref_fasta_path).as_posix(),
+        ], stdout=f, check=True)
+
+
+def _align_shard(path_to_mafft, shard_fasta_path, ref_fasta_path, out_path, threads):
+    start = time.monotonic()
+    run_mafft_add_fragments(path_to_mafft, shard_fasta_path, ref_fasta_path, out_path, threads)
+    return time.monotonic() - start
+
+
+def run_mafft_sharded(path_to_mafft, fragments_fasta_path, ref_fasta_path, out_path,
+                      threads_per_shard=DEFAULT_THREADS_PER_SHARD, max_workers=None, verbose=True):
+    """
+    Same output as `run_mafft_add_fragments` (reference first, then the fragments in input order), but the fragments
+    are split into shards that are aligned by up to `max_workers` concurrent mafft processes with
+    `threads_per_shard` threads each (default: enough workers to use every core).  Returns a list with one
+    `(num_fragments, seconds)` pair per shard.
+    """
+    if max_workers is None:
+        max_workers = max(1, (os.cpu_count() or 1) // threads_per_shard)
+    fragments = list(read_fasta(fragments_fasta_path))
+    if not fragments:
+        # Nothing for mafft to add: with `--keeplength`, it would only write out the reference, in lower case
+        ref_id, ref_seq = next(read_fasta(ref_fasta_path))
+        tmp_out_path = Path(f'{out_path}.tmp')
+        with FastaWriter(tmp_out_path) as w:
+            w.write(ref_id, ref_seq.lower())
+        os.replace(tmp_out_path, out_path)
+        return []
+    num_shards = max(1, min(2 * max_workers, len(fragments) // MIN_SHARD_SIZE))
+    # Balanced bounds, so that no shard is empty (and all have at least `MIN_SHARD_SIZE` fragments, if num_shards > 1)
+    bounds = [i * len(fragments) // num_shards for i in range(num_shards + 1)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        shard_paths = []
+        for i in range(num_shards):
+            shard_fasta_path = Path(tmp_dir) / f'shard_{i}.fasta'
+            with FastaWriter(shard_fasta_path) as w:
+                w.write_all(fragments[bounds[i]:bounds[i+1]])
+            shard_paths.append((shard_fasta_path, Path(tmp_dir) / f'shard_{i}.aligned.fasta'))
+
+        threads = threads_per_shard if num_shards > 1 else threads_per_shard * max_workers
+        # The heavy lifting happens in the mafft processes, so the workers themselves only need to be threads
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(_align_shard, path_to_mafft, shard_fasta_path, ref_fasta_path, shard_out_path,
+                                   threads)
+                       for shard_fasta_path, shard_out_path in shard_paths]
+            timings = []
+            for i, future in enumerate(futures):
+                seconds = future.result()
+                num_fragments = bounds[i+1] - bounds[i]
+                timings.append((num_fragments, seconds))
+                if verbose:
+                    print(f'Shard {i+1}/{num_shards}: aligned {num_fragments} sequences in {seconds:.1f} s '
+                          f'({threads} threads)')
+
+        # Concatenate the shard outputs, keeping only the first copy of the reference
+        tmp_out_path = Path(f'{out_path}.tmp')
+        with FastaWriter(tmp_out_path) as w:
+            for i, (_, shard_out_path) in enumerate(shard_paths):
+                records = read_fasta(shard_out_path)
+                ref_record = next(records)
+                if i == 0:
+                    w.write(*ref_record)
+                w.write_all(records)
+        os.replace(tmp_out_path, out_path)
+
+    return timings
+
+
+def align_missing(cache, seq_by_hash, path_to_mafft, threads_per_shard=DEFAULT_THREADS_PER_SHARD):
+    """
+    Aligns those sequences in `seq_by_hash` (a dict from sequence hash to unaligned sequence) that aren't in `cache`
+    yet, with a single (sharded) mafft pass, and adds them to the cache.  Returns the number of sequences aligned.
+    """
+    missing = {seq_hash: seq for seq_hash, seq in seq_by_hash.items() if seq_hash not in cache}
+    if not missing:
+        if cache.ref_hash not in cache:
+            # With `--keeplength`, mafft writes out the reference unchanged, only in lower case (like all its output),
+            # so there's no need to start mafft on an empty set of fragments just for that
+            cache.add({cache.ref_hash: cache.ref_seq.lower()})
+        return 0
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fragments_path = Path(tmp_dir) / 'fragments.fasta'
+        aligned_path = Path(tmp_dir) / 'aligned.fasta'
+        with FastaWriter(fragments_path) as w:
+            w.write_all(missing.items())
+        run_mafft_sharded(path_to_mafft, fragments_path, cache.ref_fasta_path, aligned_path, threads_per_shard)
+
+        aligned = read_fasta(aligned_path)
+        _, aligned_ref = next(aligned)  # mafft outputs the reference first
+        new_aligned = {cache.ref_hash: aligned_ref}
+        new_aligned.update(aligned)
+
+    not_aligned = missing.keys() - new_aligned.keys()
+    if not_aligned:
+        raise RuntimeError(f'mafft output is missing {len(not_aligned)} of {len(missing)} sequences')
+    cache.add(new_aligned)
+    return len(missing)
+
+
+def align_to_reference(records, cache, out_path, path_to_mafft, threads_per_shard=DEFAULT_THREADS_PER_SHARD,
+                       identical_groups_path=None, distinct_only=False):
+    """
+    Writes the alignment of `records` ((fasta_id, unaligned_seq) pairs) against the cache's reference to
+    `out_path`, in the same format as `mafft --addfragments --keeplength` (reference first, then the records in
+    order).  Only distinct sequences not already in `cache` are actually aligned; if given, a report of groups of
+    identical sequences is written to `identical_groups_path` (see `dedup.py`).  With `distinct_only`, only the
+    first record with each distinct sequence is written out (see `SequenceGroups.expand_representatives`).
+    Returns the `SequenceGroups` of `records` and the number of sequences aligned.
+    """
+    groups = SequenceGroups(records)
+    num_aligned = align_missing(cache, groups.seq_by_hash, path_to_mafft, threads_per_shard)
+    if identical_groups_path is not None:
+        groups.write_report(identical_groups_path)
+
+    tmp_out_path = Path(f'{out_path}.tmp')
+    with FastaWriter(tmp_out_path) as w:
+        w.write(cache.ref_id, cache.aligned[cache.ref_hash])
+        if distinct_only:
+            w.write_all((ids[0], cache.aligned[seq_hash]) for seq_hash, ids in groups.ids_by_hash.items())
+        else:
+            w.write_all(groups.expand(cache.aligned))
+    os.replace(tmp_out_path, out_path)
+    return groups, num_aligned
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (4, 5):
+        sys.stderr.write("Usage: python3 -m paper_tools.align "
+                         "<fragments.fasta> <ref.fasta> <out_aligned.fasta> [path_to_mafft]\n")
+        sys.exit(1)
+    fragments_fasta_path, ref_fasta_path, out_path = sys.argv[1:4]
+    path_to_mafft = sys.argv[4] if len(sys.argv) == 5 else 'mafft'
+    timings = run_mafft_sharded(path_to_mafft, fragments_fasta_path, ref_fasta_path, out_path)
+    print(f'Aligned {sum(n for n, _ in timings)} sequences in {len(timings)} shards into {out_path}')
@@ -0,0 +1,138 @@
+# Missing-data and composition statistics for aligned FASTA files
+# ===============================================================
+#
+# Works on the packed (memory-mapped) form of each alignment (see `alignment_store.py`), one block of rows at a
+# time, so that per-sequence missingness, per-site missingness and base composition all come out of a single
+# vectorized pass over the data.  Several alignments are processed in parallel.
+#
+# Usage: python3 -m paper_tools.alignment_stats <aligned.fasta> [<aligned.fasta> ...]
+
+import argparse
+import concurrent.futures
+import os
+
+import numpy as np
+
+from paper_tools.alignment_store import open_packed
+
+# Missing data = gaps and Ns (either case)
+MISSING_LUT = np.zeros(256, dtype=bool)
+MISSING_LUT[np.frombuffer(b'-nN', dtype=np.uint8)] = True
+
+COMPOSITION_STATES = ['A', 'C', 'G', 'T', 'N', '-']  # Anything else is lumped as "other" (ambiguity codes, etc.)
+
+
+def compute_stats(fasta_path, exclude_from_dates=(), block_rows=1024):
+    """
+    Returns a dict with missing-data & composition statistics for the aligned FASTA file at `fasta_path`.
+
+    Sequences whose id starts with any prefix in `exclude_from_dates` (e.g., an undated reference sequence)
+    are left out of the date range, but not out of anything else.
+    """
+    packed = open_packed(fasta_path)
+    num_seqs, num_sites = packed.seqs.shape
+
+    missing_per_seq = np.empty(num_seqs, dtype=np.int64)
+    missing_per_site = np.zeros(num_sites, dtype=np.int64)
+    byte_counts = np.zeros(256, dtype=np.int64)
+    for start, block in packed.iter_blocks(block_rows):
+        is_missing = MISSING_LUT[block]
+        missing_per_seq[start:start+len(block)] = is_missing.sum(axis=1)
+        missing_per_site += is_missing.sum(axis=0)
+        byte_counts += np.bincount(block.ravel(), minlength=256)
+
+    composition = {}
+    for state in COMPOSITION_STATES:
+        composition[state] = int(byte_counts[ord(state)])
+        if state.lower() != state:
+            composition[state] += int(byte_counts[ord(state.lower())])
+    composition['other'] = int(byte_counts.sum()) - sum(composition.values())
+
+    dates = [date
+             for fasta_id, date in zip(packed.ids, packed.dates)
+             if date and not any(fasta_id.startswith(prefix) for prefix in exclude_from_dates)]
+
+    return {
+        'fasta_path': str(fasta_path),
+        'ids': packed.ids,
+        'num_seqs': num_seqs,
+        'num_sites': num_sites,
+        'min_date': min(dates) if dates else None,
+        'max_date': max(dates) if dates else None,
+        'missing_per_seq': missing_per_seq,
+        'missing_per_site': missing_per_site,
+        'composition': composition,
+    }
+
+
+def print_stats(stats):
+    L = stats['num_sites']
+    N = stats['num_seqs']
+    print(f'Number of sequences: {N}')
+    print(f'Sequence length: {L}')
+    print(f'Date range: {stats["min_date"]} to {stats["max_date"]}')
+
+    # Missing data per sequence
+    num_missings = stats['missing_per_seq']
+    print(f'Missing data: between {num_missings.min()} bases = {100*num_missings.min()/L:.3} % '
+          + f'and {num_missings.max()} bases = {100*num_missings.max()/L:.3} % per sequence')
+
+    avg_missing = num_missings.mean()
+    print(f'Avg missing: {avg_missing} bases = {100*avg_missing / L:.3} %')
+
+    # Missing data per site
+    site_missings = stats['missing_per_site']
+    print(f'Missing data per site: between {site_missings.min()} sequences = {100*site_missings.min()/N:.1f} % '
+          + f'and {site_missings.max()} sequences = {100*site_missings.max()/N:.1f} %; '
+          + f'{(site_missings == N).sum()} sites missing in every sequence, '
+          + f'{(site_missings == 0).sum()} sites present in every sequence')
+
+    # Base composition
+    total = sum(stats['composition'].values())
+    print('Composition: ' + ', '.join(f'{state} = {100*count/total:.2f} %'
+                                      for state, count in stats['composition'].items()))
+
+
+def write_per_seq_tsv(stats, out_path):
+    with open(out_path, 'w', encoding='utf-8') as f:
+        f.write('id\tnum_missing\tfrac_missing\n')
+        for fasta_id, num_missing in zip(stats['ids'], stats['missing_per_seq']):
+            f.write(f'{fasta_id}\t{num_missing}\t{num_missing / stats["num_sites"]}\n')
+
+
+def write_per_site_tsv(stats, out_path):
+    with open(out_path, 'w', encoding='utf-8') as f:
+        f.write('site\tnum_missing\tfrac_missing\n')
+        for site, num_missing in enumerate(stats['missing_per_site']):
+            f.write(f'{site+1}\t{num_missing}\t{num_missing / stats["num_seqs"]}\n')
+
+
+def compute_stats_in_parallel(fasta_paths, exclude_from_dates=(), max_workers=None):
+    """Runs `compute_stats` on several alignments at once; results are returned in the order of `fasta_paths`."""
+    if max_workers is None:
+        max_workers = min(len(fasta_paths), os.cpu_count() or 1)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        futures = [pool.submit(compute_stats, p, exclude_from_dates) for p in fasta_paths]
+        return [f.result() for f in futures]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Missing-data and composition statistics for aligned FASTA files')
+    parser.add_argument('fasta_paths', nargs='+', help='Aligned FASTA files')
+    parser.add_argument('--exclude-from-dates', action='append', default=[],
+                        help='Leave sequences whose id starts with this prefix out of the date range (repeatable)')
+    parser.add_argument('--per-seq-tsv', action='store_true',
+                        help='Also write per-sequence missingness to <fasta>.missing_per_seq.tsv')
+    parser.add_argument('--per-site-tsv', action='store_true',
+                        help='Also write per-site missingness to <fasta>.missing_per_site.tsv')
+    parser.add_argument('--jobs', type=int, help='Number of alignments to process at once (default: all)')
+    args = parser.parse_args()
+
+    all_stats = compute_stats_in_parallel(args.fasta_paths, args.exclude_from_dates, args.jobs)
+    for stats in all_stats:
+        print(f'\n{stats["fasta_path"]}')
+        print_stats(stats)
+        if args.per_seq_tsv:
+            write_per_seq_tsv(stats, f'{stats["fasta_path"]}.missing_per_seq.tsv')
+        if args.per_site_tsv:
+            write_per_site_tsv(stats, f'{stats["fasta_path"]}.missing_per_site.tsv')
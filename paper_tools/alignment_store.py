@@ -0,0 +1,166 @@
+# Memory-mapped packed alignments
+# ===============================
+#
+# An aligned FASTA file (all sequences of the same length) is converted once into
+#
+# * `<prefix>.npy`: an N x L `uint8` matrix holding the raw sequence bytes, one row per sequence
+#   (standard NumPy `.npy` format, so it can be memory-mapped with `np.load(..., mmap_mode='r')`)
+# * `<prefix>.tsv`: a sidecar index with one line per row: row number, FASTA id and date
+#   (the date is the last `|`-separated field of the FASTA id, as in `extract_fasta_dates.py`)
+#
+# Readers then get rows and columns of the alignment as zero-copy NumPy views, without ever building
+# Python strings for the whole alignment.
+#
+# Usage: python3 -m paper_tools.alignment_store <aligned.fasta> [<out_prefix>]
+
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from paper_tools.fasta import read_fasta, FastaWriter
+
+
+def packed_paths(prefix):
+    prefix = Path(prefix)
+    return prefix.with_name(prefix.name + '.npy'), prefix.with_name(prefix.name + '.tsv')
+
+
+def default_prefix(fasta_path):
+    fasta_path = Path(fasta_path)
+    return fasta_path.with_name(fasta_path.name + '.packed')
+
+
+def date_of_fasta_id(fasta_id):
+    fields = fasta_id.split('|')
+    return fields[-1] if len(fields) >= 2 else ''
+
+
+def pack_fasta(fasta_path, prefix=None):
+    """
+    Converts the aligned FASTA file at `fasta_path` into a packed alignment at `prefix`
+    (default: `<fasta_path>.packed`) and returns it opened as a `PackedAlignment`.
+
+    The FASTA file is streamed twice (once to size the matrix, once to fill it in), so memory use stays
+    constant regardless of the size of the alignment.
+    """
+    if prefix is None:
+        prefix = default_prefix(fasta_path)
+    npy_path, index_path = packed_paths(prefix)
+
+    num_seqs = 0
+    num_sites = None
+    for fasta_id, seq in read_fasta(fasta_path):
+        if num_sites is None:
+            num_sites = len(seq)
+        elif len(seq) != num_sites:
+            raise ValueError(f'{fasta_path} is not aligned: {fasta_id} has {len(seq)} sites, expected {num_sites}')
+        num_seqs += 1
+    if num_sites is None:
+        raise ValueError(f'{fasta_path} has no sequences')
+
+    # Write to temporary files and rename at the end, so a half-written store is never picked up
+    tmp_npy_path = npy_path.with_name(npy_path.name + '.tmp')
+    tmp_index_path = index_path.with_name(index_path.name + '.tmp')
+    seqs = np.lib.format.open_memmap(tmp_npy_path, mode='w+', dtype=np.uint8, shape=(num_seqs, num_sites))
+    with open(tmp_index_path, 'w', encoding='utf-8') as f:
+        f.write('row\tid\tdate\n')
+        for row, (fasta_id, seq) in enumerate(read_fasta(fasta_path)):
+            seqs[row, :] = np.frombuffer(seq.encode('ascii'), dtype=np.uint8)
+            f.write(f'{row}\t{fasta_id}\t{date_of_fasta_id(fasta_id)}\n')
+    seqs.flush()
+    del seqs
+
+    os.replace(tmp_npy_path, npy_path)
+    os.replace(tmp_index_path, index_path)
+    return PackedAlignment(prefix)
+
+
+def is_packed_current(fasta_path, prefix=None):
+    """Whether the packed form of `fasta_path` at `prefix` exists and is no older than the FASTA file."""
+    if prefix is None:
+        prefix = default_prefix(fasta_path)
+    npy_path, index_path = packed_paths(prefix)
+    fasta_mtime = Path(fasta_path).stat().st_mtime
+    return (npy_path.exists() and index_path.exists() and
+            npy_path.stat().st_mtime >= fasta_mtime and index_path.stat().st_mtime >= fasta_mtime)
+
+
+def open_packed(fasta_path, prefix=None):
+    """
+    Returns a `PackedAlignment` for `fasta_path`, (re)packing it first if the packed form is missing or
+    older than the FASTA file.
+    """
+    if prefix is None:
+        prefix = default_prefix(fasta_path)
+    if not is_packed_current(fasta_path, prefix):
+        return pack_fasta(fasta_path, prefix)
+    return PackedAlignment(prefix)
+
+
+class PackedAlignment:
+    """
+    Read-only view of a packed alignment.
+
+    `seqs` is the N x L `np.memmap` of sequence bytes; `ids` and `dates` are lists of N strings.
+    Rows can be addressed by number or by FASTA id.
+    """
+    def __init__(self, prefix, mode='r'):
+        npy_path, index_path = packed_paths(prefix)
+        self.prefix = Path(prefix)
+        self.seqs = np.load(npy_path, mmap_mode=mode)
+        self.ids = []
+        self.dates = []
+        with open(index_path, 'r', encoding='utf-8') as f:
+            next(f)  # Header
+            for line in f:
+                row, fasta_id, date = line.rstrip('\n').split('\t')
+                if int(row) != len(self.ids):
+                    raise ValueError(f'{index_path} is corrupt: expected row {len(self.ids)}, found {row}')
+                self.ids.append(fasta_id)
+                self.dates.append(date)
+        if len(self.ids) != self.seqs.shape[0]:
+            raise ValueError(f'{index_path} lists {len(self.ids)} sequences, but {npy_path} has {self.seqs.shape[0]}')
+        self._id_2_row = {fasta_id: row for row, fasta_id in enumerate(self.ids)}
+
+    def __len__(self):
+        return self.seqs.shape[0]
+
+    @property
+    def num_sites(self):
+        return self.seqs.shape[1]
+
+    def row_of(self, fasta_id):
+        return self._id_2_row[fasta_id]
+
+    def __getitem__(self, key):
+        """Rows by number, FASTA id, slice or array of row numbers (only the latter copies data)."""
+        if isinstance(key, str):
+            key = self._id_2_row[key]
+        return self.seqs[key]
+
+    def seq_str(self, key):
+        return self[key].tobytes().decode('ascii')
+
+    def iter_blocks(self, block_rows=1024):
+        """Yields (first_row, block) pairs, with `block` a view of up to `block_rows` consecutive rows."""
+        for start in range(0, len(self), block_rows):
+            yield start, self.seqs[start:start+block_rows]
+
+    def write_fasta(self, out_path, rows=None):
+        """Writes the given rows (default: all) out as a FASTA file."""
+        if rows is None:
+            rows = range(len(self))
+        with FastaWriter(out_path) as w:
+            for row in rows:
+                w.write(self.ids[row], self.seqs[row])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        sys.stderr.write("Usage: python3 -m paper_tools.alignment_store <aligned.fasta> [<out_prefix>]\n")
+        sys.exit(1)
+    packed = pack_fasta(sys.argv[1], sys.argv[2] if len(sys.argv) == 3 else None)
+    npy_path, index_path = packed_paths(packed.prefix)
+    print(f'Packed {len(packed)} sequences x {packed.num_sites} sites into {npy_path} (index in {index_path})')
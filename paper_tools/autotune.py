@@ -0,0 +1,284 @@
+# Choosing the number of threads of a Delphy run by calibration
+# =============================================================
+#
+# The drivers pick `--v0-threads` with rules of thumb (e.g., one thread per 100 sequences, at most 32).  Instead,
+# `tune_threads` can measure how Delphy actually scales on a run's input: it runs short calibration bursts at 1, 2,
+# 4, ... threads, and measures their steps/s from the times at which their log lines appear (so that start-up time
+# doesn't count; see `run_monitor.py`).  The burst with the most threads runs `BURST_FRACTION` of the run's steps,
+# and the others proportionally fewer, so that each takes about as long (a burst at 1 thread is no slower than one
+# at N threads, unless Delphy scales better than linearly); a burst is also stopped after `BURST_MAX_SECONDS`.
+# Calibration stops early once doubling the threads gains less than `THROUGHPUT_TOLERANCE`, so all in all it costs
+# a few % of the run.  It then fits Gunther's Universal Scalability Law to the measurements,
+#
+#   steps/s (N threads) = lambda * N / (1 + sigma * (N-1) + kappa * N * (N-1)),
+#
+# where `sigma` measures contention (serial work) and `kappa` coherency costs (threads getting in each other's way,
+# which makes throughput drop past some N), and picks the smallest N (no more than were measured) whose predicted
+# throughput is within `THROUGHPUT_TOLERANCE` of the peak (leaving spare cores to other runs for the last few %).
+# If fewer than two bursts could be measured (e.g., on a small input that Delphy gets through before its log can be
+# timed), the run keeps the number of threads from the driver's rule of thumb.
+#
+# Threads are only tried up to one per `MIN_SEQS_PER_THREAD` sequences, below which Delphy's partitions get too
+# small.  The fitted curves are kept in a JSON file (e.g., `thread_curves.json` in the dataset folder), and reused
+# without re-calibrating for runs on a machine with as many cores whose number of sequences is within a factor
+# `SIMILAR_SIZE_RATIO` of a calibrated one.  The number of threads is left out of a run's inputs hash in its batch
+# journal (see `delphy_runs.set_inputs_hash`), and the drivers don't retune runs that are done already, so curves
+# added later never make a finished run be redone.
+#
+# Usage: python3 -m paper_tools.autotune <thread_curves.json>
+
+import datetime
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from paper_tools.run_monitor import RunMonitor
+
+BURST_FRACTION = 1 / 200  # Of the run's steps, for the burst with the most threads
+BURST_MAX_SECONDS = 120
+BURST_LOG_LINES = 50
+MIN_MEASURED_SECONDS = 1.0  # Between the first and last log lines timed in a burst
+BURST_LENGTHENING = 4  # Factor by which the steps of a burst too short to measure are increased for another try
+MIN_SEQS_PER_THREAD = 20  # As in `sims/run.py`: ~40 nodes per partition
+THROUGHPUT_TOLERANCE = 0.05
+SIMILAR_SIZE_RATIO = 1.25
+
+CURVES_FORMAT_VERSION = 1
+
+
+# Fitting
+# -------
+
+def fit_usl(thread_counts, steps_per_second):
+    """
+    (lambda, sigma, kappa) of the Universal Scalability Law fitted to measured steps/s at the given thread counts,
+    by linear least squares on N / X(N) = (1 + sigma*(N-1) + kappa*N*(N-1)) / lambda, with sigma, kappa >= 0.
+    """
+    n = np.asarray(thread_counts, dtype=float)
+    y = n / np.asarray(steps_per_second, dtype=float)
+    all_terms = [np.ones_like(n), n - 1, n * (n - 1)]
+    # Try the full model first, then without coherency costs, then without contention, then plain linear scaling
+    for used in [(0, 1, 2), (0, 1), (0, 2), (0,)]:
+        if len(used) > len(set(thread_counts)):
+            continue
+        coeffs, *_ = np.linalg.lstsq(np.column_stack([all_terms[i] for i in used]), y, rcond=None)
+        if np.all(coeffs > 0) or used == (0,):
+            full = dict(zip(used, coeffs.tolist()))
+            a = full[0]
+            return 1 / a, full.get(1, 0.0) / a, full.get(2, 0.0) / a
+    raise AssertionError('Unreachable')
+
+
+def usl_throughput(num_threads, lam, sigma, kappa):
+    n = num_threads
+    return lam * n / (1 + sigma * (n - 1) + kappa * n * (n - 1))
+
+
+def best_thread_count(lam, sigma, kappa, max_threads, tolerance=THROUGHPUT_TOLERANCE):
+    """Smallest number of threads (up to `max_threads`) within `tolerance` of the best predicted throughput."""
+    predicted = [usl_throughput(n, lam, sigma, kappa) for n in range(1, max_threads + 1)]
+    target = (1 - tolerance) * max(predicted)
+    return next(n for n, x in enumerate(predicted, start=1) if x >= target)
+
+
+# Calibration
+# -----------
+
+def _with_flag(delphy_cli, flag, value):
+    cli = list(delphy_cli)
+    if flag in cli:
+        cli[cli.index(flag) + 1] = str(value)
+    else:
+        cli.extend([flag, str(value)])
+    return cli
+
+
+def _burst_cli(run, num_threads, burst_steps, scratch_path):
+    """`run`'s command line for a short burst with `num_threads` threads, writing into `scratch_path`."""
+    prepared_paths = set(Path(path).as_posix() for path in run.prepared_paths)
+    cli = [run.delphy_cli[0]]
+    args = iter(run.delphy_cli[1:])
+    for arg in args:
+        if arg.startswith('--v0-'):
+            value = next(args, None)
+            if value is not None and Path(value).as_posix() in prepared_paths:
+                continue  # Not written yet (e.g., the initial tree of a warm start)
+            if arg.startswith('--v0-out-') and value is not None:
+                value = (scratch_path / Path(value).name).as_posix()
+            cli.append(arg)
+            if value is not None:
+                cli.append(value)
+        else:
+            cli.append(arg)
+    cli = _with_flag(cli, '--v0-threads', num_threads)
+    cli = _with_flag(cli, '--v0-steps', burst_steps)
+    for flag in ['--v0-tree-every', '--v0-delphy-snapshot-every']:
+        if flag in cli:
+            cli = _with_flag(cli, flag, burst_steps)
+    return _with_flag(cli, '--v0-log-every', max(1, burst_steps // BURST_LOG_LINES))
+
+
+_TOO_SHORT = 'too short to measure'
+
+
+def _burst_steps_per_second(run, num_threads, burst_steps, scratch_path):
+    """(Steps/s of a calibration burst, or None if it failed or was too short to measure; what happened)."""
+    cli = _burst_cli(run, num_threads, burst_steps, scratch_path)
+    log_paths = [Path(v) for f, v in zip(cli, cli[1:]) if f == '--v0-out-log-file']
+    if not log_paths:
+        return None, 'no log file to time'
+    monitor = RunMonitor(f'{run.key} @ {num_threads} threads', log_paths[0], burst_steps,
+                         scratch_path / 'status.json', poll_interval=0.1, snapshot_interval=float('inf'),
+                         rate_window=float('inf'))
+    monitor.start()
+    proc = subprocess.Popen(cli, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        returncode = proc.wait(timeout=BURST_MAX_SECONDS)
+    except subprocess.TimeoutExpired:
+        proc.terminate()  # Long enough: measure it from the log lines so far
+        proc.wait()
+        returncode = 0
+    monitor.stop(returncode, final_snapshot=False)
+    if returncode != 0:
+        return None, f'FAILED (exit code {returncode})'
+    progress = list(monitor.progress)[1:]  # Skip the artificial (start time, 0) point, to leave out start-up time
+    if len(progress) < 2 or progress[-1][0] - progress[0][0] < MIN_MEASURED_SECONDS:
+        return None, _TOO_SHORT
+    (t0, steps0), (t1, steps1) = progress[0], progress[-1]
+    steps_per_second = (steps1 - steps0) / (t1 - t0)
+    return steps_per_second, f'{steps_per_second:.4g} steps / s'
+
+
+def calibrate(run, thread_counts, max_burst_steps):
+    """
+    List of (number of threads, steps/s) of calibration bursts of `run` at the (increasing) `thread_counts`, with
+    `max_burst_steps` at the most threads and proportionally fewer at fewer threads (see above).  Bursts too short
+    to measure are lengthened (up to `max_burst_steps`), as are all later ones.  Stops at the first burst that fails
+    or still can't be measured, or that gains less than `THROUGHPUT_TOLERANCE` over the best so far.
+    """
+    scratch_path = run.outputs_path / 'autotune'
+    measurements = []
+    lengthening = 1
+    try:
+        for num_threads in thread_counts:
+            while True:
+                shutil.rmtree(scratch_path, ignore_errors=True)
+                scratch_path.mkdir(parents=True)
+                burst_steps = min(max_burst_steps, max(BURST_LOG_LINES, round(
+                    lengthening * max_burst_steps * num_threads / thread_counts[-1])))
+                steps_per_second, outcome = _burst_steps_per_second(run, num_threads, burst_steps, scratch_path)
+                print(f'  Calibration of {run.key}: {num_threads} threads, {burst_steps} steps -> {outcome}')
+                if outcome != _TOO_SHORT or burst_steps >= max_burst_steps:
+                    break
+                lengthening *= BURST_LENGTHENING
+            if steps_per_second is None:
+                break
+            best_so_far = max((x for _, x in measurements), default=None)
+            measurements.append((num_threads, steps_per_second))
+            if best_so_far is not None and steps_per_second < (1 + THROUGHPUT_TOLERANCE) * best_so_far:
+                break  # More threads don't help any more
+    finally:
+        shutil.rmtree(scratch_path, ignore_errors=True)
+    return measurements
+
+
+# Stored curves
+# -------------
+
+def load_curves(curves_path):
+    curves_path = Path(curves_path)
+    if not curves_path.exists():
+        return []
+    with open(curves_path, 'r', encoding='utf-8') as f:
+        contents = json.load(f)
+    return contents['curves'] if contents.get('format_version') == CURVES_FORMAT_VERSION else []
+
+
+def save_curves(curves_path, curves):
+    curves_path = Path(curves_path)
+    tmp_path = curves_path.with_name(curves_path.name + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'format_version': CURVES_FORMAT_VERSION, 'curves': curves}, f, indent=1)
+        f.write('\n')
+    os.replace(tmp_path, curves_path)
+
+
+def find_similar_curve(curves, num_seqs, cpu_count):
+    """The stored curve for the most similar number of sequences on a machine like this one, or None."""
+    candidates = [c for c in curves
+                  if c['cpu_count'] == cpu_count
+                  and abs(math.log(num_seqs / c['num_seqs'])) <= math.log(SIMILAR_SIZE_RATIO)]
+    return min(candidates, key=lambda c: abs(math.log(num_seqs / c['num_seqs'])), default=None)
+
+
+def candidate_thread_counts(num_seqs, max_threads):
+    limit = max(1, min(max_threads, num_seqs // MIN_SEQS_PER_THREAD))
+    counts = [1 << k for k in range(limit.bit_length()) if (1 << k) <= limit]
+    return counts if counts[-1] == limit else counts + [limit]
+
+
+def curve_best_thread_count(curve, max_threads):
+    """Best number of threads by a stored curve, up to `max_threads` and no more than were measured."""
+    max_measured = max(n for n, _ in curve['measurements'])
+    return best_thread_count(curve['lambda'], curve['sigma'], curve['kappa'], min(max_threads, max_measured))
+
+
+def tune_threads(run, curves_path, max_threads):
+    """
+    Sets the number of threads of `run` (up to `max_threads`, and the machine's core count) from a stored curve for
+    a similar run, or else from a new calibration (which is then stored in `curves_path`).  If the calibration
+    can't be measured, `run` keeps its number of threads.  Returns it.
+    """
+    cpu_count = os.cpu_count()
+    max_threads = max(1, min(max_threads, cpu_count, run.num_seqs // MIN_SEQS_PER_THREAD))
+    curves = load_curves(curves_path)
+    curve = find_similar_curve(curves, run.num_seqs, cpu_count)
+    if curve is None and max_threads > 1:
+        measurements = calibrate(run, candidate_thread_counts(run.num_seqs, max_threads),
+                                 max(1, round(run.num_steps * BURST_FRACTION)))
+        if len(measurements) < 2:
+            print(f'  Could not calibrate {run.key}, keeping {run.num_threads} threads')
+            return run.num_threads
+        lam, sigma, kappa = fit_usl([n for n, _ in measurements], [x for _, x in measurements])
+        curve = {
+            'num_seqs': run.num_seqs,
+            'key': run.key,
+            'cpu_count': cpu_count,
+            'calibrated_at': datetime.datetime.now().isoformat(),
+            'measurements': [list(m) for m in measurements],
+            'lambda': lam,
+            'sigma': sigma,
+            'kappa': kappa,
+        }
+        curves = load_curves(curves_path) + [curve]  # Re-read, in case another driver added to it meanwhile
+        save_curves(curves_path, curves)
+
+    if curve is None:
+        num_threads = 1
+    else:
+        num_threads = curve_best_thread_count(curve, max_threads)
+        print(f'  Autotuned {run.key} to {num_threads} threads (curve for {curve["num_seqs"]} sequences: '
+              + f'predicted {usl_throughput(num_threads, curve["lambda"], curve["sigma"], curve["kappa"]):.4g} '
+              + 'steps / s)')
+    run.num_threads = num_threads
+    run.delphy_cli = _with_flag(run.delphy_cli, '--v0-threads', num_threads)
+    return num_threads
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.stderr.write("Usage: python3 -m paper_tools.autotune <thread_curves.json>\n")
+        sys.exit(1)
+    for curve in sorted(load_curves(sys.argv[1]), key=lambda c: (c['cpu_count'], c['num_seqs'])):
+        lam, sigma, kappa = curve['lambda'], curve['sigma'], curve['kappa']
+        best = curve_best_thread_count(curve, curve['cpu_count'])
+        print(f'{curve["num_seqs"]} sequences ({curve["key"]}, {curve["cpu_count"]} cores, {curve["calibrated_at"]}): '
+              + f'lambda={lam:.4g} steps/s, sigma={sigma:.3g}, kappa={kappa:.3g}; best {best} threads')
+        for n, x in curve['measurements']:
+            print(f'  {n:4} threads: {x:.4g} steps / s measured, {usl_throughput(n, lam, sigma, kappa):.4g} fitted')
@@ -0,0 +1,116 @@
+# Streaming extraction of taxa and alignments from BEAST XML files
+# ================================================================
+#
+# `ET.parse` builds the whole document tree in memory, and for XMLs with tens of thousands of taxa that tree
+# (one element per sequence, plus all its text) is many times bigger than the sequences themselves.  Here we
+# walk the file once with `iterparse`, pull out what the prep scripts need, and clear every top-level element as
+# soon as it's done with, so peak memory is dominated by the extracted sequences alone.
+#
+# Only top-level elements of the document are looked at:
+#
+# * `<taxa id="...">` blocks give `BeastTaxon`s, with the text of each `<attr name="...">` child (e.g., `State`
+#   or `Region` for discrete trait analyses);
+# * `<alignment id="...">` blocks give `BeastSequence`s, one per `<sequence>`, with all whitespace removed.
+#
+# References elsewhere in the document (`<taxa idref="..."/>`, `<alignment idref="..."/>`) are ignored.
+#
+# Usage: python3 -m paper_tools.beast_xml <beast.xml> <out.fasta> [alignment_id ...]
+
+import re
+import sys
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+
+from paper_tools.fasta import FastaWriter
+from paper_tools.partitions import merge_partitions
+
+BeastTaxon = namedtuple('BeastTaxon', ['taxa_id', 'taxon_id', 'attrs'])
+BeastSequence = namedtuple('BeastSequence', ['alignment_id', 'taxon_id', 'seq'])
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def iter_beast_xml(source):
+    """
+    Yields a `BeastTaxon` for every taxon defined in a top-level `<taxa>` block and a `BeastSequence` for every
+    sequence in a top-level `<alignment>` block of the BEAST XML file `source` (a path or binary file object),
+    in document order.
+    """
+    root = None
+    top = None  # Current top-level element
+    depth = 0
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                root = elem
+            elif depth == 2:
+                top = elem
+            continue
+
+        if depth == 3 and top.get('id') is not None:
+            if top.tag == 'taxa' and elem.tag == 'taxon' and elem.get('id') is not None:
+                attrs = {a.get('name'): (a.text or '').strip() for a in elem.findall('attr')}
+                yield BeastTaxon(top.get('id'), elem.get('id'), attrs)
+            elif top.tag == 'alignment' and elem.tag == 'sequence':
+                taxon = elem.find('taxon')
+                if taxon is None:
+                    raise ValueError(f'<sequence> without a <taxon> in alignment {top.get("id")}')
+                seq = _WHITESPACE_RE.sub('', ''.join(elem.itertext()))
+                yield BeastSequence(top.get('id'), taxon.get('idref'), seq)
+            top.remove(elem)
+        elif depth == 2:
+            root.remove(elem)
+
+        depth -= 1
+
+
+def read_beast_xml(source, taxa_id=None):
+    """
+    Reads the BEAST XML file `source` in one streaming pass.  Returns a pair `(taxa, alignments)`, where:
+
+    * `taxa` is the list of `BeastTaxon`s in the `<taxa>` block with id `taxa_id` (default: the first one);
+    * `alignments` is a dict from alignment id to list of `BeastSequence`s, in document order.
+    """
+    taxa = []
+    alignments = {}
+    for record in iter_beast_xml(source):
+        if isinstance(record, BeastTaxon):
+            if taxa_id is None:
+                taxa_id = record.taxa_id
+            if record.taxa_id == taxa_id:
+                taxa.append(record)
+        else:
+            alignments.setdefault(record.alignment_id, []).append(record)
+    return taxa, alignments
+
+
+def check_same_taxa_order(expected_ids, alignment):
+    """Raises a `ValueError` unless the sequences in `alignment` are for taxa `expected_ids`, in that order."""
+    for expected_id, s in zip(expected_ids, alignment):
+        if s.taxon_id != expected_id:
+            raise ValueError(f'Sequences in alignment {s.alignment_id} listed in a different order '
+                             f'(first discrepancy: {s.taxon_id} vs {expected_id})')
+    if len(expected_ids) != len(alignment):
+        raise ValueError(f'Alignment {alignment[0].alignment_id if alignment else "?"} has {len(alignment)} '
+                         f'sequences, expected {len(expected_ids)}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        sys.stderr.write("Usage: python3 -m paper_tools.beast_xml <beast.xml> <out.fasta> [alignment_id ...]\n")
+        sys.stderr.write("  Several alignments of the same taxa (e.g., partitions masked with N) are merged into one\n")
+        sys.exit(1)
+    in_path, out_path, *alignment_ids = sys.argv[1:]
+
+    _, alignments = read_beast_xml(in_path)
+    if not alignment_ids:
+        alignment_ids = list(alignments)
+    ids = [s.taxon_id for s in alignments[alignment_ids[0]]]
+    for alignment_id in alignment_ids:
+        check_same_taxa_order(ids, alignments[alignment_id])
+
+    seqs = merge_partitions([[s.seq for s in alignments[a]] for a in alignment_ids])
+    with FastaWriter(out_path) as w:
+        w.write_all(zip(ids, seqs))
+    print(f'Wrote {len(ids)} sequences from alignment(s) {", ".join(alignment_ids)} to {out_path}')
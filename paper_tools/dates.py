@@ -0,0 +1,231 @@
+# Vectorized date handling
+# ========================
+#
+# Dates are represented as integer day numbers (days since 1970-01-01, as in NumPy's `datetime64[D]`), so that
+# whole columns of dates can be parsed, compared and bucketed into CDC epi weeks with NumPy, without building a
+# `datetime` per row.  Strings that can't be parsed give `NO_DAY`, which is smaller than any real day number, so
+# range filters like `(days >= lo) & (days <= hi)` exclude them automatically.
+#
+# Imprecise dates are parsed into inclusive ranges of days `(min_day, max_day)`.  The formats recognized (from
+# GenBank and GISAID) are:
+#
+# * 1978         -> 1978-01-01 to 1978-12-31
+# * Nov-2017     -> 2017-11-01 to 2017-11-30
+# * 2018-08      -> 2018-08-01 to 2018-08-31
+# * 09-Nov-2017  -> 2017-11-09
+# * 2019-01-16   -> 2019-01-16
+#
+# `format_date_range` turns a range back into the shortest of these forms (ISO style), as used in the dates
+# of FASTA ids (e.g., `MN908947.3|2019-12`), or `YYYY-MM-DD/YYYY-MM-DD` if it's none of them.
+
+import datetime
+
+import numpy as np
+
+NO_DAY = np.iinfo(np.int32).min
+
+_EPOCH = datetime.date(1970, 1, 1)
+_MAX_LEN = len('DD-Mon-YYYY')
+_MONTH_NAMES = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+
+
+def day_number(d):
+    """Day number of a `datetime.date` or `datetime.datetime`."""
+    if isinstance(d, datetime.datetime):
+        d = d.date()
+    return (d - _EPOCH).days
+
+
+def date_of_day(day):
+    return _EPOCH + datetime.timedelta(days=int(day))
+
+
+def _char_columns(date_strs):
+    """
+    (`_MAX_LEN` x N matrix of character codes, zero-padded; lengths) of an array of N strings.  Each row holds one
+    character position of every string, so that the per-position tests below run over contiguous memory.
+    """
+    n = len(date_strs)
+    lengths = np.char.str_len(date_strs) if n > 0 else np.zeros(0, dtype=int)
+    chars = np.zeros((_MAX_LEN, n), dtype=np.int32)
+    fits = lengths <= _MAX_LEN
+    if np.any(fits):
+        chars[:, fits] = date_strs[fits].astype(f'U{_MAX_LEN}').view(np.uint32).reshape(-1, _MAX_LEN).T
+    return chars, lengths
+
+
+def _number_at(chars, start, num_digits):
+    """(Value, all-digits mask) of the decimal number at positions [start, start+num_digits) of `chars`."""
+    value = np.zeros(chars.shape[1], dtype=np.int64)
+    ok = np.ones(chars.shape[1], dtype=bool)
+    for i in range(start, start + num_digits):
+        digit = chars[i] - ord('0')
+        ok &= (digit >= 0) & (digit <= 9)
+        value = value*10 + digit
+    return value, ok
+
+
+def _month_at(chars, start):
+    """(Month number, ok mask) of the (case-insensitive) three-letter month name at position `start` of `chars`."""
+    letters = chars[start:start+3]
+    lower = np.where((letters >= ord('A')) & (letters <= ord('Z')), letters + (ord('a') - ord('A')), letters)
+    code = (lower[0] << 16) | (lower[1] << 8) | lower[2]
+    month = np.zeros(chars.shape[1], dtype=np.int64)
+    for mm, name in enumerate(_MONTH_NAMES, start=1):
+        month[code == ((ord(name[0]) << 16) | (ord(name[1]) << 8) | ord(name[2]))] = mm
+    return month, month > 0
+
+
+def _days_from_civil(year, month, day):
+    """Day numbers of arrays of (proleptic Gregorian) years, months and days, with integer arithmetic only
+    (H. Hinnant's `days_from_civil`, which is much faster than going through `datetime64[M]`)."""
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era*400
+    day_of_year = (153*((month + 9) % 12) + 2) // 5 + day - 1  # Counting from March 1st
+    day_of_era = year_of_era*365 + year_of_era//4 - year_of_era//100 + day_of_year
+    return era*146097 + day_of_era - 719468
+
+
+def parse_date_ranges(date_strs):
+    """
+    Parses an array or list of date strings (formats above) into a pair of `int32` arrays `(min_days, max_days)`
+    of inclusive day ranges; both are `NO_DAY` where a string isn't a valid date in any of the formats.
+    """
+    date_strs = np.asarray(date_strs, dtype=str)
+    chars, lengths = _char_columns(date_strs)
+    n = len(date_strs)
+    year = np.zeros(n, dtype=np.int64)
+    month = np.zeros(n, dtype=np.int64)
+    day = np.zeros(n, dtype=np.int64)
+    kind = np.zeros(n, dtype=np.int8)  # 0 = unparseable, 1 = year, 2 = month, 3 = day
+
+    def dash_at(*positions):
+        return np.logical_and.reduce([chars[p] == ord('-') for p in positions])
+
+    def found(ok, the_kind, yyyy, mm, dd=0):
+        np.copyto(year, yyyy, where=ok)
+        np.copyto(month, mm, where=ok)
+        np.copyto(day, dd, where=ok)
+        np.copyto(kind, the_kind, where=ok)
+
+    # 1978
+    yyyy, ok_yyyy = _number_at(chars, 0, 4)
+    found(ok_yyyy & (lengths == 4), 1, yyyy, 1)
+
+    # 2018-08 and 2019-01-16
+    mm, ok_mm = _number_at(chars, 5, 2)
+    dd, ok_dd = _number_at(chars, 8, 2)
+    ok_ym = ok_yyyy & ok_mm & dash_at(4)
+    found(ok_ym & (lengths == 7), 2, yyyy, mm)
+    found(ok_ym & ok_dd & dash_at(7) & (lengths == 10), 3, yyyy, mm, dd)
+
+    # Nov-2017
+    mon, ok_mon = _month_at(chars, 0)
+    yyyy, ok_yyyy = _number_at(chars, 4, 4)
+    found(ok_mon & ok_yyyy & dash_at(3) & (lengths == 8), 2, yyyy, mon)
+
+    # 09-Nov-2017
+    dd, ok_dd = _number_at(chars, 0, 2)
+    mon, ok_mon = _month_at(chars, 3)
+    yyyy, ok_yyyy = _number_at(chars, 7, 4)
+    found(ok_dd & ok_mon & ok_yyyy & dash_at(2, 6) & (lengths == 11), 3, yyyy, mon, dd)
+
+    # Validate, then convert to day numbers
+    good = (kind > 0) & (year >= 1) & (month >= 1) & (month <= 12)
+    month_start = _days_from_civil(year, month, 1)
+    next_month_start = _days_from_civil(year + (month == 12), month % 12 + 1, 1)
+    next_year_start = _days_from_civil(year + 1, 1, 1)
+    good &= (kind != 3) | ((day >= 1) & (day <= next_month_start - month_start))
+
+    min_days = np.where(kind == 3, month_start + day - 1, month_start)
+    max_days = np.select([kind == 1, kind == 2], [next_year_start - 1, next_month_start - 1], min_days)
+    return (np.where(good, min_days, NO_DAY).astype(np.int32),
+            np.where(good, max_days, NO_DAY).astype(np.int32))
+
+
+def parse_iso_days(date_strs):
+    """Day numbers (`int32` array) of an array or list of `YYYY-MM-DD` strings; `NO_DAY` where not a valid date."""
+    date_strs = np.asarray(date_strs, dtype=str)
+    min_days, max_days = parse_date_ranges(date_strs)
+    is_iso = (np.char.str_len(date_strs) == 10) if len(date_strs) > 0 else np.zeros(0, dtype=bool)
+    return np.where(is_iso & (min_days == max_days), min_days, NO_DAY).astype(np.int32)
+
+
+def epi_weeks(days):
+    """
+    CDC epi weeks (as `YYYYWW` integers, e.g. 202013) of an array of day numbers; 0 where the day is `NO_DAY`.
+    Epi weeks run Sunday to Saturday, and belong to the year in which they end.
+    """
+    days = np.asarray(days, dtype=np.int64)
+    good = days != NO_DAY
+    weekday = (days + 4) % 7  # 0 = Sunday, ..., 6 = Saturday (1970-01-01 was a Thursday)
+    end_of_week = np.where(good, days + 6 - weekday, 0)
+    year_of_end = end_of_week.astype('datetime64[D]').astype('datetime64[Y]')
+    jan1 = year_of_end.astype('datetime64[D]').astype(np.int64)
+    weeks = (year_of_end.astype(np.int64) + 1970)*100 + (end_of_week - jan1) // 7 + 1
+    return np.where(good, weeks, 0).astype(np.int32)
+
+
+def decimal_years(days):
+    """Decimal years (e.g., 2020.0 for 2020-01-01) of an array of day numbers, as in baltic's `decimalDate`;
+    NaN where the day is `NO_DAY`."""
+    days = np.asarray(days, dtype=np.int64)
+    good = days != NO_DAY
+    years = np.where(good, days, 0).astype('datetime64[D]').astype('datetime64[Y]')
+    jan1 = years.astype('datetime64[D]').astype(np.int64)
+    next_jan1 = (years + 1).astype('datetime64[D]').astype(np.int64)
+    result = (years.astype(np.int64) + 1970) + (days - jan1) / (next_jan1 - jan1)
+    return np.where(good, result, np.nan)
+
+
+def format_date_range(min_day, max_day):
+    """The date string for the inclusive range of days [`min_day`, `max_day`] (see above); '' for `NO_DAY`."""
+    if min_day == NO_DAY or max_day == NO_DAY:
+        return ''
+    lo, hi = date_of_day(min_day), date_of_day(max_day)
+    if lo == hi:
+        return lo.isoformat()
+    after_hi = hi + datetime.timedelta(days=1)
+    if lo.day == 1 and after_hi.day == 1:
+        if lo.month == 1 and after_hi.month == 1 and after_hi.year == lo.year + 1:
+            return f'{lo.year:04d}'
+        if (after_hi.year, after_hi.month) == ((lo.year, lo.month + 1) if lo.month < 12 else (lo.year + 1, 1)):
+            return f'{lo.year:04d}-{lo.month:02d}'
+    return f'{lo.isoformat()}/{hi.isoformat()}'
+
+
+def format_date_ranges(min_days, max_days):
+    """List of `format_date_range` strings for arrays of ranges."""
+    return [format_date_range(lo, hi) for lo, hi in zip(np.asarray(min_days).tolist(), np.asarray(max_days).tolist())]
+
+
+# Scalar interface of the prep scripts
+# ------------------------------------
+#
+# The GenBank prep scripts encode date ranges as ((yyyy, mm, dd), (yyyy, mm, dd)) tuples, where the second date is
+# *exclusive* for imprecise dates (e.g., 2018-08 is ((2018, 8, 1), (2018, 9, 1))) and equal to the first for precise
+# ones.  Unparseable dates are ((1900, 1, 1), (1900, 1, 1)).
+
+_UNKNOWN_DATE = (1900, 1, 1)
+
+
+def parse_genbank_date(gb_date):
+    """Parses a date from GenBank (formats above) into a date-range tuple pair."""
+    min_days, max_days = parse_date_ranges([gb_date])
+    min_day, max_day = int(min_days[0]), int(max_days[0])
+    if min_day == NO_DAY:
+        return (_UNKNOWN_DATE, _UNKNOWN_DATE)
+    lo = date_of_day(min_day)
+    hi = date_of_day(max_day) if max_day == min_day else date_of_day(max_day + 1)
+    return ((lo.year, lo.month, lo.day), (hi.year, hi.month, hi.day))
+
+
+def unparse_date_range(date_range):
+    """The date string for a date-range tuple pair (see `format_date_range`)."""
+    min_date, max_date = date_range
+    min_day = day_number(datetime.date(*min_date))
+    max_day = day_number(datetime.date(*max_date))
+    if max_day != min_day:
+        max_day -= 1  # Exclusive -> inclusive
+    return format_date_range(min_day, max_day)
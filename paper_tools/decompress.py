@@ -0,0 +1,235 @@
+# Parallel decompression of large xz / gzip files
+# ===============================================
+#
+# Python's `lzma` and `gzip` modules decompress on a single core.  For big sequence dumps we instead:
+#
+# 1. For xz files made of several blocks (as written by `xz -T<n>`, `pixz` or `paper_tools.fasta_index`),
+#    locate every block from the stream indexes at the end of the file and decompress the blocks on a
+#    process pool, handing the results back strictly in file order;
+# 2. Otherwise, pipe the file through a multi-threaded external decompressor if one is installed
+#    (`pixz` / `xz -T0` for xz, `pigz` for gzip);
+# 3. Otherwise, fall back to the standard library.
+#
+# Either way, the caller gets a text-mode iterable of lines, in order.
+#
+# xz file format reference: https://tukaani.org/xz/xz-file-format.txt
+
+import concurrent.futures
+import gzip
+import io
+import lzma
+import os
+import shutil
+import struct
+import subprocess
+import zlib
+from collections import namedtuple
+
+XZ_HEADER_MAGIC = b'\xfd7zXZ\x00'
+XZ_FOOTER_MAGIC = b'YZ'
+XZ_HEADER_SIZE = 12
+XZ_FOOTER_SIZE = 12
+
+XzBlock = namedtuple('XzBlock', ['offset', 'unpadded_size', 'uncompressed_size', 'stream_flags'])
+
+
+def _round_up_4(n):
+    return (n + 3) & ~3
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not (b & 0x80):
+            return result, pos
+        shift += 7
+
+
+def _encode_varint(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def list_xz_blocks(path):
+    """
+    Returns the list of `XzBlock`s in the xz file at `path`, in file order, by walking the stream footers and
+    indexes backwards from the end of the file.  Handles concatenated streams and stream padding.
+    """
+    streams = []
+    with open(path, 'rb') as f:
+        pos = f.seek(0, os.SEEK_END)
+        while pos > 0:
+            # Skip stream padding (multiples of 4 null bytes)
+            f.seek(pos - 4)
+            if f.read(4) == b'\0\0\0\0':
+                pos -= 4
+                continue
+
+            f.seek(pos - XZ_FOOTER_SIZE)
+            footer = f.read(XZ_FOOTER_SIZE)
+            if footer[10:12] != XZ_FOOTER_MAGIC:
+                raise ValueError(f'{path}: not an xz file, or corrupt stream footer at byte {pos - XZ_FOOTER_SIZE}')
+            backward_size, = struct.unpack('<I', footer[4:8])
+            index_size = (backward_size + 1) * 4
+            stream_flags = footer[8:10]
+
+            index_start = pos - XZ_FOOTER_SIZE - index_size
+            f.seek(index_start)
+            index = f.read(index_size)
+            if index[0] != 0x00:
+                raise ValueError(f'{path}: corrupt xz index at byte {index_start}')
+            num_records, p = _read_varint(index, 1)
+            records = []
+            for _ in range(num_records):
+                unpadded_size, p = _read_varint(index, p)
+                uncompressed_size, p = _read_varint(index, p)
+                records.append((unpadded_size, uncompressed_size))
+
+            blocks_size = sum(_round_up_4(unpadded_size) for unpadded_size, _ in records)
+            stream_start = index_start - blocks_size - XZ_HEADER_SIZE
+            f.seek(stream_start)
+            if f.read(len(XZ_HEADER_MAGIC)) != XZ_HEADER_MAGIC:
+                raise ValueError(f'{path}: could not find xz stream header at byte {stream_start}')
+
+            blocks = []
+            offset = stream_start + XZ_HEADER_SIZE
+            for unpadded_size, uncompressed_size in records:
+                blocks.append(XzBlock(offset, unpadded_size, uncompressed_size, stream_flags))
+                offset += _round_up_4(unpadded_size)
+            streams.append(blocks)
+
+            pos = stream_start
+
+    return [block for blocks in reversed(streams) for block in blocks]
+
+
+def _wrap_xz_block(block_bytes, block):
+    """Wraps the raw bytes of a single xz block into a complete, standalone one-block xz stream."""
+    header = XZ_HEADER_MAGIC + block.stream_flags + struct.pack('<I', zlib.crc32(block.stream_flags))
+
+    index = bytearray(b'\x00')
+    index += _encode_varint(1)
+    index += _encode_varint(block.unpadded_size)
+    index += _encode_varint(block.uncompressed_size)
+    index += b'\0' * (_round_up_4(len(index)) - len(index))
+    index += struct.pack('<I', zlib.crc32(index))
+
+    footer_body = struct.pack('<I', len(index) // 4 - 1) + block.stream_flags
+    footer = struct.pack('<I', zlib.crc32(footer_body)) + footer_body + XZ_FOOTER_MAGIC
+
+    return header + block_bytes + bytes(index) + footer
+
+
+def _decompress_xz_block(path, block):
+    with open(path, 'rb') as f:
+        f.seek(block.offset)
+        block_bytes = f.read(_round_up_4(block.unpadded_size))
+    return lzma.decompress(_wrap_xz_block(block_bytes, block), format=lzma.FORMAT_XZ)
+
+
+def iter_xz_blocks_parallel(path, blocks, max_workers):
+    """Yields the decompressed contents of `blocks` in order, decompressing up to `2*max_workers` blocks ahead."""
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+        pending = []
+        blocks_iter = iter(blocks)
+        for block in blocks_iter:
+            pending.append(pool.submit(_decompress_xz_block, path, block))
+            if len(pending) >= 2 * max_workers:
+                break
+        while pending:
+            data = pending.pop(0).result()
+            block = next(blocks_iter, None)
+            if block is not None:
+                pending.append(pool.submit(_decompress_xz_block, path, block))
+            yield data
+
+
+class ChunkLineReader:
+    """Text-mode line iterator over an iterable of byte chunks whose boundaries may fall mid-line."""
+    def __init__(self, chunks):
+        self._chunks = chunks
+
+    def __iter__(self):
+        leftover = b''
+        for chunk in self._chunks:
+            lines = (leftover + chunk).split(b'\n')
+            leftover = lines.pop()
+            for line in lines:
+                yield line.decode('utf-8') + '\n'
+        if leftover:
+            yield leftover.decode('utf-8')
+
+    def close(self):
+        if hasattr(self._chunks, 'close'):
+            self._chunks.close()  # Shuts down any worker pool behind a generator
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ExternalDecompressor:
+    """Text-mode reader over the stdout of an external decompression command."""
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self._proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        self._text = io.TextIOWrapper(self._proc.stdout, encoding='utf-8')
+
+    def __iter__(self):
+        return iter(self._text)
+
+    def close(self):
+        self._text.close()
+        returncode = self._proc.wait()
+        if returncode not in (0, -13):  # -13 = SIGPIPE, i.e., we stopped reading early
+            raise RuntimeError(f'{" ".join(self.cmd)} failed with exit code {returncode}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def external_decompress_cmd(path, compression, threads):
+    if compression == 'xz':
+        if shutil.which('pixz'):
+            return ['pixz', '-d', '-p', str(threads), '-i', str(path)]
+        if shutil.which('xz'):
+            return ['xz', '-d', '-c', f'-T{threads}', str(path)]
+    if compression == 'gz':
+        if shutil.which('pigz'):
+            return ['pigz', '-d', '-c', '-p', str(threads), str(path)]
+    return None
+
+
+def open_compressed_text(path, compression, threads=None):
+    """Opens an xz- or gzip-compressed file for reading as lines of text, using as many cores as possible."""
+    if threads is None:
+        threads = os.cpu_count() or 1
+
+    if threads > 1:
+        if compression == 'xz':
+            blocks = list_xz_blocks(path)
+            if len(blocks) > 1:
+                return ChunkLineReader(iter_xz_blocks_parallel(path, blocks, min(threads, len(blocks))))
+
+        cmd = external_decompress_cmd(path, compression, threads)
+        if cmd is not None:
+            return ExternalDecompressor(cmd)
+
+    if compression == 'xz':
+        return lzma.open(path, mode='rt', encoding='utf-8')
+    if compression == 'gz':
+        return gzip.open(path, mode='rt', encoding='utf-8')
+    raise ValueError(f'Unknown compression: {compression}')
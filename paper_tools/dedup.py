@@ -0,0 +1,69 @@
+# Grouping of byte-identical sequences
+# ====================================
+#
+# Early outbreak datasets contain many byte-identical genomes.  Expensive per-sequence steps (like alignment) only
+# need to see one copy of each; `SequenceGroups` keeps an exact map from every record to its group, so that the
+# results for the distinct sequences can be expanded back to all records, in the original order.  Intermediate
+# files can then hold each distinct sequence once, under the id of the first record with it, and only the final
+# output is expanded.
+#
+# The report of identical groups is a TSV file with one line per group of 2 or more records:
+#
+#   seq_hash   num_copies   ids (comma-separated, in input order)
+
+import hashlib
+
+
+def sequence_hash(seq):
+    """Hex sha256 of a sequence (`str` or bytes-like)."""
+    return hashlib.sha256(seq.encode('ascii') if isinstance(seq, str) else seq).hexdigest()
+
+
+class SequenceGroups:
+    """The records of an iterable of (fasta_id, seq) pairs, grouped by sequence hash."""
+    def __init__(self, records):
+        self.seq_by_hash = {}  # Key: sequence hash, Value: sequence (in order of first appearance)
+        self.ids_by_hash = {}  # Key: sequence hash, Value: list of ids with that sequence
+        self.record_hashes = []  # (fasta_id, seq_hash) for every record, in input order
+        for fasta_id, seq in records:
+            seq_hash = sequence_hash(seq)
+            if seq_hash not in self.seq_by_hash:
+                self.seq_by_hash[seq_hash] = seq
+                self.ids_by_hash[seq_hash] = []
+            self.ids_by_hash[seq_hash].append(fasta_id)
+            self.record_hashes.append((fasta_id, seq_hash))
+
+    @property
+    def num_records(self):
+        return len(self.record_hashes)
+
+    @property
+    def num_distinct(self):
+        return len(self.seq_by_hash)
+
+    def expand(self, seq_by_hash):
+        """Yields (fasta_id, seq_by_hash[seq_hash]) for every record, in input order."""
+        for fasta_id, seq_hash in self.record_hashes:
+            yield fasta_id, seq_by_hash[seq_hash]
+
+    def expand_representatives(self, records):
+        """
+        Yields (fasta_id, seq) for every record, in input order, from (fasta_id, seq) pairs holding one sequence per
+        group under the id of its first record (as written by `align_to_reference(..., distinct_only=True)`).
+        Pairs under any other id (e.g., a reference sequence) are dropped.
+        """
+        hash_by_first_id = {ids[0]: seq_hash for seq_hash, ids in self.ids_by_hash.items()}
+        seq_by_hash = {hash_by_first_id[fasta_id]: seq for fasta_id, seq in records if fasta_id in hash_by_first_id}
+        return self.expand(seq_by_hash)
+
+    def identical_groups(self):
+        """(seq_hash, ids) pairs for all groups of 2 or more records, largest groups first."""
+        groups = [(seq_hash, ids) for seq_hash, ids in self.ids_by_hash.items() if len(ids) > 1]
+        groups.sort(key=lambda group: len(group[1]), reverse=True)  # Stable, so ties stay in input order
+        return groups
+
+    def write_report(self, out_path):
+        with open(out_path, 'w', encoding='utf-8') as f:
+            f.write('seq_hash\tnum_copies\tids\n')
+            for seq_hash, ids in self.identical_groups():
+                f.write(f'{seq_hash}\t{len(ids)}\t{",".join(ids)}\n')
@@ -0,0 +1,334 @@
+# Running batches of Delphy runs
+# ==============================
+#
+# The `run.py` drivers describe each Delphy run as a `DelphyRun` (command line, thread count, step count, output
+# folder) and hand the whole batch to `run_batch`.  By default, runs are executed one after the other, in the order
+# given, exactly as the drivers used to do (which is what we want when the timings themselves are being measured).
+#
+# With `max_threads` set, runs are instead packed onto that many cores and run concurrently, using the greedy
+# "longest processing time first" rule with backfilling: whenever cores free up, start the costliest pending run
+# that fits in them.  The cost of a run is estimated as `num_steps / num_threads`, since Delphy's steps/s scales
+# roughly linearly with the number of threads.  Starting the long runs first keeps them from dominating the end of
+# the batch, and backfilling keeps small runs (e.g., early epi weeks with a single thread) from leaving cores idle.
+# Note that concurrent runs compete for memory bandwidth, so their steps/s are lower than those of solo runs.
+# A run asking for more threads than `max_threads` occupies the whole machine while it runs.
+#
+# Each run's timing is recorded in `<outputs>/timing.tsv`, with the same first columns as before:
+#
+#   key, number of sequences, start time, end time, total time (s), total steps, number of threads, steps / s
+#
+# followed by a summary of its resource usage (CPU, memory, I/O and context switches; see `proc_stats.py`, which
+# also records a time series of them in `<outputs>/resources.tsv`), and by any extra columns the driver asks for,
+# like those of warm-started runs in `warm_start.py`.  While a run is going, its progress (steps/s, time left,
+# posterior trace) is written to `<outputs>/status.json` (see `run_monitor.py`).
+#
+# A run can depend on another one (`after`), e.g., when it starts from the other's last tree: it's only started once
+# that one has succeeded (and isn't run at all if that one failed), and its `prepare` callback is invoked just before
+# it starts, to write the inputs it derives from the other run's outputs (`prepared_paths`).
+#
+# `run_journaled_batch` additionally keeps a `RunJournal` (see `run_journal.py`), so that an interrupted batch can
+# be re-invoked and only redoes the runs that hadn't finished (and those that depend on them).
+
+import concurrent.futures
+import datetime
+import os
+import subprocess
+import threading
+from pathlib import Path
+
+from paper_tools.run_journal import RUNNING, DONE, FAILED, PENDING, inputs_hash
+from paper_tools.proc_stats import RESOURCE_TIMING_COLUMNS, ResourceSampler, resource_timing_fields, wait_with_rusage
+from paper_tools.run_monitor import RunMonitor
+
+TIMING_COLUMNS = [
+    'Epi week',  # Or simulation name, etc.
+    'Number of sequences',
+    'Start time',
+    'End time',
+    'Total time (s)',
+    'Total steps',
+    'Number of threads',
+    'Steps / s',
+] + RESOURCE_TIMING_COLUMNS
+
+
+class DelphyRun:
+    """One Delphy run: `key` identifies it in the timing records (e.g., an epi week or a simulation name)."""
+    def __init__(self, key, delphy_cli, num_seqs, num_steps, num_threads, outputs_path):
+        self.key = key
+        self.delphy_cli = [str(arg) for arg in delphy_cli]
+        self.num_seqs = num_seqs
+        self.num_steps = num_steps
+        self.num_threads = num_threads
+        self.outputs_path = Path(outputs_path)
+        self.after = None  # The run this one depends on, if any
+        self.prepare = None  # If set, called as `prepare()` just before the run starts
+        self.prepared_paths = []  # Inputs written by `prepare`
+        self.extra_timing_fields = None  # If set, `extra_timing_fields()` gives the extra timing columns of the run
+        self.resource_usage = None  # Set as the run finishes (see `proc_stats.py`)
+        self.inputs_hash = None  # Set by `set_inputs_hash`
+
+    @property
+    def estimated_cost(self):
+        return self.num_steps / self.num_threads
+
+    def _paths_of_flags(self, prefix):
+        return [Path(value) for flag, value in zip(self.delphy_cli, self.delphy_cli[1:]) if flag.startswith(prefix)]
+
+    @property
+    def input_paths(self):
+        """The files given to Delphy as inputs (`--v0-in-...` flags), except those written by `prepare`."""
+        prepared_paths = set(Path(path) for path in self.prepared_paths)
+        return [path for path in self._paths_of_flags('--v0-in-') if path not in prepared_paths]
+
+    @property
+    def output_paths(self):
+        """The files Delphy writes (`--v0-out-...` flags)."""
+        return self._paths_of_flags('--v0-out-')
+
+    @property
+    def log_path(self):
+        """The log file Delphy writes (`--v0-out-log-file`), or None."""
+        paths = self._paths_of_flags('--v0-out-log-file')
+        return paths[0] if paths else None
+
+    def monitor(self):
+        """A `RunMonitor` for this run (writing `<outputs>/status.json`), or None if it doesn't write a log."""
+        if self.log_path is None:
+            return None
+        return RunMonitor(self.key, self.log_path, self.num_steps, self.outputs_path / 'status.json')
+
+    def write_cmd(self):
+        """Records the command line in `<outputs>/run.sh`."""
+        with open(self.outputs_path / 'run.sh', mode='wt', encoding='utf-8') as f:
+            f.write(" ".join(self.delphy_cli) + '\n')  # Ignore quoting subtleties
+
+
+def timing_record(run, start_time, end_time):
+    time_for_run = end_time - start_time
+    steps_per_second = run.num_steps / time_for_run.total_seconds()
+    fields = [
+        f'{run.key}',
+        f'{run.num_seqs}',
+        f'{start_time.isoformat()}',
+        f'{end_time.isoformat()}',
+        f'{time_for_run.total_seconds()}',
+        f'{run.num_steps}',
+        f'{run.num_threads}',
+        f'{steps_per_second}'
+    ]
+    fields.extend(resource_timing_fields(run.resource_usage))
+    if run.extra_timing_fields is not None:
+        fields.extend(run.extra_timing_fields())
+    return '\t'.join(fields) + '\n'
+
+
+def write_timing(run, start_time, end_time, all_timing_f=None):
+    """Writes the timing record of a finished run to `<outputs>/timing.tsv` (and appends it to `all_timing_f`)."""
+    timing_str = timing_record(run, start_time, end_time)
+    with open(run.outputs_path / 'timing.tsv', mode='wt', encoding='utf-8') as f:
+        f.write(timing_str)
+    if all_timing_f is not None:
+        all_timing_f.write(timing_str)
+        all_timing_f.flush()
+    return timing_str
+
+
+def write_all_timing(all_timing_path, runs, journal=None, columns=TIMING_COLUMNS):
+    """
+    (Re)writes `all_timing_path` from the `timing.tsv` of every finished run in `runs`, in that order (only those
+    recorded as done in `journal`, if given).
+    """
+    tmp_path = Path(f'{all_timing_path}.tmp')
+    with open(tmp_path, mode='wt', encoding='utf-8') as all_timing_f:
+        all_timing_f.write('\t'.join(columns) + '\n')
+        for run in runs:
+            timing_path = run.outputs_path / 'timing.tsv'
+            if journal is not None and not journal.is_done(run.key, run.inputs_hash):
+                continue
+            if timing_path.exists():
+                all_timing_f.write(timing_path.read_text(encoding='utf-8'))
+    os.replace(tmp_path, all_timing_path)
+
+
+def execute(run, stdout=None, preexec_fn=None, watchdog=None):
+    """
+    Runs Delphy for `run` (output to `stdout` if given), monitoring its progress and sampling its resource usage
+    (which ends up in `run.resource_usage`).  If given, `watchdog(proc, stop)` is called in a thread for the duration
+    of the run (`stop` is an Event set once it's over); if it returns True, the run was abandoned (e.g., its outputs
+    now belong to someone else) and no final status is written.
+
+    Returns (start time, end time, return code, abandoned).
+    """
+    monitor = run.monitor()
+    start_time = datetime.datetime.now()
+    if monitor is not None:
+        monitor.start()
+    stderr = None if stdout is None else subprocess.STDOUT
+    proc = subprocess.Popen(run.delphy_cli, stdout=stdout, stderr=stderr, preexec_fn=preexec_fn)
+    sampler = ResourceSampler(proc.pid, run.outputs_path / 'resources.tsv')
+    sampler.start()
+    stop, abandoned = threading.Event(), []
+    if watchdog is not None:
+        watchdog_thread = threading.Thread(target=lambda: abandoned.append(watchdog(proc, stop)), daemon=True)
+        watchdog_thread.start()
+    returncode, rusage = wait_with_rusage(proc)
+    end_time = datetime.datetime.now()
+    sampler.stop()
+    if watchdog is not None:
+        stop.set()
+        watchdog_thread.join()
+    run.resource_usage = sampler.summary(rusage, (end_time - start_time).total_seconds())
+    if monitor is not None:
+        monitor.stop(returncode, final_snapshot=not any(abandoned))
+    return start_time, end_time, returncode, any(abandoned)
+
+
+def _execute(run, capture_output):
+    if capture_output:
+        # Concurrent runs would otherwise interleave their output on the terminal
+        with open(run.outputs_path / 'delphy_output.txt', mode='wb') as out_f:
+            start_time, end_time, returncode, _ = execute(run, stdout=out_f)
+    else:
+        start_time, end_time, returncode, _ = execute(run)
+    return start_time, end_time, returncode
+
+
+def lpt_order(runs):
+    """The runs sorted by decreasing estimated cost (ties keep their original order)."""
+    return sorted(runs, key=lambda run: run.estimated_cost, reverse=True)
+
+
+def _start(run, on_start):
+    if on_start is not None:
+        on_start(run)
+    if run.prepare is not None:
+        run.prepare()
+
+
+def run_batch(runs, max_threads=None, on_start=None, on_finish=None):
+    """
+    Executes `runs`, one at a time in order if `max_threads` is None, or else packed concurrently onto `max_threads`
+    cores (see above).  Calls `on_start(run)` as each run is launched and `on_finish(run, start_time, end_time,
+    returncode)` as each one finishes (always from the calling thread); `returncode` is None for a run that wasn't
+    started because the run it depends on failed.  Runs must come after the runs they depend on.
+    """
+    failed = set()
+
+    def skip(run):
+        failed.add(run)
+        if on_finish is not None:
+            now = datetime.datetime.now()
+            on_finish(run, now, now, None)
+
+    def finish(run, start_time, end_time, returncode):
+        if returncode != 0:
+            failed.add(run)
+        if on_finish is not None:
+            on_finish(run, start_time, end_time, returncode)
+
+    if max_threads is None:
+        for run in runs:
+            if run.after in failed:
+                skip(run)
+                continue
+            _start(run, on_start)
+            finish(run, *_execute(run, capture_output=False))
+        return
+
+    pending = lpt_order(runs)
+    unfinished = set(runs)
+    free_threads = max_threads
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(runs))) as pool:
+        running = {}  # Key: future, Value: (run, threads reserved)
+        while pending or running:
+            # Start the costliest pending runs that fit in the free cores (and whose prerequisites are done)
+            for run in list(pending):
+                if run.after in failed:
+                    pending.remove(run)
+                    unfinished.remove(run)
+                    skip(run)
+                    continue
+                if run.after in unfinished:
+                    continue
+                threads = min(run.num_threads, max_threads)
+                if threads <= free_threads:
+                    pending.remove(run)
+                    free_threads -= threads
+                    _start(run, on_start)
+                    running[pool.submit(_execute, run, True)] = (run, threads)
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                run, threads = running.pop(future)
+                free_threads += threads
+                unfinished.remove(run)
+                finish(run, *future.result())
+
+
+def clear_outputs(run):
+    """Removes whatever an earlier, unfinished attempt at `run` may have left behind."""
+    bookkeeping_files = ['timing.tsv', 'delphy_output.txt', 'status.json', 'resources.tsv']
+    for path in (run.output_paths + [Path(path) for path in run.prepared_paths]
+                 + [run.outputs_path / name for name in bookkeeping_files]):
+        path.unlink(missing_ok=True)
+
+
+# Command-line flags that only change how fast Delphy gets through a run, so they're left out of its inputs hash
+# (e.g., `autotune.py` may come up with a different number of threads than the one a finished run was done with)
+PERFORMANCE_FLAGS = ['--v0-threads']
+
+
+def set_inputs_hash(run):
+    """Sets `run.inputs_hash` (that of the run it comes after, if any, must be set already)."""
+    cli = list(run.delphy_cli)
+    for flag in PERFORMANCE_FLAGS:
+        if flag in cli:
+            del cli[cli.index(flag):cli.index(flag) + 2]
+    prerequisite_hash = [] if run.after is None else [run.after.inputs_hash]
+    run.inputs_hash = inputs_hash(cli + prerequisite_hash, run.input_paths)
+
+
+def journaled_as_done(run, journal):
+    """
+    Whether `run_journaled_batch` would skip `run`, i.e., `journal` records it (and the run it comes after, if any)
+    as done with its current inputs.  Sets `run.inputs_hash` if it isn't yet.
+    """
+    if run.inputs_hash is None:
+        set_inputs_hash(run)
+    return journal.is_done(run.key, run.inputs_hash) and (run.after is None or journaled_as_done(run.after, journal))
+
+
+def run_journaled_batch(runs, journal, max_threads=None, on_start=None, on_finish=None, on_skip=None):
+    """
+    Like `run_batch`, but runs recorded as done in `journal` (with the same inputs) are skipped (calling
+    `on_skip(run)`), and the others are redone from scratch, along with the runs that depend on them.  The timing
+    of each successful run is written to `<outputs>/timing.tsv` before it's recorded as done.
+    """
+    to_do = []
+    for run in runs:
+        set_inputs_hash(run)
+        if journal.is_done(run.key, run.inputs_hash) and run.after not in to_do:
+            if on_skip is not None:
+                on_skip(run)
+            continue
+        clear_outputs(run)
+        journal.mark(run.key, PENDING, run.inputs_hash)
+        to_do.append(run)
+
+    def journaled_start(run):
+        journal.mark(run.key, RUNNING, run.inputs_hash)
+        if on_start is not None:
+            on_start(run)
+
+    def journaled_finish(run, start_time, end_time, returncode):
+        if returncode == 0:
+            write_timing(run, start_time, end_time)
+            journal.mark(run.key, DONE, run.inputs_hash)
+        else:
+            note = 'prerequisite failed' if returncode is None else f'exit code {returncode}'
+            journal.mark(run.key, FAILED, run.inputs_hash, note=note)
+        if on_finish is not None:
+            on_finish(run, start_time, end_time, returncode)
+
+    run_batch(to_do, max_threads=max_threads, on_start=journaled_start, on_finish=journaled_finish)
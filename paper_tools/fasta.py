@@ -0,0 +1,120 @@
+# Streaming FASTA reading & writing
+# =================================
+#
+# Sequences are accumulated as a list of line chunks and joined once per record, so parsing is linear in the
+# size of the input, and records are yielded one at a time, so memory use doesn't grow with the number of
+# sequences.  Plain, gzip- and xz-compressed files are all accepted (detected by their magic bytes); compressed
+# files are decompressed on several cores where possible (see `decompress.py`).
+
+import gzip
+import lzma
+from pathlib import Path
+
+from paper_tools.decompress import open_compressed_text
+
+GZIP_MAGIC = b'\x1f\x8b'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+
+WRITE_BUFFER_SIZE = 1 << 20  # 1 MiB
+
+
+def detect_compression(path):
+    """Returns 'gz', 'xz' or None depending on the first few bytes of the file at `path`."""
+    with open(path, 'rb') as f:
+        magic = f.read(len(XZ_MAGIC))
+    if magic.startswith(GZIP_MAGIC):
+        return 'gz'
+    if magic.startswith(XZ_MAGIC):
+        return 'xz'
+    return None
+
+
+def open_fasta(path, threads=None):
+    """
+    Opens a possibly compressed FASTA file for reading in text mode.  Compressed files are decompressed using up to
+    `threads` cores (default: all of them).
+    """
+    compression = detect_compression(path)
+    if compression is not None:
+        return open_compressed_text(path, compression, threads)
+    return open(path, mode='rt', encoding='utf-8')
+
+
+def read_fasta(source, threads=None):
+    """
+    Yields (fasta_id, sequence) pairs from a FASTA file.
+
+    `source` is either a path (str or Path; compression detected automatically) or an already-open file, in
+    which case it's simply iterated over line by line (text or binary lines are both fine).  `threads` limits
+    the number of cores used to decompress a compressed file.
+    """
+    if isinstance(source, (str, Path)):
+        with open_fasta(source, threads) as f:
+            yield from read_fasta(f)
+        return
+
+    fasta_id = None
+    chunks = []
+    for line in source:
+        if not isinstance(line, str):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            continue
+        if line[0] == '>':
+            if fasta_id is not None:
+                yield (fasta_id, ''.join(chunks))
+            fasta_id = line[1:].strip()
+            chunks = []
+        else:
+            if fasta_id is None:
+                raise ValueError(f"Expecting FASTA ID line, found {line}")
+            chunks.append(line)
+    if fasta_id is not None:
+        yield (fasta_id, ''.join(chunks))
+
+
+class FastaWriter:
+    """
+    Buffered FASTA writer.  Each sequence is written on a single line.
+
+    Sequences may be `str` or any bytes-like object (`bytes`, `bytearray`, `memoryview`, NumPy `uint8` arrays);
+    the latter are written out as-is, without copying them into intermediate strings.  Output is compressed if
+    `path` ends in `.gz` or `.xz`.
+    """
+    def __init__(self, path, mode='wb'):
+        path = Path(path)
+        if path.suffix == '.gz':
+            self._f = gzip.open(path, mode)
+        elif path.suffix == '.xz':
+            self._f = lzma.open(path, mode)
+        else:
+            self._f = open(path, mode, buffering=WRITE_BUFFER_SIZE)
+        self.num_written = 0
+
+    def write(self, fasta_id, seq):
+        f = self._f
+        f.write(b'>' + fasta_id.encode('utf-8') + b'\n')
+        f.write(seq.encode('ascii') if isinstance(seq, str) else seq)
+        f.write(b'\n')
+        self.num_written += 1
+
+    def write_all(self, records):
+        for fasta_id, seq in records:
+            self.write(fasta_id, seq)
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_fasta(path, records):
+    """Writes an iterable of (fasta_id, sequence) pairs to `path`; returns the number of records written."""
+    with FastaWriter(path) as w:
+        w.write_all(records)
+        return w.num_written
@@ -0,0 +1,170 @@
+# Seekable, indexed compressed FASTA files
+# ========================================
+#
+# A plain `.xz` file can only be read from the start.  Here we recompress a FASTA file into a sequence of
+# independent xz streams ("blocks") of a few MiB of uncompressed data each, and record, for every record, which
+# block it lives in and where in that block it starts.  Concatenated xz streams are still a valid `.xz` file, so
+# the output can be read as usual by `xz -d`, `lzma.open` or `read_fasta`.  But with the index, fetching a subset
+# of records only requires decompressing the blocks that contain them.
+#
+# Index format (`<blocked.fasta.xz>.idx.tsv`), one line per record:
+#
+#   id   block_offset   block_size   offset_in_block   record_size
+#
+# where offsets and sizes of blocks are in bytes of the compressed file, and offsets and sizes of records are
+# in bytes of the decompressed block (a record spans its `>` line up to and including the final newline).  A first
+# `# source` line stamps the index with the name, size and mtime of the FASTA file it was built from, so that a
+# blocked copy of an older version of that file (e.g., an updated GISAID dump) is never used by mistake.
+#
+# Usage: python3 -m paper_tools.fasta_index [--unless-current] <in.fasta[.xz|.gz]> <out_blocked.fasta.xz>
+#
+# (with `--unless-current`, nothing is done if the blocked copy is already up to date with the input)
+
+import lzma
+import os
+import sys
+from collections import namedtuple
+from pathlib import Path
+
+from paper_tools.fasta import read_fasta
+
+DEFAULT_BLOCK_SIZE = 4 << 20  # 4 MiB of uncompressed FASTA per block
+
+IndexEntry = namedtuple('IndexEntry', ['fasta_id', 'block_offset', 'block_size', 'offset_in_block', 'record_size'])
+
+
+def index_path_for(blocked_path):
+    blocked_path = Path(blocked_path)
+    return blocked_path.with_name(blocked_path.name + '.idx.tsv')
+
+
+def _source_stamp(source_path):
+    st = Path(source_path).stat()
+    return [Path(source_path).name, str(st.st_size), str(st.st_mtime_ns)]
+
+
+def build_blocked_xz(in_path, out_path, block_size=DEFAULT_BLOCK_SIZE, preset=6):
+    """
+    Recompresses the FASTA file at `in_path` into independently decompressible xz blocks at `out_path`,
+    writing the record index next to it.  Returns the number of records indexed.
+    """
+    out_path = Path(out_path)
+    idx_path = index_path_for(out_path)
+    tmp_out_path = out_path.with_name(out_path.name + '.tmp')
+    tmp_idx_path = idx_path.with_name(idx_path.name + '.tmp')
+
+    num_records = 0
+    with open(tmp_out_path, 'wb') as out_f, open(tmp_idx_path, 'w', encoding='utf-8') as idx_f:
+        idx_f.write('\t'.join(['# source'] + _source_stamp(in_path)) + '\n')  # Before reading, in case it changes
+        idx_f.write('id\tblock_offset\tblock_size\toffset_in_block\trecord_size\n')
+
+        block_chunks = []
+        block_len = 0
+        pending = []  # (fasta_id, offset_in_block, record_size) for records in the current block
+
+        def flush_block():
+            nonlocal block_chunks, block_len, pending
+            if not pending:
+                return
+            block_offset = out_f.tell()
+            compressed = lzma.compress(b''.join(block_chunks), format=lzma.FORMAT_XZ, preset=preset)
+            out_f.write(compressed)
+            for fasta_id, offset_in_block, record_size in pending:
+                idx_f.write(f'{fasta_id}\t{block_offset}\t{len(compressed)}\t{offset_in_block}\t{record_size}\n')
+            block_chunks = []
+            block_len = 0
+            pending = []
+
+        for fasta_id, seq in read_fasta(in_path):
+            if '\t' in fasta_id:
+                raise ValueError(f'FASTA id contains a tab, cannot index it: {fasta_id!r}')
+            record = f'>{fasta_id}\n{seq}\n'.encode('utf-8')
+            pending.append((fasta_id, block_len, len(record)))
+            block_chunks.append(record)
+            block_len += len(record)
+            num_records += 1
+            if block_len >= block_size:
+                flush_block()
+        flush_block()
+
+    os.replace(tmp_out_path, out_path)
+    os.replace(tmp_idx_path, idx_path)
+    return num_records
+
+
+def has_index(blocked_path, source_path=None):
+    """
+    Whether `blocked_path` and its index exist and, if `source_path` is given, were built from that file as it
+    is now (same name, size and mtime).
+    """
+    idx_path = index_path_for(blocked_path)
+    if not (Path(blocked_path).exists() and idx_path.exists()):
+        return False
+    if source_path is None:
+        return True
+    with open(idx_path, 'r', encoding='utf-8') as f:
+        first_line = f.readline().rstrip('\n').split('\t')
+    return first_line == ['# source'] + _source_stamp(source_path)
+
+
+class IndexedFasta:
+    """Random access to the records of a blocked `.xz` FASTA file built by `build_blocked_xz`."""
+    def __init__(self, blocked_path):
+        self.path = Path(blocked_path)
+        self.entries = []
+        with open(index_path_for(blocked_path), 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('#') or line.startswith('id\t'):
+                    continue  # Source stamp and header
+                fasta_id, *nums = line.rstrip('\n').split('\t')
+                self.entries.append(IndexEntry(fasta_id, *(int(n) for n in nums)))
+        self._id_2_entry = {e.fasta_id: e for e in self.entries}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, fasta_id):
+        return fasta_id in self._id_2_entry
+
+    def read_fasta(self, select=None, ids=None):
+        """
+        Yields (fasta_id, sequence) pairs, in file order, for the records whose id is in `ids` or satisfies the
+        predicate `select` (default: all records).  Only blocks containing at least one such record are read and
+        decompressed, each exactly once.
+        """
+        if ids is not None:
+            ids = set(ids)
+            wanted = [e for e in self.entries if e.fasta_id in ids]
+        elif select is not None:
+            wanted = [e for e in self.entries if select(e.fasta_id)]
+        else:
+            wanted = self.entries
+
+        with open(self.path, 'rb') as f:
+            cur_block_offset = None
+            block = None
+            for e in wanted:  # Already in file order
+                if e.block_offset != cur_block_offset:
+                    f.seek(e.block_offset)
+                    block = lzma.decompress(f.read(e.block_size), format=lzma.FORMAT_XZ)
+                    cur_block_offset = e.block_offset
+                record = block[e.offset_in_block:e.offset_in_block+e.record_size]
+                header, _, seq = record.rstrip(b'\n').partition(b'\n')
+                yield (header[1:].decode('utf-8'), seq.decode('ascii'))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    unless_current = args[:1] == ['--unless-current']
+    if unless_current:
+        args = args[1:]
+    if len(args) != 2:
+        sys.stderr.write("Usage: python3 -m paper_tools.fasta_index [--unless-current] "
+                         "<in.fasta[.xz|.gz]> <out_blocked.fasta.xz>\n")
+        sys.exit(1)
+    in_path, out_path = args
+    if unless_current and has_index(out_path, source_path=in_path):
+        print(f'{out_path} is up to date with {in_path}')
+        sys.exit(0)
+    num_records = build_blocked_xz(in_path, out_path)
+    print(f'Indexed {num_records} records into {out_path} (index in {index_path_for(out_path)})')
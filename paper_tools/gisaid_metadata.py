@@ -0,0 +1,162 @@
+# Columnar cache of GISAID metadata tables
+# ========================================
+#
+# GISAID metadata dumps like `metadata_20200331.tsv` have one row per sequence, with these columns:
+#
+#   Virus name, Accession ID, Collection date, Location, Additional location information, Sequence length, Host,
+#   Submission date
+#
+# Parsing the TSV row by row into dicts, and then re-parsing its dates with regexes, is slow for big dumps and has
+# to be redone by every script that looks at the metadata.  Instead, the table is converted once into
+# `<metadata.tsv>.cache.npz`, with one NumPy array per column, plus pre-parsed dates as day numbers and CDC epi weeks
+# (see `dates.py`).  Later loads just read the arrays back, and filters are vectorized expressions over them.
+#
+# The cache records the size, modification time and sha256 of the TSV it came from.  It's rebuilt if the TSV's
+# contents change; if only its size or mtime changed (e.g., the file was copied) but its hash didn't, the cache is
+# reused and just re-stamped.
+#
+# Usage: python3 -m paper_tools.gisaid_metadata <metadata.tsv>
+
+import csv
+import hashlib
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from paper_tools.dates import NO_DAY, parse_iso_days, epi_weeks
+
+CACHE_FORMAT_VERSION = 1
+
+# Attribute names for the columns of the TSV, in order
+COLUMNS = ['virus_name', 'accession_id', 'collection_date', 'location', 'additional_location_info',
+           'length', 'host', 'submission_date']
+STRING_COLUMNS = [c for c in COLUMNS if c != 'length']
+DERIVED_COLUMNS = ['collection_day', 'submission_day', 'collection_epi_week', 'submission_epi_week']
+
+
+def default_cache_path(tsv_path):
+    tsv_path = Path(tsv_path)
+    return tsv_path.with_name(tsv_path.name + '.cache.npz')
+
+
+def _sha256_of_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _sanitize_tabs(s):
+    return s.replace("\t", " ")  # Avoid CSV pain downstream
+
+
+def _read_tsv_columns(tsv_path):
+    columns = {name: [] for name in COLUMNS}
+    with open(tsv_path, 'r', encoding='utf-8', newline='') as f:
+        ff = csv.reader(f, delimiter='\t')
+        next(ff)  # Header
+        for row in ff:
+            if len(row) != len(COLUMNS):
+                raise ValueError(f'{tsv_path}, line {ff.line_num}: expected {len(COLUMNS)} columns, found {len(row)}')
+            for name, value in zip(COLUMNS, row):
+                columns[name].append(value)
+
+    arrays = {name: np.array([_sanitize_tabs(v) for v in columns[name]], dtype=str) for name in STRING_COLUMNS}
+    arrays['length'] = np.array(columns['length'], dtype=np.int32)
+
+    unique_ids, counts = np.unique(arrays['accession_id'], return_counts=True)
+    if np.any(counts > 1):
+        raise ValueError(f'{tsv_path}: duplicate accession IDs, e.g. {unique_ids[counts > 1][0]}')
+
+    arrays['collection_day'] = parse_iso_days(arrays['collection_date'])
+    arrays['submission_day'] = parse_iso_days(arrays['submission_date'])
+    arrays['collection_epi_week'] = epi_weeks(arrays['collection_day'])
+    arrays['submission_epi_week'] = epi_weeks(arrays['submission_day'])
+    return arrays
+
+
+def _save_cache(cache_path, arrays, stamp):
+    tmp_cache_path = cache_path.with_name(cache_path.name + '.tmp')
+    with open(tmp_cache_path, 'wb') as f:  # A file object, so that `np.savez` doesn't append `.npz` to the name
+        np.savez(f, **arrays, **{f'_source_{k}': v for k, v in stamp.items()})
+    os.replace(tmp_cache_path, cache_path)
+
+
+def _load_cache(cache_path):
+    with np.load(cache_path) as npz:
+        if int(npz['_source_format_version']) != CACHE_FORMAT_VERSION:
+            return None, None
+        stamp = {k[len('_source_'):]: npz[k].item() for k in npz.files if k.startswith('_source_')}
+        arrays = {name: npz[name] for name in COLUMNS + DERIVED_COLUMNS}
+    return arrays, stamp
+
+
+def load_gisaid_metadata(tsv_path, cache_path=None, verbose=True):
+    """
+    Returns the `GisaidMetadata` for the TSV file `tsv_path`, from its cache (default: `<tsv_path>.cache.npz`)
+    if that's up to date, or else parsing the TSV and (re)building the cache.
+    """
+    tsv_path = Path(tsv_path)
+    cache_path = default_cache_path(tsv_path) if cache_path is None else Path(cache_path)
+    st = tsv_path.stat()
+    stamp = {'format_version': CACHE_FORMAT_VERSION, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+    if cache_path.exists():
+        arrays, cached_stamp = _load_cache(cache_path)
+        if arrays is not None:
+            if cached_stamp['size'] == stamp['size'] and cached_stamp['mtime_ns'] == stamp['mtime_ns']:
+                return GisaidMetadata(arrays)
+            stamp['sha256'] = _sha256_of_file(tsv_path)
+            if cached_stamp['sha256'] == stamp['sha256']:
+                _save_cache(cache_path, arrays, stamp)
+                return GisaidMetadata(arrays)
+
+    if verbose:
+        print(f'INFO: Building metadata cache {cache_path.as_posix()} from {tsv_path.as_posix()}')
+    if 'sha256' not in stamp:
+        stamp['sha256'] = _sha256_of_file(tsv_path)
+    arrays = _read_tsv_columns(tsv_path)
+    _save_cache(cache_path, arrays, stamp)
+    return GisaidMetadata(arrays)
+
+
+class GisaidMetadata:
+    """
+    A GISAID metadata table, one NumPy array per column (see `COLUMNS`), plus:
+
+    * `collection_day` and `submission_day`: day numbers of the dates (`NO_DAY` if not a precise `YYYY-MM-DD`);
+    * `collection_epi_week` and `submission_epi_week`: their CDC epi weeks (e.g. 202013; 0 if no precise date).
+
+    Rows can be selected with boolean masks over the columns, e.g. `md.accession_id[md.host == 'Human']`.
+    """
+    def __init__(self, arrays):
+        for name in COLUMNS + DERIVED_COLUMNS:
+            setattr(self, name, arrays[name])
+        self._accession_id_2_row = None
+
+    def __len__(self):
+        return len(self.accession_id)
+
+    def row_of(self, accession_id):
+        if self._accession_id_2_row is None:
+            self._accession_id_2_row = {a: row for row, a in enumerate(self.accession_id.tolist())}
+        return self._accession_id_2_row[accession_id]
+
+    def rows(self, mask=None):
+        """Yields the rows selected by `mask` (default: all) as dicts from column name to (Python) value."""
+        selected = np.arange(len(self)) if mask is None else np.flatnonzero(mask)
+        columns = [(name, getattr(self, name)[selected].tolist()) for name in COLUMNS + DERIVED_COLUMNS]
+        for i in range(len(selected)):
+            yield {name: values[i] for name, values in columns}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.stderr.write("Usage: python3 -m paper_tools.gisaid_metadata <metadata.tsv>\n")
+        sys.exit(1)
+    md = load_gisaid_metadata(sys.argv[1])
+    num_precise = np.count_nonzero(md.collection_day != NO_DAY)
+    print(f'{len(md)} rows in {default_cache_path(sys.argv[1])}, {num_precise} with precise collection dates')
@@ -0,0 +1,146 @@
+# Site masking of whole alignments
+# ================================
+#
+# A site mask is a boolean array over the sites of an alignment (True = mask out).  It can be built from
+# 1-based inclusive site ranges or from a BED file (0-based, half-open intervals; the chromosome column is
+# ignored).  Masks are applied to whole blocks of rows at a time with NumPy, either while streaming a FASTA
+# file into another, or in place on a packed alignment (see `alignment_store.py`).
+#
+# Usage: python3 -m paper_tools.masking <in.fasta> <out.fasta> [--range START-END ...] [--bed sites.bed ...]
+
+import argparse
+
+import numpy as np
+
+from paper_tools.alignment_store import default_prefix, is_packed_current, PackedAlignment
+from paper_tools.fasta import read_fasta, FastaWriter
+
+DEFAULT_BLOCK_ROWS = 1024
+
+
+def mask_from_ranges(num_sites, ranges):
+    """Mask of length `num_sites` covering the 1-based, inclusive (start, end) site ranges in `ranges`."""
+    mask = np.zeros(num_sites, dtype=bool)
+    for start, end in ranges:
+        if not (1 <= start <= end <= num_sites):
+            raise ValueError(f'Site range [{start}, {end}] out of bounds for an alignment with {num_sites} sites')
+        mask[start-1:end] = True
+    return mask
+
+
+def mask_tails(num_sites, num_initial, num_final):
+    """Mask covering the first `num_initial` and last `num_final` sites."""
+    mask = np.zeros(num_sites, dtype=bool)
+    mask[:num_initial] = True
+    mask[num_sites-num_final:] = True
+    return mask
+
+
+def mask_from_bed(num_sites, bed_path):
+    """Mask of length `num_sites` covering all intervals in the BED file at `bed_path`."""
+    ranges = []
+    with open(bed_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            _, start, end, *_ = line.split('\t')
+            ranges.append((int(start) + 1, int(end)))  # BED is 0-based, half-open
+    return mask_from_ranges(num_sites, ranges)
+
+
+def apply_mask(block, mask, fill=b'-', rows=None):
+    """
+    Masks the sites in `mask` in-place in a 2D `uint8` block of rows.  If given, `rows` is a boolean array
+    selecting which rows of the block get masked.
+    """
+    if rows is None:
+        block[:, mask] = ord(fill)
+    elif rows.any():
+        block[np.ix_(rows, mask)] = ord(fill)
+    return block
+
+
+def _record_blocks(in_path, block_rows):
+    """Yields (ids, block) pairs of up to `block_rows` rows each, with `block` a writable 2D `uint8` array."""
+    # Use the packed form of the alignment if there's an up-to-date one, to skip FASTA parsing altogether
+    if is_packed_current(in_path):
+        packed = PackedAlignment(default_prefix(in_path))
+        for start, block in packed.iter_blocks(block_rows):
+            yield packed.ids[start:start+len(block)], np.array(block)
+        return
+
+    ids = []
+    seqs = []
+    num_sites = None
+    for fasta_id, seq in read_fasta(in_path):
+        if num_sites is None:
+            num_sites = len(seq)
+        elif len(seq) != num_sites:
+            raise ValueError(f'{in_path} is not aligned: {fasta_id} has {len(seq)} sites, expected {num_sites}')
+        ids.append(fasta_id)
+        seqs.append(seq.encode('ascii'))
+        if len(ids) >= block_rows:
+            yield ids, np.frombuffer(b''.join(seqs), dtype=np.uint8).reshape(len(ids), num_sites).copy()
+            ids, seqs = [], []
+    if ids:
+        yield ids, np.frombuffer(b''.join(seqs), dtype=np.uint8).reshape(len(ids), num_sites).copy()
+
+
+def mask_fasta(in_path, out_path, mask, fill=b'-', include=None, exempt=None, block_rows=DEFAULT_BLOCK_ROWS):
+    """
+    Streams the aligned FASTA file at `in_path` into `out_path`, replacing the sites in `mask` with `fill`.
+
+    Optional predicates on the FASTA id:
+    * `include`: records for which this is False are dropped;
+    * `exempt`: records for which this is True are copied through unmasked.
+
+    `mask` may also be a function taking the number of sites in the alignment and returning a mask, for when
+    that isn't known in advance.  Returns the number of records written.
+    """
+    with FastaWriter(out_path) as w:
+        for ids, block in _record_blocks(in_path, block_rows):
+            if callable(mask):
+                mask = mask(block.shape[1])
+            if len(mask) != block.shape[1]:
+                raise ValueError(f'Site mask has {len(mask)} sites, but {in_path} has {block.shape[1]}')
+            rows = None
+            if exempt is not None:
+                rows = np.array([not exempt(fasta_id) for fasta_id in ids], dtype=bool)
+            apply_mask(block, mask, fill, rows)
+
+            for fasta_id, row in zip(ids, block):
+                if include is None or include(fasta_id):
+                    w.write(fasta_id, row)
+        return w.num_written
+
+
+def mask_packed(packed_prefix, mask, fill=b'-', exempt=None, block_rows=DEFAULT_BLOCK_ROWS):
+    """Applies `mask` in place to the packed alignment at `packed_prefix`, one block of rows at a time."""
+    packed = PackedAlignment(packed_prefix, mode='r+')
+    if callable(mask):
+        mask = mask(packed.num_sites)
+    for start, block in packed.iter_blocks(block_rows):
+        rows = None
+        if exempt is not None:
+            rows = np.array([not exempt(fasta_id) for fasta_id in packed.ids[start:start+len(block)]], dtype=bool)
+        apply_mask(block, mask, fill, rows)
+    packed.seqs.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mask sites of an aligned FASTA file')
+    parser.add_argument('in_fasta')
+    parser.add_argument('out_fasta')
+    parser.add_argument('--range', action='append', default=[], help='1-based, inclusive site range START-END (repeatable)')
+    parser.add_argument('--bed', action='append', default=[], help='BED file with sites to mask (repeatable)')
+    parser.add_argument('--fill', default='-', help='Character to mask sites with (default: -)')
+    args = parser.parse_args()
+
+    def build_mask(num_sites):
+        mask = mask_from_ranges(num_sites, [tuple(int(x) for x in r.split('-')) for r in args.range])
+        for bed_path in args.bed:
+            mask |= mask_from_bed(num_sites, bed_path)
+        return mask
+
+    num_written = mask_fasta(args.in_fasta, args.out_fasta, build_mask, fill=args.fill.encode('ascii'))
+    print(f'Masked {num_written} sequences into {args.out_fasta}')
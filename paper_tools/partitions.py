@@ -0,0 +1,128 @@
+# Reassembling partitioned alignments
+# ===================================
+#
+# BEAST XML files often split one alignment into several partitions.  The helpers here put them back together
+# with NumPy operations over whole (sequences x sites) byte matrices, rather than one character at a time.
+
+import numpy as np
+
+
+def seqs_to_matrix(seqs):
+    """Stacks equal-length sequences (`str` or bytes-like) into an N x L `uint8` matrix."""
+    seqs = [s.encode('ascii') if isinstance(s, str) else bytes(s) for s in seqs]
+    if not seqs:
+        return np.zeros((0, 0), dtype=np.uint8)
+    L = len(seqs[0])
+    for i, s in enumerate(seqs):
+        if len(s) != L:
+            raise ValueError(f'Sequence #{i} has length {len(s)}, expected {L}')
+    return np.frombuffer(b''.join(seqs), dtype=np.uint8).reshape(len(seqs), L)
+
+
+def merge_partitions(partitions, missing=b'N'):
+    """
+    Overlays several partitions of the same taxa and sites, masked with `missing` wherever a site belongs to a
+    different partition (e.g., the APOBEC3 and non-APOBEC3 partitions of the mpox BEAST XMLs).
+
+    `partitions` is a list of N x L `uint8` matrices (or lists of N sequences of length L).  At each site, the
+    result takes the state of the first partition in which it isn't `missing` (or `missing` if there is none).
+    """
+    matrices = [p if isinstance(p, np.ndarray) else seqs_to_matrix(p) for p in partitions]
+    if not matrices:
+        raise ValueError('No partitions to merge')
+    shape = matrices[0].shape
+    for i, m in enumerate(matrices):
+        if m.shape != shape:
+            raise ValueError(f'Partition #{i} has shape {m.shape}, expected {shape}')
+
+    missing_code = ord(missing)
+    result = matrices[0].copy()
+    for m in matrices[1:]:
+        np.copyto(result, m, where=(result == missing_code))
+    return result
+
+
+# Table-driven reassembly
+# -----------------------
+#
+# A partition map is a TSV file with columns `ref_start`, `ref_end`, `partition`, `part_start`, `part_end`
+# (all ranges 1-based and half-open, `#` lines are comments).  Each row says that reference sites
+# [ref_start, ref_end) come from sites [part_start, part_end) of the named partition; a partition of `-` means
+# those reference sites are filled in (with N).  The rows must tile the reference from site 1 without gaps or
+# overlaps.
+#
+# The map is turned once into a single gather index into the concatenation of all partitions (plus one trailing
+# fill column), so that unscrambling every taxon is a single fancy-indexing operation per alignment.
+
+FILL_PARTITION = '-'
+
+
+def read_partition_map(path):
+    """Returns the rows of a partition map file as (ref_start, ref_end, partition, part_start, part_end) tuples."""
+    rows = []
+    header = None
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if header is None:
+                header = fields
+                if header != ['ref_start', 'ref_end', 'partition', 'part_start', 'part_end']:
+                    raise ValueError(f'{path}: unexpected header {header}')
+                continue
+            ref_start, ref_end, partition, part_start, part_end = fields
+            if partition == FILL_PARTITION:
+                rows.append((int(ref_start), int(ref_end), None, None, None))
+            else:
+                rows.append((int(ref_start), int(ref_end), partition, int(part_start), int(part_end)))
+    return rows
+
+
+def build_gather_index(partition_map, partition_lengths):
+    """
+    Builds the gather index for `partition_map` (rows as returned by `read_partition_map`).
+
+    `partition_lengths` is a dict from partition name to number of sites, whose iteration order is the order in
+    which the partitions will be concatenated.  Fill sites point at the extra column after all the partitions.
+    """
+    offsets = {}
+    total = 0
+    for name, length in partition_lengths.items():
+        offsets[name] = total
+        total += length
+    fill_column = total
+
+    pieces = []
+    expected_ref_start = 1
+    for ref_start, ref_end, partition, part_start, part_end in sorted(partition_map, key=lambda row: row[0]):
+        if ref_start != expected_ref_start:
+            raise ValueError(f'Partition map has a gap or overlap at reference site {expected_ref_start}')
+        if partition is None:
+            pieces.append(np.full(ref_end - ref_start, fill_column, dtype=np.intp))
+        else:
+            if partition not in offsets:
+                raise ValueError(f'Partition map refers to unknown partition {partition}')
+            if ref_end - ref_start != part_end - part_start:
+                raise ValueError(f'Reference range [{ref_start}, {ref_end}) and {partition} range '
+                                 f'[{part_start}, {part_end}) have different lengths')
+            if not (1 <= part_start and part_end - 1 <= partition_lengths[partition]):
+                raise ValueError(f'{partition} range [{part_start}, {part_end}) out of bounds')
+            start = offsets[partition] + part_start - 1
+            pieces.append(np.arange(start, start + (part_end - part_start), dtype=np.intp))
+        expected_ref_start = ref_end
+
+    return np.concatenate(pieces)
+
+
+def reassemble(partitions, gather_index, fill=b'N'):
+    """
+    Applies a gather index built by `build_gather_index` to all taxa at once.
+
+    `partitions` is a dict from partition name to N x L_p `uint8` matrix (or list of N sequences), in the same
+    order as the `partition_lengths` used to build `gather_index`.  Returns an N x L_ref `uint8` matrix.
+    """
+    matrices = [p if isinstance(p, np.ndarray) else seqs_to_matrix(p) for p in partitions.values()]
+    num_taxa = matrices[0].shape[0]
+    fill_column = np.full((num_taxa, 1), ord(fill), dtype=np.uint8)
+    return np.hstack(matrices + [fill_column])[:, gather_index]
@@ -0,0 +1,179 @@
+# Resource usage of Delphy runs
+# =============================
+#
+# To tell whether a run (e.g., a 96-thread sim or a 100k-sequence epi week) is CPU-, memory- or I/O-bound, a
+# `ResourceSampler` thread reads the Delphy process's `/proc/<pid>` files every `SAMPLE_INTERVAL` seconds while it
+# runs, and appends one line per sample to a time-series sidecar file (`<outputs>/resources.tsv`):
+#
+#   elapsed (s), user CPU (s), system CPU (s), RSS (MiB), read (MiB), written (MiB), voluntary & involuntary
+#   context switches
+#
+# All but RSS are cumulative; CPU and I/O cover all of Delphy's threads, and context switches are summed over its
+# live threads.  When the run ends, its totals come from the kernel's exact accounting of the reaped process
+# (`os.wait4`), so nothing after the last sample is lost, and are summarized in the `RESOURCE_TIMING_COLUMNS` of
+# `timing.tsv`.
+#
+# Where `/proc` isn't available (e.g., macOS), no time series is recorded, and the mean RSS is left blank.
+
+import os
+import threading
+import time
+from pathlib import Path
+
+SAMPLE_INTERVAL = 5  # seconds
+
+_MIB = 1 << 20
+
+RESOURCE_TIMING_COLUMNS = [
+    'User CPU (s)',
+    'System CPU (s)',
+    'Mean CPU cores used',
+    'Peak RSS (MiB)',
+    'Mean RSS (MiB)',
+    'Read (MiB)',
+    'Written (MiB)',
+    'Voluntary context switches',
+    'Involuntary context switches',
+]
+
+RESOURCE_SERIES_COLUMNS = [
+    'Elapsed (s)',
+    'User CPU (s)',
+    'System CPU (s)',
+    'RSS (MiB)',
+    'Read (MiB)',
+    'Written (MiB)',
+    'Voluntary context switches',
+    'Involuntary context switches',
+]
+
+
+def _read_key_values(path):
+    result = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            result[key.strip()] = value.strip()
+    return result
+
+
+def read_proc_sample(pid):
+    """
+    Current (user CPU s, system CPU s, RSS bytes, read bytes, written bytes, voluntary context switches,
+    involuntary context switches) of process `pid`, from `/proc/<pid>`.  Raises `OSError` if it's gone.
+    """
+    proc_path = Path(f'/proc/{pid}')
+    with open(proc_path / 'stat', 'r', encoding='utf-8') as f:
+        stat = f.read()
+    fields = stat[stat.rindex(')')+2:].split()  # After `pid (comm) `, from field 3 (`state`) on
+    ticks_per_second = os.sysconf('SC_CLK_TCK')
+    user_cpu = int(fields[11]) / ticks_per_second
+    system_cpu = int(fields[12]) / ticks_per_second
+    rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+
+    try:
+        io = _read_key_values(proc_path / 'io')
+        read_bytes, written_bytes = int(io['read_bytes']), int(io['write_bytes'])
+    except (OSError, KeyError):  # No I/O accounting in this kernel, or not allowed to see it
+        read_bytes, written_bytes = None, None
+
+    voluntary, involuntary = 0, 0
+    for task_path in (proc_path / 'task').iterdir():
+        try:
+            status = _read_key_values(task_path / 'status')
+        except OSError:
+            continue  # Thread just exited
+        voluntary += int(status.get('voluntary_ctxt_switches', 0))
+        involuntary += int(status.get('nonvoluntary_ctxt_switches', 0))
+    return user_cpu, system_cpu, rss, read_bytes, written_bytes, voluntary, involuntary
+
+
+class ResourceSampler:
+    """Samples the resource usage of process `pid` into the time series `series_path` (see above)."""
+    def __init__(self, pid, series_path, interval=SAMPLE_INTERVAL):
+        self.pid = pid
+        self.series_path = Path(series_path)
+        self.interval = interval
+        self.start_time = None
+        self.rss_samples = []
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.start_time = time.time()
+        if not Path(f'/proc/{self.pid}').exists():
+            return  # No /proc here
+        with open(self.series_path, 'w', encoding='utf-8') as f:
+            f.write('\t'.join(RESOURCE_SERIES_COLUMNS) + '\n')
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _sample(self):
+        with open(self.series_path, 'a', encoding='utf-8') as f:
+            while True:
+                try:
+                    user_cpu, system_cpu, rss, read_bytes, written_bytes, voluntary, involuntary = (
+                        read_proc_sample(self.pid))
+                except (OSError, ValueError, IndexError):
+                    return  # Process is gone (or a zombie)
+                self.rss_samples.append(rss)
+                self.peak_rss = max(self.peak_rss, rss)
+                f.write('\t'.join([
+                    f'{time.time() - self.start_time:.1f}',
+                    f'{user_cpu}',
+                    f'{system_cpu}',
+                    f'{rss / _MIB:.1f}',
+                    '' if read_bytes is None else f'{read_bytes / _MIB:.1f}',
+                    '' if written_bytes is None else f'{written_bytes / _MIB:.1f}',
+                    f'{voluntary}',
+                    f'{involuntary}',
+                ]) + '\n')
+                f.flush()
+                if self._stop.wait(self.interval):
+                    return
+
+    def summary(self, rusage, wall_seconds):
+        """Dict from `RESOURCE_TIMING_COLUMNS` to values, from the sampled series and the `rusage` of the run."""
+        peak_rss = self.peak_rss
+        if rusage is not None:
+            # `ru_maxrss` is in KiB on Linux; block counts are in 512-byte units
+            peak_rss = max(peak_rss, rusage.ru_maxrss * 1024)
+            cpu_seconds = rusage.ru_utime + rusage.ru_stime
+        return {
+            'User CPU (s)': None if rusage is None else rusage.ru_utime,
+            'System CPU (s)': None if rusage is None else rusage.ru_stime,
+            'Mean CPU cores used': None if rusage is None or wall_seconds <= 0 else cpu_seconds / wall_seconds,
+            'Peak RSS (MiB)': peak_rss / _MIB if peak_rss else None,
+            'Mean RSS (MiB)': sum(self.rss_samples) / len(self.rss_samples) / _MIB if self.rss_samples else None,
+            'Read (MiB)': None if rusage is None else rusage.ru_inblock * 512 / _MIB,
+            'Written (MiB)': None if rusage is None else rusage.ru_oublock * 512 / _MIB,
+            'Voluntary context switches': None if rusage is None else rusage.ru_nvcsw,
+            'Involuntary context switches': None if rusage is None else rusage.ru_nivcsw,
+        }
+
+
+def wait_with_rusage(proc):
+    """
+    Waits for the `subprocess.Popen` `proc` to exit, and returns (its return code, its `resource.struct_rusage`,
+    or None where `os.wait4` isn't available).
+    """
+    if not hasattr(os, 'wait4'):
+        return proc.wait(), None
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)  # So that `proc` doesn't try to reap it again
+    return proc.returncode, rusage
+
+
+def resource_timing_fields(usage):
+    """Values of the `RESOURCE_TIMING_COLUMNS` for a `ResourceSampler.summary` (blank where unknown or None)."""
+    def field(value):
+        if value is None:
+            return ''
+        return f'{value:.1f}' if isinstance(value, float) else f'{value}'
+    return [field(None if usage is None else usage[column]) for column in RESOURCE_TIMING_COLUMNS]
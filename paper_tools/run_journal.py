@@ -0,0 +1,84 @@
+# Resumable batches of runs
+# =========================
+#
+# A batch of long runs (e.g., a Delphy run per epi week) keeps a journal of each run's state, so that re-invoking
+# an interrupted batch skips the runs that already finished and only redoes the others.  The journal is an
+# append-only TSV file with one line per state change:
+#
+#   time, key, state, inputs hash, note
+#
+# and the last line for a key wins.  States are `pending`, `running`, `done` and `failed`; a run left `running`
+# by a batch that died (machine restart, Ctrl-C, ...) counts as interrupted and is redone, as is a `failed` one.
+# The inputs hash covers the run's command line (bar flags that only affect its speed, like the number of threads;
+# see `delphy_runs.PERFORMANCE_FLAGS`) and the contents of its input files, so a run whose inputs have changed
+# since it finished is redone too.  Lines are flushed and fsync'ed as they're written, and a truncated
+# last line (from a crash mid-write) is cut off when the journal is next loaded.
+
+import datetime
+import hashlib
+import os
+from pathlib import Path
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+STATES = (PENDING, RUNNING, DONE, FAILED)
+
+JOURNAL_COLUMNS = ['time', 'key', 'state', 'inputs_hash', 'note']
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def inputs_hash(delphy_cli, input_paths):
+    """Hash of a command line and the contents of its input files."""
+    h = hashlib.sha256()
+    h.update('\0'.join(str(arg) for arg in delphy_cli).encode('utf-8'))
+    for path in input_paths:
+        h.update(b'\0' + file_sha256(path).encode('ascii'))
+    return h.hexdigest()
+
+
+class RunJournal:
+    """The journal of a batch of runs at `path` (created if missing)."""
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries = {}  # Key: run key (as str), Value: (state, inputs hash)
+        contents = self.path.read_bytes() if self.path.exists() else b''
+        complete = contents[:contents.rfind(b'\n') + 1]
+        if len(complete) < len(contents):
+            # Cut off a last line truncated by a crash, so that the next line appended doesn't get merged into it
+            with open(self.path, 'r+b') as f:
+                f.truncate(len(complete))
+        if not complete:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                f.write('\t'.join(JOURNAL_COLUMNS) + '\n')
+        for line in complete.decode('utf-8').split('\n')[1:-1]:  # Skip the header
+            fields = line.split('\t')
+            if len(fields) != len(JOURNAL_COLUMNS) or fields[2] not in STATES:
+                raise ValueError(f'{self.path} is corrupt: unexpected line {line!r}')
+            _, key, state, the_inputs_hash, _ = fields
+            self.entries[key] = (state, the_inputs_hash)
+
+    def state(self, key, the_inputs_hash):
+        """The last recorded state of run `key`, or None if it has none for these inputs."""
+        state, recorded_hash = self.entries.get(str(key), (None, None))
+        return state if recorded_hash == the_inputs_hash else None
+
+    def is_done(self, key, the_inputs_hash):
+        return self.state(key, the_inputs_hash) == DONE
+
+    def mark(self, key, state, the_inputs_hash, note=''):
+        if state not in STATES:
+            raise ValueError(f'Unknown run state {state}')
+        self.entries[str(key)] = (state, the_inputs_hash)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write('\t'.join([datetime.datetime.now().isoformat(), str(key), state, the_inputs_hash, note]) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
@@ -0,0 +1,189 @@
+# Live progress of Delphy runs
+# ============================
+#
+# Delphy runs last for hours, and all `run.py` used to learn about one was its total steps/s once it was over.
+# A `RunMonitor` thread instead tails the run's log file (`--v0-out-log-file`) as Delphy writes it.  Each line
+# starts with the step count (`Sample` column), so by noting the wall time at which lines show up, it tracks:
+#
+# * the current steps/s, over the last `RATE_WINDOW` seconds (and the mean since the start);
+# * an estimate of the time left, from the current steps/s and the steps still to go;
+# * a rolling trace of the posterior (the last `TRACE_LENGTH` log samples).
+#
+# Every `SNAPSHOT_INTERVAL` seconds, these are written out to a JSON status file (`<outputs>/status.json` for the
+# runs in `delphy_runs.py`), replaced atomically so it can be read at any time; the final snapshot also records the
+# run's exit code.  To spot runs that are going too slowly (and stop them early), look at their status files:
+#
+# Usage: python3 -m paper_tools.run_monitor <status.json or folder to search for them> ...
+
+import collections
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+SAMPLE_COLUMN = 'Sample'
+POSTERIOR_COLUMN = 'posterior_for_Delphy'
+
+POLL_INTERVAL = 5  # seconds
+SNAPSHOT_INTERVAL = 30  # seconds
+RATE_WINDOW = 300  # seconds
+TRACE_LENGTH = 200  # log samples
+
+
+class RunMonitor:
+    """Monitor of the Delphy run `key`, writing to log `log_path` until `total_steps` (see above)."""
+    def __init__(self, key, log_path, total_steps, status_path, poll_interval=POLL_INTERVAL,
+                 snapshot_interval=SNAPSHOT_INTERVAL, rate_window=RATE_WINDOW, trace_length=TRACE_LENGTH):
+        self.key = key
+        self.log_path = Path(log_path)
+        self.total_steps = total_steps
+        self.status_path = Path(status_path)
+        self.poll_interval = poll_interval
+        self.snapshot_interval = snapshot_interval
+        self.rate_window = rate_window
+
+        self.start_time = None
+        self.steps_done = 0
+        self.progress = collections.deque()  # (wall time, steps done), over the last `rate_window` seconds
+        self.posterior_trace = collections.deque(maxlen=trace_length)  # (steps done, posterior)
+
+        self._log_f = None
+        self._partial_line = ''
+        self._columns = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.start_time = time.time()
+        self.progress.append((self.start_time, 0))
+        self._thread = threading.Thread(target=self._monitor, daemon=True)
+        self._thread.start()
+
+    def stop(self, returncode, final_snapshot=True):
+        """Stops monitoring once the run is over, and writes the final snapshot."""
+        self._stop.set()
+        self._thread.join()
+        self._read_new_lines()
+        if self._log_f is not None:
+            self._log_f.close()
+        if final_snapshot:
+            self.write_snapshot(returncode)
+
+    # Tailing the log
+    # ---------------
+
+    def _read_new_lines(self):
+        if self._log_f is None:
+            try:
+                self._log_f = open(self.log_path, 'r', encoding='utf-8')
+            except FileNotFoundError:
+                return  # Not created yet
+        now = time.time()
+        chunk = self._log_f.read()
+        if not chunk:
+            return
+        lines = (self._partial_line + chunk).split('\n')
+        self._partial_line = lines.pop()  # Incomplete until it ends with a newline
+        for line in lines:
+            self._parse_line(line, now)
+        while len(self.progress) > 2 and self.progress[1][0] < now - self.rate_window:
+            self.progress.popleft()
+
+    def _parse_line(self, line, now):
+        if not line.strip() or line.startswith('#'):
+            return
+        fields = line.rstrip('\r').split('\t')
+        if self._columns is None:
+            self._columns = {name: i for i, name in enumerate(fields)}
+            return
+        try:
+            steps = int(fields[self._columns[SAMPLE_COLUMN]])
+        except (KeyError, IndexError, ValueError):
+            return
+        self.steps_done = steps
+        self.progress.append((now, steps))
+        if POSTERIOR_COLUMN in self._columns:
+            try:
+                self.posterior_trace.append((steps, float(fields[self._columns[POSTERIOR_COLUMN]])))
+            except (IndexError, ValueError):
+                pass
+
+    def _monitor(self):
+        last_snapshot = 0.0
+        while not self._stop.wait(self.poll_interval):
+            self._read_new_lines()
+            if time.time() - last_snapshot >= self.snapshot_interval:
+                self.write_snapshot()
+                last_snapshot = time.time()
+
+    # Snapshots
+    # ---------
+
+    def steps_per_second(self):
+        """(Steps/s over the last `rate_window` seconds, mean steps/s since the start); None when unknown."""
+        (t0, steps0), (t1, steps1) = self.progress[0], self.progress[-1]
+        recent = (steps1 - steps0) / (t1 - t0) if t1 > t0 and steps1 > steps0 else None
+        elapsed = t1 - self.start_time
+        mean = self.steps_done / elapsed if elapsed > 0 and self.steps_done > 0 else None
+        return recent, mean
+
+    def snapshot(self, returncode=None):
+        recent, mean = self.steps_per_second()
+        steps_left = max(0, self.total_steps - self.steps_done)
+        eta_seconds = steps_left / recent if recent else None
+        return {
+            'key': self.key,
+            'log_path': self.log_path.as_posix(),
+            'updated': datetime.datetime.now().isoformat(),
+            'start_time': datetime.datetime.fromtimestamp(self.start_time).isoformat(),
+            'finished': returncode is not None,
+            'returncode': returncode,
+            'steps_done': self.steps_done,
+            'total_steps': self.total_steps,
+            'fraction_done': self.steps_done / self.total_steps if self.total_steps else None,
+            'steps_per_second': recent,
+            'mean_steps_per_second': mean,
+            'eta_seconds': None if returncode is not None else eta_seconds,
+            'eta': (None if returncode is not None or eta_seconds is None
+                    else (datetime.datetime.now() + datetime.timedelta(seconds=eta_seconds)).isoformat()),
+            'posterior_trace': [list(point) for point in self.posterior_trace],
+        }
+
+    def write_snapshot(self, returncode=None):
+        tmp_path = self.status_path.with_name(self.status_path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(returncode), f, indent=1)
+            f.write('\n')
+        os.replace(tmp_path, self.status_path)
+
+
+def format_status(status):
+    """One-line summary of a status snapshot."""
+    def rate(x):
+        return '?' if x is None else f'{x:.4g}'
+    if status['finished']:
+        state = 'done' if status['returncode'] == 0 else f'FAILED (exit code {status["returncode"]})'
+    elif status['eta_seconds'] is None:
+        state = 'running, ETA unknown'
+    else:
+        state = f'running, ETA {status["eta"]} ({datetime.timedelta(seconds=round(status["eta_seconds"]))} left)'
+    fraction = status['fraction_done'] or 0.0
+    trace = status['posterior_trace']
+    posterior = f', posterior {trace[-1][1]:.6g}' if trace else ''
+    return (f'{status["key"]}: {fraction:6.1%} of {status["total_steps"]} steps, '
+            + f'{rate(status["steps_per_second"])} steps/s (mean {rate(status["mean_steps_per_second"])}){posterior}; '
+            + f'{state} [updated {status["updated"]}]')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.stderr.write("Usage: python3 -m paper_tools.run_monitor <status.json or folder to search for them> ...\n")
+        sys.exit(1)
+    for arg in sys.argv[1:]:
+        path = Path(arg)
+        for status_path in (sorted(path.rglob('status.json')) if path.is_dir() else [path]):
+            with open(status_path, 'r', encoding='utf-8') as f:
+                print(f'{status_path.parent.as_posix()}: {format_status(json.load(f))}')
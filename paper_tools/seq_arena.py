@@ -0,0 +1,77 @@
+# Compact in-memory store of many sequences
+# =========================================
+#
+# Keeping tens of thousands of genomes as separate Python objects costs an allocation and object header per
+# sequence, fragments the heap, and turns every write of a sequence into an encode-and-copy.  `SequenceArena`
+# instead packs the raw sequence bytes back to back into a few large, preallocated `bytearray` chunks, with an
+# index from key to (chunk, offset, length).  Lookups return zero-copy `memoryview` slices, which `FastaWriter`
+# (and `hashlib`) accept as they are.
+#
+# Chunks are never resized once allocated (a `bytearray` can't be resized while a `memoryview` of it is alive), so
+# sequences can be added at any time, even while views of earlier ones are in use.
+
+DEFAULT_CHUNK_SIZE = 16 << 20  # 16 MiB
+
+_LOWERCASE = bytes.maketrans(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ', b'abcdefghijklmnopqrstuvwxyz')
+
+
+def to_lowercase_bytes(seq):
+    """ASCII bytes of `seq` (`str` or bytes-like), lowercased."""
+    if isinstance(seq, str):
+        seq = seq.encode('ascii')
+    return bytes(seq).translate(_LOWERCASE)
+
+
+class SequenceArena:
+    """Sequences (`str` or bytes-like) stored as raw bytes, keyed by any hashable (e.g., accession IDs)."""
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self._chunks = []
+        self._used = 0  # Bytes used in the last chunk
+        self._index = {}  # Key: key, Value: (chunk number, offset, length)
+
+    def add(self, key, seq):
+        """Stores a copy of `seq` under `key` (replacing any earlier sequence under the same key)."""
+        if isinstance(seq, str):
+            seq = seq.encode('ascii')
+        n = len(seq)
+        if not self._chunks or self._used + n > len(self._chunks[-1]):
+            self._chunks.append(bytearray(max(self.chunk_size, n)))
+            self._used = 0
+        chunk = self._chunks[-1]
+        chunk[self._used:self._used+n] = seq
+        self._index[key] = (len(self._chunks) - 1, self._used, n)
+        self._used += n
+
+    def __getitem__(self, key):
+        """A read-only `memoryview` of the sequence under `key` (no copy is made)."""
+        chunk_num, offset, n = self._index[key]
+        return memoryview(self._chunks[chunk_num])[offset:offset+n].toreadonly()
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def keys(self):
+        return self._index.keys()
+
+    def items(self):
+        for key in self._index:
+            yield key, self[key]
+
+    def seq_str(self, key):
+        return self[key].tobytes().decode('ascii')
+
+    @property
+    def num_bytes(self):
+        """Total size of the stored sequences."""
+        return sum(n for _, _, n in self._index.values())
+
+    @property
+    def num_allocated_bytes(self):
+        return sum(len(chunk) for chunk in self._chunks)
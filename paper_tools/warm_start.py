@@ -0,0 +1,394 @@
+# Warm-starting a Delphy run from an earlier one
+# ==============================================
+#
+# The input of each week-by-week run is a superset of the previous week's, whose posterior has already been sampled.
+# Instead of starting from scratch, such a run can start from the last tree sampled by the previous run, with the
+# new tips grafted onto it, which spares it most of the burn-in.
+#
+# `.dphy` snapshots are in Delphy's own binary format, so the starting point is taken from the last tree in the
+# previous run's `.trees` file (NEXUS, with a `Translate` block and `[&...]` annotations, which are dropped).
+# Each new tip is grafted next to the old tip whose sequence is closest to its own (mismatches at polymorphic
+# sites, ignoring gaps and ambiguous bases), on the branch above it at the height where its date fits; old tips
+# that aren't in the new input are pruned.  Tip dates are taken from the FASTA ids (`<id>|<date>`), and the result
+# is written out as a plain, dated Newick tree with branch lengths in years.
+#
+# That tree is passed to Delphy with `INITIAL_TREE_FLAG`.  None of the runs in the paper (Delphy 1.0, build 2036;
+# see the README) use that flag, so it can't be taken for granted: `check_initial_tree_support` looks for it in the
+# Delphy binary's `--help` output, and `run.py --warm-start` refuses to start without it (otherwise, every warm run
+# after the first would fail, and the rest of the chain would be skipped).
+#
+# Usage: python3 -m paper_tools.warm_start <previous.trees> <new inputs.fasta> <initial tree.nwk>
+
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+from paper_tools.dates import NO_DAY, parse_date_ranges, decimal_years
+from paper_tools.fasta import read_fasta
+from paper_tools.run_monitor import POSTERIOR_COLUMN
+from paper_tools.seq_arena import to_lowercase_bytes
+
+# Delphy command-line flag for the initial tree of a run (see above)
+INITIAL_TREE_FLAG = '--v0-in-init-tree'
+
+# Warm-started runs skip the burn-in of the sequences they inherit, i.e., the fraction of a cold run's samples that
+# the analyses discard (30%, as in `sims/02_make_mccs.sh` and `sims/23_calc_essrates.py`)
+BURNIN_FRACTION = 0.30
+
+WARM_START_TIMING_COLUMNS = [
+    'Warm-started from',  # Empty for cold starts
+    'Cold-start steps',
+    'Steps saved',
+    'Posterior ESS',
+]
+
+_NEWICK_DELIMITERS = set('(),:;[')
+_DISTANCE_CHUNK_SIZE = 256  # New tips at a time when looking for their nearest old tips
+
+
+def check_initial_tree_support(path_to_delphy):
+    """Raises `SystemExit` unless the Delphy binary at `path_to_delphy` lists `INITIAL_TREE_FLAG` in its `--help`."""
+    try:
+        result = subprocess.run([str(path_to_delphy), '--help'], capture_output=True, text=True, timeout=60)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        raise SystemExit(f'Could not run {path_to_delphy} --help to check for {INITIAL_TREE_FLAG}: {e}')
+    if INITIAL_TREE_FLAG not in result.stdout + result.stderr:
+        raise SystemExit(f'{path_to_delphy} does not list {INITIAL_TREE_FLAG} in its --help output, '
+                         + 'so it cannot warm-start runs from an initial tree')
+
+
+# Trees
+# -----
+
+class TreeNode:
+    __slots__ = ('name', 'length', 'time', 'parent', 'children')
+
+    def __init__(self, parent=None, name='', length=0.0):
+        self.name = name
+        self.length = length  # Of the branch above the node
+        self.time = None  # In (decimal) years
+        self.parent = parent
+        self.children = []
+
+    def add_child(self, child):
+        child.parent = self
+        self.children.append(child)
+
+    def preorder(self):
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    def tips(self):
+        return [node for node in self.preorder() if not node.children]
+
+
+def _skip_comment(newick, i):
+    end = newick.find(']', i)
+    if end < 0:
+        raise ValueError('Unterminated [...] comment in Newick tree')
+    return end + 1
+
+
+def parse_newick(newick):
+    """Root `TreeNode` of a Newick tree; comments (like `[&mutations=...]`) are ignored."""
+    root = TreeNode()
+    node = root
+    i, n = 0, len(newick)
+    while i < n:
+        c = newick[i]
+        if c == '(':
+            child = TreeNode()
+            node.add_child(child)
+            node = child
+            i += 1
+        elif c == ',':
+            if node.parent is None:
+                raise ValueError(f'Unexpected "," at position {i} of Newick tree')
+            sibling = TreeNode()
+            node.parent.add_child(sibling)
+            node = sibling
+            i += 1
+        elif c == ')':
+            if node.parent is None:
+                raise ValueError(f'Unbalanced ")" at position {i} of Newick tree')
+            node = node.parent
+            i += 1
+        elif c == ':':
+            i += 1
+            while i < n and (newick[i].isspace() or newick[i] == '['):
+                i = _skip_comment(newick, i) if newick[i] == '[' else i + 1
+            start = i
+            while i < n and newick[i] not in _NEWICK_DELIMITERS:
+                i += 1
+            node.length = float(newick[start:i])
+        elif c == '[':
+            i = _skip_comment(newick, i)
+        elif c == ';':
+            break
+        elif c.isspace():
+            i += 1
+        elif c == "'":
+            end = newick.find("'", i + 1)
+            if end < 0:
+                raise ValueError('Unterminated quoted name in Newick tree')
+            node.name = newick[i+1:end]
+            i = end + 1
+        else:
+            start = i
+            while i < n and newick[i] not in _NEWICK_DELIMITERS:
+                i += 1
+            node.name = newick[start:i].strip()
+    if node is not root:
+        raise ValueError('Unbalanced "(" in Newick tree')
+    return root
+
+
+def _newick_name(name):
+    if any(c in name for c in " ():;,[]'"):
+        return "'" + name.replace("'", "''") + "'"
+    return name
+
+
+def format_newick(root):
+    """Newick string of a tree whose nodes all have times (branch lengths = differences in times)."""
+    parts = []
+    stack = [(root, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if node is None:
+            parts.append(',')
+        elif node.children and not children_done:
+            parts.append('(')
+            stack.append((node, True))
+            for k, child in enumerate(reversed(node.children)):
+                stack.append((child, False))
+                if k < len(node.children) - 1:
+                    stack.append((None, None))  # Comma between siblings
+        else:
+            if node.children:
+                parts.append(')')
+            parts.append(_newick_name(node.name))
+            if node.parent is not None:
+                parts.append(f':{node.time - node.parent.time:.10g}')
+    return ''.join(parts) + ';'
+
+
+def read_last_tree(trees_path):
+    """Root `TreeNode` of the last tree in a NEXUS trees file written by Delphy, with tip names translated."""
+    translate = {}
+    last_tree = None
+    in_translate = False
+    with open(trees_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            stripped = line.strip()
+            if in_translate:
+                for entry in stripped.rstrip(';').split(','):
+                    if entry.strip():
+                        number, name = entry.split(None, 1)
+                        translate[number] = name.strip()
+                in_translate = not stripped.endswith(';')
+            elif stripped.lower() == 'translate':
+                in_translate = True
+            elif stripped.lower().startswith('tree '):
+                last_tree = stripped
+    if last_tree is None:
+        raise ValueError(f'No trees found in {trees_path}')
+    root = parse_newick(last_tree[last_tree.index('=')+1:])
+    for tip in root.tips():
+        tip.name = translate.get(tip.name, tip.name)
+    return root
+
+
+def tip_date(fasta_id):
+    """The date part of a FASTA id `<id>|<date>` (in any of the formats of `dates.py`)."""
+    return fasta_id.rsplit('|', 1)[-1]
+
+
+def tip_times(names):
+    """Decimal years of the (midpoints of the) dates in `names` (NaN if missing)."""
+    min_days, max_days = parse_date_ranges([tip_date(name) for name in names])
+    mid_days = np.where(min_days == NO_DAY, NO_DAY, (min_days.astype(np.int64) + max_days) // 2)
+    return decimal_years(mid_days)
+
+
+def date_tree(root):
+    """Sets the `time` of every node from the branch lengths and the tip dates (which must be in years)."""
+    depth = {id(root): 0.0}
+    for node in root.preorder():
+        if node.parent is not None:
+            depth[id(node)] = depth[id(node.parent)] + node.length
+    tips = root.tips()
+    times = tip_times([tip.name for tip in tips])
+    dated = ~np.isnan(times)
+    if not np.any(dated):
+        raise ValueError('None of the tips of the tree have dates')
+    root_time = float(np.median(times[dated] - np.array([depth[id(tip)] for tip in tips])[dated]))
+    for node in root.preorder():
+        node.time = root_time + depth[id(node)]
+
+
+# Grafting
+# --------
+
+def prune_tips(root, names_to_keep):
+    """Removes the tips not in `names_to_keep` (and the nodes left with a single child); returns the new root."""
+    for tip in root.tips():
+        if tip.name in names_to_keep:
+            continue
+        node = tip
+        while node.parent is not None and len(node.parent.children) == 1:
+            node = node.parent  # Would be left childless too
+        if node.parent is None:
+            raise ValueError('None of the tips of the tree are kept')
+        parent = node.parent
+        parent.children.remove(node)
+        if len(parent.children) == 1:  # Splice out `parent`
+            only_child = parent.children[0]
+            if parent.parent is None:
+                only_child.parent = None
+                root = only_child
+            else:
+                grandparent = parent.parent
+                grandparent.children[grandparent.children.index(parent)] = only_child
+                only_child.parent = grandparent
+    return root
+
+
+def _sequence_matrix(seqs):
+    seqs = [to_lowercase_bytes(seq) for seq in seqs]
+    if len(set(len(seq) for seq in seqs)) > 1:
+        raise ValueError('Sequences must be aligned (all of the same length) to find nearest neighbours')
+    return np.frombuffer(b''.join(seqs), dtype=np.uint8).reshape(len(seqs), -1)
+
+
+def nearest_tips(new_seqs, old_seqs):
+    """For each of `new_seqs`, the index of the closest of `old_seqs` (mismatches between a/c/g/t only)."""
+    matrix = _sequence_matrix(list(new_seqs) + list(old_seqs))
+    bases = [np.uint8(ord(b)) for b in 'acgt']
+    is_base = [matrix == b for b in bases]
+    polymorphic = np.sum([np.any(x, axis=0) for x in is_base], axis=0) >= 2
+    one_hot = [x[:, polymorphic].astype(np.float32) for x in is_base]
+    known = sum(one_hot)
+    num_new = len(new_seqs)
+
+    result = np.empty(num_new, dtype=np.int64)
+    for start in range(0, num_new, _DISTANCE_CHUNK_SIZE):
+        end = min(start + _DISTANCE_CHUNK_SIZE, num_new)
+        comparable = known[start:end] @ known[num_new:].T
+        matches = sum(x[start:end] @ x[num_new:].T for x in one_hot)
+        result[start:end] = np.argmin(comparable - matches, axis=1)
+    return result
+
+
+def graft_tip(root, name, time, next_to):
+    """
+    Grafts a new tip `name` at `time` onto the branch above `next_to`, or above the ancestor of it where it fits in
+    time; returns the new root (which changes if the tip is older than the current root).
+    """
+    node = next_to
+    while node.parent is not None and node.parent.time >= time:
+        node = node.parent
+    junction = TreeNode()
+    if node.parent is None:
+        junction.time = min(node.time, time) - 1/365  # A new root, a day before either
+        root = junction
+    else:
+        junction.time = (node.parent.time + min(node.time, time)) / 2
+        parent = node.parent
+        parent.children[parent.children.index(node)] = junction
+        junction.parent = parent
+    junction.add_child(node)
+    tip = TreeNode(name=name)
+    tip.time = time
+    junction.add_child(tip)
+    return root
+
+
+def write_initial_tree(trees_path, fasta_path, out_path):
+    """
+    Writes to `out_path` the last tree of `trees_path` adapted to the sequences in `fasta_path` (see above).
+    Returns (number of tips grafted, number of tips pruned).
+    """
+    seqs = dict(read_fasta(fasta_path))
+    root = read_last_tree(trees_path)
+    date_tree(root)
+    old_names = set(tip.name for tip in root.tips())
+    num_pruned = len(old_names - seqs.keys())
+    root = prune_tips(root, seqs.keys())
+
+    kept_tips = root.tips()
+    new_names = [name for name in seqs if name not in old_names]
+    if new_names:
+        new_times = tip_times(new_names)
+        if np.any(np.isnan(new_times)):
+            raise ValueError(f'{fasta_path}: no date in FASTA id {new_names[int(np.argmax(np.isnan(new_times)))]}')
+        nearest = nearest_tips([seqs[name] for name in new_names], [seqs[tip.name] for tip in kept_tips])
+        for name, time, i in zip(new_names, new_times.tolist(), nearest.tolist()):
+            root = graft_tip(root, name, time, kept_tips[i])
+
+    tmp_path = f'{out_path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(format_newick(root) + '\n')
+    os.replace(tmp_path, out_path)
+    return len(new_names), num_pruned
+
+
+# Step budgets and convergence
+# ----------------------------
+
+def warm_num_steps(cold_num_steps, steps_per_seq, num_inherited_seqs):
+    """Step budget of a warm-started run that would take `cold_num_steps` from scratch."""
+    return max(steps_per_seq, cold_num_steps - round(BURNIN_FRACTION * steps_per_seq * num_inherited_seqs))
+
+
+def effective_sample_size(samples):
+    """ESS of a trace, from its autocorrelations summed up to Geyer's initial positive sequence cutoff."""
+    x = np.asarray(samples, dtype=float)
+    n = len(x)
+    if n < 2 or np.var(x) == 0:
+        return float(n)
+    x = x - x.mean()
+    spectrum = np.fft.rfft(x, 2*n)
+    acf = np.fft.irfft(spectrum * np.conj(spectrum))[:n]
+    acf /= acf[0]
+    tau = -1.0
+    for k in range(0, n - 1, 2):
+        pair_sum = acf[k] + acf[k+1]
+        if pair_sum <= 0:
+            break
+        tau += 2*pair_sum
+    return n / tau
+
+
+def posterior_ess(log_path, burnin=BURNIN_FRACTION):
+    """ESS of the posterior in a Delphy log file, after discarding the first `burnin` fraction of the samples."""
+    with open(log_path, 'r', encoding='utf-8') as f:
+        lines = (line for line in f if line.strip() and not line.startswith('#'))
+        header = next(lines).rstrip('\n').split('\t')
+        col = header.index(POSTERIOR_COLUMN)
+        values = [float(line.split('\t')[col]) for line in lines]
+    return effective_sample_size(values[int(burnin*len(values)):])
+
+
+def warm_start_timing_fields(warm_started_from, cold_num_steps, num_steps, log_path):
+    """Values of the `WARM_START_TIMING_COLUMNS` for a finished run."""
+    return [
+        f'{warm_started_from}',
+        f'{cold_num_steps}',
+        f'{cold_num_steps - num_steps}',
+        f'{posterior_ess(log_path)}',
+    ]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4:
+        sys.stderr.write("Usage: python3 -m paper_tools.warm_start <previous.trees> <new inputs.fasta> "
+                         "<initial tree.nwk>\n")
+        sys.exit(1)
+    num_grafted, num_pruned = write_initial_tree(sys.argv[1], sys.argv[2], sys.argv[3])
+    print(f'Wrote {sys.argv[3]}: grafted {num_grafted} new tips, pruned {num_pruned} old ones')
@@ -0,0 +1,362 @@
+# Work queue of Delphy runs on a shared filesystem
+# ================================================
+#
+# Spreads a batch of Delphy runs (e.g., the `--sim`/`--rep` runs of `sims/run.py`) over any number of worker
+# processes on any number of machines that share a filesystem (NFS, EFS, ...).  There's no server: the queue is a
+# directory, and workers coordinate only through files in it:
+#
+#   jobs/<job>.json         One descriptor per run (command line, thread & step counts, ...), written by `--enqueue`
+#   claims/<job>.lock       Created with O_EXCL by the worker running the job (so only one can claim it)
+#   done/<job>.json         Outcome of a successful run (worker, start & end times); its timing.tsv is written too
+#   failed/<job>.json       Outcome of a failed run (not retried until the job is enqueued again)
+#   workers/<worker>        Touched by each worker as it polls (lists the workers seen lately)
+#
+# While a job runs, its worker refreshes the mtime of its claim every `HEARTBEAT_INTERVAL` seconds.  A claim whose
+# heartbeat is older than `STALE_AFTER` seconds belongs to a dead worker (crashed, or its machine went away), and
+# is reclaimed by the next idle worker: it renames the lock out of the way (only one rename of a given file can
+# succeed), and claims the job afresh.  Should the original worker turn out to be alive after all, its next
+# heartbeat notices that its lock is gone, and it kills its run and moves on.  Ages are measured against mtimes
+# that the file server itself stamps, so clock skew between machines doesn't matter.
+#
+# Paths in the job descriptors are relative to the dataset folder the job was enqueued from, which is itself
+# recorded relative to the queue folder, so the shared filesystem can be mounted at different places on different
+# machines.  Workers pick the costliest jobs first, as in `delphy_runs.lpt_order`, and keep polling until every job
+# is done or failed (so that they can take over the jobs of workers that die).
+#
+# Workers only write each run's own `timing.tsv`.  Once they're done, `./run.py ... --collect <queue dir>` records
+# the runs that finished in the batch's journal (so that running the batch again locally doesn't redo them) and, for
+# the epi weeks, assembles `all_timing.tsv`.
+#
+# Usage: python3 -m paper_tools.work_queue worker <queue dir> [--path-to-delphy <delphy>] [--worker-id <id>]
+#        python3 -m paper_tools.work_queue status <queue dir>
+
+import argparse
+import ctypes
+import datetime
+import json
+import os
+import re
+import signal
+import socket
+import sys
+import time
+from pathlib import Path
+
+from paper_tools.delphy_runs import DelphyRun, clear_outputs, execute, set_inputs_hash, write_timing
+from paper_tools.run_journal import DONE
+
+HEARTBEAT_INTERVAL = 30  # seconds
+STALE_AFTER = 10 * HEARTBEAT_INTERVAL
+POLL_INTERVAL = 10  # seconds
+
+_SUBDIRS = ['jobs', 'claims', 'done', 'failed', 'workers']
+
+
+def _write_json_atomically(path, obj):
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, indent=2)
+        f.write('\n')
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def default_worker_id():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class WorkQueue:
+    """The work queue in folder `path` (created if missing)."""
+    def __init__(self, path):
+        self.path = Path(path).resolve()
+        for subdir in _SUBDIRS:
+            (self.path / subdir).mkdir(parents=True, exist_ok=True)
+
+    def _file(self, subdir, job_id, suffix='.json'):
+        return self.path / subdir / f'{job_id}{suffix}'
+
+    def _lock_path(self, job_id):
+        return self._file('claims', job_id, '.lock')
+
+    # Enqueueing
+    # ----------
+
+    def _job_of(self, run, cwd):
+        """(Job id, job descriptor) of `run`, whose paths are relative to `cwd`."""
+        cwd = Path(cwd).resolve()
+        job_id = re.sub(r'[^A-Za-z0-9_.-]+', '_', f'{cwd.name}-{run.outputs_path.as_posix()}')
+        job = {
+            'cwd': os.path.relpath(cwd, self.path),
+            'key': run.key,
+            'delphy_cli': run.delphy_cli,
+            'num_seqs': run.num_seqs,
+            'num_steps': run.num_steps,
+            'num_threads': run.num_threads,
+            'outputs_path': run.outputs_path.as_posix(),
+        }
+        return job_id, job
+
+    def enqueue(self, runs, cwd='.'):
+        """
+        Adds a job for each of `runs`, whose paths are relative to `cwd`.  Jobs already in the queue with the same
+        descriptor keep their outcome (so enqueueing a batch again only retries its failed runs).  Returns the job ids.
+        """
+        job_ids = []
+        for run in runs:
+            job_id, job = self._job_of(run, cwd)
+            job_path = self._file('jobs', job_id)
+            if job_path.exists() and _read_json(job_path) == job:
+                self._file('failed', job_id).unlink(missing_ok=True)
+            else:
+                _write_json_atomically(job_path, job)
+                self._file('done', job_id).unlink(missing_ok=True)
+                self._file('failed', job_id).unlink(missing_ok=True)
+            job_ids.append(job_id)
+        return job_ids
+
+    def collect(self, runs, journal, cwd='.'):
+        """
+        Records those of `runs` (enqueued from `cwd`) whose jobs finished successfully as done in `journal` (a
+        `run_journal.RunJournal`), so that running their batch again without the queue skips them.  Returns them.
+        """
+        collected = []
+        for run in runs:
+            set_inputs_hash(run)
+            job_id, job = self._job_of(run, cwd)
+            job_path = self._file('jobs', job_id)
+            if not (self._file('done', job_id).exists() and job_path.exists() and _read_json(job_path) == job):
+                continue
+            if not journal.is_done(run.key, run.inputs_hash):
+                journal.mark(run.key, DONE, run.inputs_hash, note=f'collected from {self.path.as_posix()}')
+            collected.append(run)
+        return collected
+
+    # State
+    # -----
+
+    def jobs(self):
+        """Dict from job id to job descriptor."""
+        return {p.stem: _read_json(p) for p in sorted((self.path / 'jobs').glob('*.json'))}
+
+    def is_finished(self, job_id):
+        return self._file('done', job_id).exists() or self._file('failed', job_id).exists()
+
+    def fs_now(self, worker_id):
+        """The file server's current time (the mtime it stamps on `workers/<worker_id>` as it's touched)."""
+        probe_path = self.path / 'workers' / worker_id
+        probe_path.touch()
+        return probe_path.stat().st_mtime
+
+    def claim_age(self, job_id, now):
+        """Seconds since the last heartbeat of the claim on `job_id`, or None if it's unclaimed."""
+        try:
+            return now - self._lock_path(job_id).stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    # Claiming
+    # --------
+
+    def try_claim(self, job_id, worker_id):
+        """Returns an open file descriptor of the new claim on `job_id`, or None if it's taken or finished."""
+        try:
+            fd = os.open(self._lock_path(job_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return None
+        os.write(fd, f'{worker_id}\n'.encode('utf-8'))
+        os.fsync(fd)
+        if self.is_finished(job_id):  # It finished between our look at it and our claim
+            self.release(job_id, fd)
+            return None
+        return fd
+
+    def reclaim_if_stale(self, job_id, worker_id, now, stale_after=STALE_AFTER):
+        """Claims `job_id` if its current claim's heartbeat is stale (see `try_claim`)."""
+        age = self.claim_age(job_id, now)
+        if age is None or age <= stale_after:
+            return None
+        lock_path = self._lock_path(job_id)
+        reclaimed_path = lock_path.with_name(f'{lock_path.name}.reclaimed-by-{worker_id}')
+        try:
+            os.rename(lock_path, reclaimed_path)
+        except FileNotFoundError:
+            return None  # Someone else got there first
+        if now - reclaimed_path.stat().st_mtime <= stale_after:
+            # A heartbeat came in just before the rename: hand the claim back, unless it's been taken since
+            try:
+                os.link(reclaimed_path, lock_path)
+            except FileExistsError:
+                pass
+            reclaimed_path.unlink()
+            return None
+        dead_worker = reclaimed_path.read_text(encoding='utf-8').strip()
+        reclaimed_path.unlink()
+        print(f'[{worker_id}] Reclaiming {job_id} from {dead_worker} (no heartbeat for {age:.0f} s)', flush=True)
+        return self.try_claim(job_id, worker_id)
+
+    def still_holds(self, job_id, fd):
+        try:
+            return os.stat(self._lock_path(job_id)).st_ino == os.fstat(fd).st_ino
+        except FileNotFoundError:
+            return False
+
+    def release(self, job_id, fd):
+        if self.still_holds(job_id, fd):
+            self._lock_path(job_id).unlink()
+        os.close(fd)
+
+    def record_outcome(self, job_id, worker_id, start_time, end_time, returncode):
+        outcome = {
+            'worker': worker_id,
+            'start_time': start_time.isoformat(),
+            'end_time': end_time.isoformat(),
+            'returncode': returncode,
+        }
+        _write_json_atomically(self._file('done' if returncode == 0 else 'failed', job_id), outcome)
+
+    def status(self):
+        """Dict from job id to one of 'pending', 'running', 'stale', 'done' or 'failed'."""
+        probe_id = f'{default_worker_id()}-status'
+        now = self.fs_now(probe_id)
+        result = {}
+        for job_id in self.jobs():
+            if self._file('done', job_id).exists():
+                result[job_id] = 'done'
+            elif self._file('failed', job_id).exists():
+                result[job_id] = 'failed'
+            else:
+                age = self.claim_age(job_id, now)
+                result[job_id] = 'pending' if age is None else 'running' if age <= STALE_AFTER else 'stale'
+        (self.path / 'workers' / probe_id).unlink(missing_ok=True)
+        return result
+
+
+# Workers
+# -------
+
+def run_of_job(job, path_to_delphy=None):
+    """The `DelphyRun` of a job descriptor (with paths relative to the job's `cwd`)."""
+    delphy_cli = list(job['delphy_cli'])
+    if path_to_delphy is not None:
+        delphy_cli[0] = str(path_to_delphy)
+    return DelphyRun(job['key'], delphy_cli, job['num_seqs'], job['num_steps'], job['num_threads'],
+                     job['outputs_path'])
+
+
+def _die_with_worker():
+    """
+    A `preexec_fn` that has Linux kill the run if its worker dies, so that it can't race with the run of whoever
+    reclaims the job (None elsewhere).  Other threads are running by the time the run is forked, so `prctl` is looked
+    up here, in the worker, and the child only calls it.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    prctl = ctypes.CDLL(None).prctl
+    PR_SET_PDEATHSIG = 1
+    sigkill = int(signal.SIGKILL)
+    return lambda: prctl(PR_SET_PDEATHSIG, sigkill)
+
+
+def _heartbeat(queue, job_id, fd, heartbeat_interval):
+    """Watchdog (see `delphy_runs.execute`) that keeps the claim on `job_id` alive, or kills the run if it's lost."""
+    def watchdog(proc, stop):
+        while not stop.wait(heartbeat_interval):
+            if not queue.still_holds(job_id, fd):
+                proc.terminate()
+                return True
+            os.utime(fd)
+        return not queue.still_holds(job_id, fd)  # E.g., this worker was suspended for a while
+    return watchdog
+
+
+def _run_job(queue, job_id, job, fd, worker_id, path_to_delphy, heartbeat_interval):
+    job_cwd = queue.path / job['cwd']
+    os.chdir(job_cwd)  # The job's paths are relative to it
+    run = run_of_job(job, path_to_delphy)
+    clear_outputs(run)  # E.g., left behind by a dead worker
+    run.outputs_path.mkdir(parents=True, exist_ok=True)
+
+    print(f'[{worker_id}] {datetime.datetime.now().isoformat()}: Running {job_id}', flush=True)
+    with open(run.outputs_path / 'delphy_output.txt', mode='wb') as out_f:
+        start_time, end_time, returncode, lost_claim = execute(
+            run, stdout=out_f, preexec_fn=_die_with_worker(), watchdog=_heartbeat(queue, job_id, fd, heartbeat_interval))
+
+    if lost_claim:
+        print(f'[{worker_id}] Lost the claim on {job_id} to another worker, abandoned it', flush=True)
+        os.close(fd)
+        return
+    if returncode == 0:
+        write_timing(run, start_time, end_time)
+    queue.record_outcome(job_id, worker_id, start_time, end_time, returncode)
+    queue.release(job_id, fd)
+    outcome = 'Finished' if returncode == 0 else f'FAILED (exit code {returncode})'
+    print(f'[{worker_id}] {end_time.isoformat()}: {outcome} {job_id}, took {(end_time - start_time).total_seconds()} s',
+          flush=True)
+
+
+def run_worker(queue, worker_id=None, path_to_delphy=None, heartbeat_interval=HEARTBEAT_INTERVAL,
+               stale_after=STALE_AFTER, poll_interval=POLL_INTERVAL):
+    """Runs jobs from `queue` (a `WorkQueue`) until all of them are done or failed."""
+    worker_id = worker_id or default_worker_id()
+    start_dir = os.getcwd()
+    if path_to_delphy is not None and os.sep in str(path_to_delphy):
+        path_to_delphy = Path(path_to_delphy).resolve()  # Jobs run in their own folders
+    try:
+        while True:
+            jobs = queue.jobs()
+            unfinished = [job_id for job_id in jobs if not queue.is_finished(job_id)]
+            if not unfinished:
+                print(f'[{worker_id}] No jobs left', flush=True)
+                return
+            unfinished.sort(key=lambda job_id: jobs[job_id]['num_steps'] / jobs[job_id]['num_threads'], reverse=True)
+
+            now = queue.fs_now(worker_id)
+            for job_id in unfinished:
+                fd = queue.try_claim(job_id, worker_id)
+                if fd is None:
+                    fd = queue.reclaim_if_stale(job_id, worker_id, now, stale_after)
+                if fd is not None:
+                    _run_job(queue, job_id, jobs[job_id], fd, worker_id, path_to_delphy, heartbeat_interval)
+                    os.chdir(start_dir)
+                    break
+            else:
+                time.sleep(poll_interval)  # Everything left is being run by others
+    finally:
+        os.chdir(start_dir)
+        (queue.path / 'workers' / worker_id).unlink(missing_ok=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Work queue of Delphy runs on a shared filesystem')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    worker_parser = subparsers.add_parser('worker', help='Run jobs until all of them are done or failed')
+    worker_parser.add_argument('queue', help='Queue folder')
+    worker_parser.add_argument('--path-to-delphy', help='Delphy binary on this machine (default: as enqueued)')
+    worker_parser.add_argument('--worker-id', help='Name of this worker (default: <hostname>-<pid>)')
+    worker_parser.add_argument('--heartbeat-interval', type=float, default=HEARTBEAT_INTERVAL,
+                               help=f'Seconds between heartbeats (default: {HEARTBEAT_INTERVAL})')
+    worker_parser.add_argument('--stale-after', type=float, default=STALE_AFTER,
+                               help=f'Seconds without a heartbeat before a job is reclaimed (default: {STALE_AFTER})')
+    worker_parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL,
+                               help=f'Seconds between looks for new work when idle (default: {POLL_INTERVAL})')
+    status_parser = subparsers.add_parser('status', help='Show the state of every job')
+    status_parser.add_argument('queue', help='Queue folder')
+    args = parser.parse_args()
+
+    if not Path(args.queue).exists():
+        sys.stderr.write(f'Queue folder {args.queue} not found\n')
+        sys.exit(1)
+    queue = WorkQueue(args.queue)
+    if args.command == 'worker':
+        run_worker(queue, args.worker_id, args.path_to_delphy, args.heartbeat_interval, args.stale_after,
+                   args.poll_interval)
+    else:
+        status = queue.status()
+        for job_id, state in status.items():
+            print(f'{state:8} {job_id}')
+        counts = {state: list(status.values()).count(state) for state in sorted(set(status.values()))}
+        print(', '.join(f'{n} {state}' for state, n in counts.items()) or 'No jobs')
@@ -0,0 +1,113 @@
+# Declarative rewriting of large XML documents (e.g., BEAST XMLs)
+# ===============================================================
+#
+# Pruning a BEAST XML down to a subset of taxa and models by hand means dozens of `findall` scans and
+# `x not in some_list` tests, which gets quadratic in the number of taxa.  Instead, we describe the edits as a
+# list of `Rule`s and apply all of them in a single top-down traversal of the tree:
+#
+# * a rule is keyed on the path of the parent element (tags from the root, e.g. `mcmc/joint/prior`; `.` for the
+#   root itself) and the tag of the child, so finding the rules for an element is a single dict lookup;
+# * its optional `match(elem, parent)` predicate further selects elements (use sets, not lists, for membership);
+# * its action is either `REMOVE` (drop the element and its whole subtree) or a function `action(elem, parent)`
+#   that edits the element in place (rename it, change attributes, ...).
+#
+# Several rules may apply to the same element; they're tried in order, and a `REMOVE` ends the list.  Rules are
+# matched against the element as it was *before* any action, so a renaming action doesn't change which later rules
+# apply.  Removals rebuild each parent's list of children once, rather than calling `remove` per child.
+#
+# `XmlIndex` maps ids to elements and elements to their parents, so that edits elsewhere don't need to search the
+# tree either.
+
+from collections import defaultdict, namedtuple
+
+Rule = namedtuple('Rule', ['path', 'tag', 'match', 'action'])
+
+REMOVE = 'remove'
+
+
+def child_idref(elem, *tags):
+    """The `idref` attribute of the child of `elem` at the given chain of tags (e.g., 'ctmcScale', 'parameter'),
+    or None if there isn't one."""
+    for tag in tags:
+        elem = elem.find(tag)
+        if elem is None:
+            return None
+    return elem.get('idref')
+
+
+# Common predicates and actions
+# -----------------------------
+
+def has_id(*ids):
+    ids = frozenset(ids)
+    return lambda elem, parent: elem.get('id') in ids
+
+
+def has_idref(*idrefs):
+    idrefs = frozenset(idrefs)
+    return lambda elem, parent: elem.get('idref') in idrefs
+
+
+def has_label(*labels):
+    labels = frozenset(labels)
+    return lambda elem, parent: elem.get('label') in labels
+
+
+def child_has_idref(tags, idrefs):
+    """Matches elements whose child at the chain of tags `tags` (see `child_idref`) has an idref in `idrefs`."""
+    return lambda elem, parent: child_idref(elem, *tags) in idrefs
+
+
+def rename(tag):
+    def action(elem, parent):
+        elem.tag = tag
+    return action
+
+
+def rename_child(child_tag, tag):
+    def action(elem, parent):
+        elem.find(child_tag).tag = tag
+    return action
+
+
+def apply_rules(root, rules):
+    """Applies `rules` to the tree under `root` in one top-down traversal."""
+    rules_by_key = defaultdict(list)
+    for rule in rules:
+        rules_by_key[(rule.path, rule.tag)].append(rule)
+
+    stack = [(root, '.')]
+    while stack:
+        parent, path = stack.pop()
+        kept = []
+        changed = False
+        for child in parent:
+            tag = child.tag
+            removed = False
+            for rule in rules_by_key.get((path, tag), ()):
+                if rule.match is None or rule.match(child, parent):
+                    if rule.action is REMOVE:
+                        removed = True
+                        break
+                    rule.action(child, parent)
+            if removed:
+                changed = True
+            else:
+                kept.append(child)
+                stack.append((child, tag if path == '.' else f'{path}/{tag}'))
+        if changed:
+            parent[:] = kept
+
+
+class XmlIndex:
+    """One-pass index of an XML tree: `by_id` maps ids to elements and `parent` maps elements to their parent."""
+    def __init__(self, root):
+        self.root = root
+        self.by_id = {}
+        self.parent = {}
+        for elem in root.iter():
+            for child in elem:
+                self.parent[child] = elem
+            the_id = elem.get('id')
+            if the_id is not None:
+                self.by_id.setdefault(the_id, elem)  # First definition wins, as for `find`
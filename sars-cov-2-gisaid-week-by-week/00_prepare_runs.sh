@@ -2,5 +2,10 @@
 
 set -x
 
-./extract_data.py --mode submissionDate
-./extract_data.py --mode collectionDate
+# One-time recompression of the GISAID dump into independently decompressible blocks, with a per-record index,
+# so that extract_data.py only needs to decompress the blocks with sequences that pass metadata QC (redone only if
+# the dump has changed since)
+PYTHONPATH=.. python3 -m paper_tools.fasta_index --unless-current 20200331.fasta.xz 20200331.blocked.fasta.xz
+
+# Both modes share one pass over the metadata, sequences and alignments
+./extract_data.py --mode both
@@ -1,31 +1,23 @@
 #!/usr/bin/env python
 
-import csv
 import baltic as bt
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
 from pathlib import Path
 import subprocess
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))  # For `paper_tools`
+from paper_tools.gisaid_metadata import load_gisaid_metadata
 
 # Read in metadata
 # ===========================
 print("\nReading in metadata...")
-def sanitizeTabs(s):
-    return s.replace("\t", " ")  # Avoid CSV pain
-
-sample_id_2_geo0 = {}
-with open('metadata_20200331.tsv', 'r') as f:
-    ff = csv.reader(f, delimiter='\t')
-    header = None
-    for row in ff:
-        if not header:
-            header = row
-            continue
-        
-        virusName, accessionId, collectionDate, location, additionalLocationInfo, seqLength, host, submissionDate = row
-
-        sample_id_2_geo0[f'{accessionId}'] = \
-            sanitizeTabs(location).split(' / ')[0]
+gisaidMetadata = load_gisaid_metadata('metadata_20200331.tsv')
+sample_id_2_geo0 = {
+    accessionId: location.split(' / ')[0]
+    for accessionId, location in zip(gisaidMetadata.accession_id.tolist(), gisaidMetadata.location.tolist())
+}
 
 geo0_to_simple_geo0 = {
     'Asia':          'Asia',
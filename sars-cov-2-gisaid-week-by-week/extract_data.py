@@ -1,42 +1,68 @@
 #!/usr/bin/env python3
 
 import argparse
-import lzma
-import csv
-import re
-import gzip
 import datetime
 from collections import defaultdict
 from pathlib import Path
 import subprocess
 import random
+import sys
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))  # For `paper_tools`
+from paper_tools.align import AlignmentCache, align_missing, align_to_reference
+from paper_tools.dates import day_number
+from paper_tools.dedup import SequenceGroups
+from paper_tools.fasta import read_fasta, FastaWriter
+from paper_tools.fasta_index import IndexedFasta, has_index
+from paper_tools.files import copy_file
+from paper_tools.gisaid_metadata import load_gisaid_metadata
+from paper_tools.masking import mask_fasta, mask_tails
+from paper_tools.seq_arena import SequenceArena, to_lowercase_bytes
 
 # Config
 # ======
 MODE_SUBMITTED_BY_DATE = 'submissionDate'
 MODE_COLLECTED_BY_DATE = 'collectionDate'
+MODE_BOTH = 'both'
 
 parser = argparse.ArgumentParser(description="Prepare Delphy runs for first N weeks of SARS-CoV-2")
-parser.add_argument('--mode', help='Include samples in run if _this_ date is on or before CDC epi week N',
-                    required=True, choices=[MODE_SUBMITTED_BY_DATE, MODE_COLLECTED_BY_DATE])
+parser.add_argument('--mode', help='Include samples in run if _this_ date is on or before CDC epi week N '
+                    + f'("{MODE_BOTH}" prepares the inputs for both modes in a single pass)',
+                    required=True, choices=[MODE_SUBMITTED_BY_DATE, MODE_COLLECTED_BY_DATE, MODE_BOTH])
 
 args = parser.parse_args()
     
 path_to_mafft = Path("../mafft")
 
-if args.mode == MODE_SUBMITTED_BY_DATE:
-    min_submission_date = datetime.datetime(2019, 12,  1)
-    max_submission_date = datetime.datetime(2020,  3, 28)  # end of CDC epi week 2020-13
-    
-    min_collection_date = datetime.datetime(2019, 12,  1)
-    max_collection_date = max_submission_date
-    
-elif args.mode == MODE_COLLECTED_BY_DATE:
-    min_submission_date = datetime.datetime(2019, 12,  1)
-    max_submission_date = datetime.datetime(2024, 12, 31)  # Allow anything!
+# With `--mode both`, the metadata, sequences, QC and alignments are shared, and only the split into epi weeks
+# and the output files differ between the modes
+if args.mode == MODE_BOTH:
+    modes = [MODE_SUBMITTED_BY_DATE, MODE_COLLECTED_BY_DATE]
+else:
+    modes = [args.mode]
 
-    min_collection_date = datetime.datetime(2019, 12,  1)
-    max_collection_date = datetime.datetime(2020,  3,  7)  # end of CDC epi week 2020-10
+dateRanges = {}  # Key: mode, Value: {min/max_submission_date, min/max_collection_date}
+dateRanges[MODE_SUBMITTED_BY_DATE] = {
+    'min_submission_date': datetime.datetime(2019, 12,  1),
+    'max_submission_date': datetime.datetime(2020,  3, 28),  # end of CDC epi week 2020-13
+
+    'min_collection_date': datetime.datetime(2019, 12,  1),
+    'max_collection_date': datetime.datetime(2020,  3, 28),  # = max_submission_date
+}
+dateRanges[MODE_COLLECTED_BY_DATE] = {
+    'min_submission_date': datetime.datetime(2019, 12,  1),
+    'max_submission_date': datetime.datetime(2024, 12, 31),  # Allow anything!
+
+    'min_collection_date': datetime.datetime(2019, 12,  1),
+    'max_collection_date': datetime.datetime(2020,  3,  7),  # end of CDC epi week 2020-10
+}
+
+inputsPaths = {
+    MODE_SUBMITTED_BY_DATE: Path('inputs_by_submission_date'),
+    MODE_COLLECTED_BY_DATE: Path('inputs_by_collection_date'),
+}
 
 
 # The tail ends of a genome are hard to sequence.  These crude parameters are from Lemieux et al 2021.
@@ -50,66 +76,9 @@ min_seq_len = 20000
 
 
 
-metadata = {}  # Key: Accession ID, Value: {virusName, collectionDate, location, length, host, submissionDate}
-virusName2AccessionId = {}
-
-def sanitizeTabs(s):
-    return s.replace("\t", " ")  # Avoid CSV pain
-
-with open('metadata_20200331.tsv', 'r') as f:
-    ff = csv.reader(f, delimiter='\t')
-    header = None
-    for row in ff:
-        if not header:
-            header = row
-            continue
-        
-        virusName, accessionId, collectionDate, location, additionalLocationInfo, seqLength, host, submissionDate = row
-        assert accessionId not in metadata;
-        metadata[accessionId] = {
-            'virusName': sanitizeTabs(virusName),
-            'collectionDate': sanitizeTabs(collectionDate),
-            'location': sanitizeTabs(location),
-            'length': int(seqLength),
-            'host': sanitizeTabs(host),
-            'submissionDate': sanitizeTabs(submissionDate)
-        }
-        virusName2AccessionId[virusName] = accessionId
-
-# Filter out anything with an imprecise collectionDate or a date outside [min_collection_date, max_collection_date]
-dateRE = re.compile(r'(\d\d\d\d)\-(\d\d)\-(\d\d)')
-def isCollectionDateGood(collectionDate):
-    if len(collectionDate) != len('YYYY-MM-DD'):
-        return False
-    m = dateRE.match(collectionDate)
-    if not m:
-        return False
-
-    dt = datetime.datetime(int(m.group(1)), int(m.group(2)), int(m.group(3)))
-    
-    return min_collection_date <= dt <= max_collection_date
-        
-# Filter out anything with an imprecise submissionDate or a date outside [min_submission_date, max_submission_date]
-def isSubmissionDateGood(submissionDate):
-    if len(submissionDate) != len('YYYY-MM-DD'):
-        return False
-    m = dateRE.match(submissionDate)
-    if not m:
-        return False
-
-    dt = datetime.datetime(int(m.group(1)), int(m.group(2)), int(m.group(3)))
-    
-    return min_submission_date <= dt <= max_submission_date
-
-# Produce a set of accession IDs which pass very basic filters
-interestingAccessionIDs = set()
-for accessionId, info in metadata.items():
-    if (info['host'] == 'Human' and
-        info['length'] >= min_seq_len and
-        isCollectionDateGood(info['collectionDate']) and
-        isSubmissionDateGood(info['submissionDate'])):
-        
-        interestingAccessionIDs.add(accessionId)
+# Read in metadata (from a columnar cache of `metadata_20200331.tsv`, built on first use; see `gisaid_metadata.py`)
+gisaidMetadata = load_gisaid_metadata('metadata_20200331.tsv')
+virusName2AccessionId = dict(zip(gisaidMetadata.virus_name.tolist(), gisaidMetadata.accession_id.tolist()))
 
 # Filter out a few known-bad genomes (including them completely distorts the tree)
 #
@@ -261,174 +230,193 @@ badAccessionIDs = [
         'EPI_ISL_2758213',  # [6] - ** - hCoV-19/India/un-IRSHA-CD210929/2020 - India/un-IRSHA-CD210929/2020 in NS-2021-06-05
 ]
 
-for badAccessionID in badAccessionIDs:
-    interestingAccessionIDs.discard(badAccessionID)
-
-print(f'INFO: {len(interestingAccessionIDs)} sequences pass QC and have precise collection and submission dates:')
-print(f'INFO:  - Host is Human')
-print(f'INFO:  - Sequence length >= {min_seq_len}')
-print(f'INFO:  - Collection date in range [{min_collection_date}, {max_collection_date}]')
-print(f'INFO:  - Submission date in range [{min_submission_date}, {max_submission_date}]')
-
-# Prepare input data folder (BAIL if it's there instead of overwriting data)
-if args.mode == MODE_SUBMITTED_BY_DATE:
-    inputs_path = Path('inputs_by_submission_date')
-else:
-    inputs_path = Path('inputs_by_collection_date')
-inputs_path.mkdir(parents=True, exist_ok=False)  # Bail out if this exists
+# Produce a set of accession IDs for each mode which pass very basic filters:
+# - Host is Human
+# - Sequence length >= min_seq_len
+# - Precise collectionDate in range [min_collection_date, max_collection_date]
+# - Precise submissionDate in range [min_submission_date, max_submission_date]
+# - Not a known-bad genome
+isGoodSample = (gisaidMetadata.host == 'Human') & (gisaidMetadata.length >= min_seq_len)
+isInterestingInAnyMode = np.zeros(len(gisaidMetadata), dtype=bool)
+interestingAccessionIDsByMode = {}  # Key: mode, Value: set of accession IDs
+for mode in modes:
+    r = dateRanges[mode]
+    isInteresting = (isGoodSample &
+                     (gisaidMetadata.collection_day >= day_number(r['min_collection_date'])) &
+                     (gisaidMetadata.collection_day <= day_number(r['max_collection_date'])) &
+                     (gisaidMetadata.submission_day >= day_number(r['min_submission_date'])) &
+                     (gisaidMetadata.submission_day <= day_number(r['max_submission_date'])))
+    isInterestingInAnyMode |= isInteresting
     
-# Read in interesting sequences
-def read_fasta(f):
-    inSequence = False
-    curFastaId = ''
-    curSequence = ''
-    for line in f:
-        if type(line) != str:
-            line = line.decode('utf-8')
-        if not line.strip():
-            continue
-        if inSequence and line[0] == '>':
-            yield (curFastaId, curSequence)
-            inSequence = False
-        if inSequence:
-            curSequence += line.strip()
-        else:
-            if line[0] != '>':
-                raise ValueError(f"Expecting FASTA ID line, found {line}")
-            curFastaId = line[1:].strip()
-            curSequence = ''
-            inSequence = True
-    if inSequence and curSequence:
-        yield (curFastaId, curSequence)
+    modeAccessionIDs = set(gisaidMetadata.accession_id[isInteresting].tolist())
+    modeAccessionIDs.difference_update(badAccessionIDs)
+    interestingAccessionIDsByMode[mode] = modeAccessionIDs
+
+    print(f'INFO: {len(modeAccessionIDs)} sequences pass QC and have precise collection and submission dates:')
+    print(f'INFO:  - Host is Human')
+    print(f'INFO:  - Sequence length >= {min_seq_len}')
+    print(f'INFO:  - Collection date in range [{r["min_collection_date"]}, {r["max_collection_date"]}]')
+    print(f'INFO:  - Submission date in range [{r["min_submission_date"]}, {r["max_submission_date"]}]')
+
+metadata = {}  # Key: Accession ID, Value: {virusName, collectionDate, location, length, host, submissionDate,
+               #                            submissionEpiWeek, collectionEpiWeek}
+for row in gisaidMetadata.rows(isInterestingInAnyMode):
+    metadata[row['accession_id']] = {
+        'virusName': row['virus_name'],
+        'collectionDate': row['collection_date'],
+        'location': row['location'],
+        'length': row['length'],
+        'host': row['host'],
+        'submissionDate': row['submission_date'],
+        'submissionEpiWeek': row['submission_epi_week'],
+        'collectionEpiWeek': row['collection_epi_week'],
+    }
+interestingAccessionIDs = set.union(*interestingAccessionIDsByMode.values())
+
+# Prepare input data folders (BAIL if they're there instead of overwriting data)
+for mode in modes:
+    inputsPaths[mode].mkdir(parents=True, exist_ok=False)  # Bail out if this exists
     
-sequences = {}  # Key: AccessionID, Value: Raw Unaligned Sequence
-with lzma.open('20200331.fasta.xz', mode='rt', encoding='utf-8') as f:
-    numRead = 0
-    for fastaId, seq in read_fasta(f):
+# Read in interesting sequences
+#
+# If the indexed copy of the GISAID dump is available and up to date (built by `00_prepare_runs.sh`), only the
+# blocks containing sequences that pass the metadata filters above are decompressed
+raw_fasta_path = Path('20200331.fasta.xz')
+blocked_fasta_path = Path('20200331.blocked.fasta.xz')
+if has_index(blocked_fasta_path, source_path=raw_fasta_path):
+    print(f'INFO: Reading sequences from indexed {blocked_fasta_path.as_posix()}')
+    def isInterestingFastaId(fastaId):
         virusName, _ = fastaId.split('|', maxsplit=1)
-        accessionId = virusName2AccessionId[virusName]
-        if accessionId in interestingAccessionIDs:
-            
-            # Discard very low quality sequences
-            
-            if len(seq) != metadata[accessionId]['length']:
-                print(f"WARNING: Dropping {accessionId} = {metadata[accessionId]['virusName']}, actual length {len(seq)} doesn't match length in metadata {metadata[accessionId]['length']}")
-                interestingAccessionIDs.discard(accessionId)
-                continue
-
-            seq = seq.lower()
-            if (seq.count('n') + seq.count('-')) > (len(seq) // 10):
-                print(f'WARNING: Dropping {accessionId} = {metadata[accessionId]["virusName"]}, more than 10% missing')
-                interestingAccessionIDs.discard(accessionId)
-                continue
-            
-            sequences[accessionId] = seq
-            numRead += 1
-            print(f'({numRead} / {len(interestingAccessionIDs)}) Read {accessionId} = {metadata[accessionId]["virusName"]}')
-
-
+        return virusName2AccessionId.get(virusName) in interestingAccessionIDs
+    rawRecords = IndexedFasta(blocked_fasta_path).read_fasta(select=isInterestingFastaId)
+else:
+    print(f'INFO: Reading sequences from {raw_fasta_path.as_posix()} (no up-to-date index found)')
+    rawRecords = read_fasta(raw_fasta_path)
+
+# Sequences are kept as lowercase bytes, packed together in an arena (see `seq_arena.py`), and written out to the
+# weekly files below as zero-copy views
+sequences = SequenceArena()  # Key: AccessionID, Value: Raw Unaligned Sequence
+numRead = 0
+for fastaId, seq in rawRecords:
+    virusName, _ = fastaId.split('|', maxsplit=1)
+    accessionId = virusName2AccessionId[virusName]
+    if accessionId in interestingAccessionIDs:
+        
+        # Discard very low quality sequences
+        
+        if len(seq) != metadata[accessionId]['length']:
+            print(f"WARNING: Dropping {accessionId} = {metadata[accessionId]['virusName']}, actual length {len(seq)} doesn't match length in metadata {metadata[accessionId]['length']}")
+            interestingAccessionIDs.discard(accessionId)
+            continue
 
-# Split out sequences into CDC epi weeks according to submission date
-def epiWeek(dateStr):
-    m = dateRE.match(dateStr)
-    if not m:
-        raise ValueError(f'Not a precise ISO-8601 date: {dateStr}')
-    year = int(m.group(1))
-    month = int(m.group(2))
-    day = int(m.group(3))
+        seq = to_lowercase_bytes(seq)
+        if (seq.count(b'n') + seq.count(b'-')) > (len(seq) // 10):
+            print(f'WARNING: Dropping {accessionId} = {metadata[accessionId]["virusName"]}, more than 10% missing')
+            interestingAccessionIDs.discard(accessionId)
+            continue
+        
+        sequences.add(accessionId, seq)
+        numRead += 1
+        print(f'({numRead} / {len(interestingAccessionIDs)}) Read {accessionId} = {metadata[accessionId]["virusName"]}')
 
-    d = datetime.datetime(year, month, day)
 
-    # Find end of epi week
-    weekday = d.weekday()        # 0 = Monday, ..., 6 = Sunday
-    weekday = (weekday + 1) % 7  # 0 = Sunday, ..., 6 = Saturday
 
-    endOfEpiWeek = d + datetime.timedelta(days=6-weekday)  # CDC Epi Weeks end on a Saturday
+for accessionId in sorted(interestingAccessionIDs):
+    if accessionId not in sequences:
+        print(f'WARNING: Skipping {accessionId}, no sequence found (not just dropped owing to QC)')
 
-    return endOfEpiWeek.year*100 + ((endOfEpiWeek - datetime.datetime(endOfEpiWeek.year, 1, 1)).days // 7 + 1)
-    
-interestingAccessionIDsByEpiWeek = defaultdict(set)  # Key: Epi week, e.g., 202043; Value: set of accession IDs
-for accessionId in interestingAccessionIDs:
-    info = metadata[accessionId]
-    if args.mode == MODE_SUBMITTED_BY_DATE:
-        week = epiWeek(info['submissionDate'])
-    else:
-        week = epiWeek(info['collectionDate'])
-    interestingAccessionIDsByEpiWeek[week].add(accessionId)
-
-for week in sorted(interestingAccessionIDsByEpiWeek.keys()):
-    seq_type = 'submissions' if args.mode == MODE_SUBMITTED_BY_DATE else 'collections'
-    print(f'INFO: In epi week {week}, there were {len(interestingAccessionIDsByEpiWeek[week])} {seq_type}')
-
-# Produce unaligned FASTA and metadata files for all the weeks
-for week in sorted(interestingAccessionIDsByEpiWeek.keys()):
-    print(f'INFO: Preparing data for epi week {week}')
-    week_path = inputs_path / f'to_epi_week_{week}'
-    week_path.mkdir(parents=True, exist_ok=False)  # Bail out if exists
-
-    unaligned_fasta_path = week_path / f'to_epi_week_{week}_unaligned.fasta'
-    metadata_path = week_path / f'to_epi_week_{week}.tsv'
-    with open(unaligned_fasta_path, 'w') as ff:
-        with open(metadata_path, 'w') as fm:
-            fm.write('id\t' + '\t'.join(f'locLevel{n+1}' for n in range(6)) + '\n')
-
-            selectedIds = set()
-            for accessionId in interestingAccessionIDs:
-                if accessionId not in sequences:
-                    print(f'WARNING: Skipping {accessionId}, no sequence found (not just dropped owing to QC)')
-                else:
-                    if ((args.mode == MODE_SUBMITTED_BY_DATE and epiWeek(metadata[accessionId]['submissionDate']) <= week)
-                        or
-                        (args.mode == MODE_COLLECTED_BY_DATE and epiWeek(metadata[accessionId]['collectionDate']) <= week)):
-                        
-                        selectedIds.add(accessionId)
-                    
-
-            for accessionId in selectedIds:
-                ff.write(f">{accessionId}|{metadata[accessionId]['collectionDate']}")
-                ff.write('\n')
-                ff.write(sequences[accessionId])
-                ff.write('\n')
+# Set up alignment against the NC_045512.2 reference genome in sars-cov-2-lemieux
+#
+# With `--keeplength`, mafft aligns every sequence to the reference independently of the others, so each distinct
+# genome is aligned only once and cached in `alignment_cache/` (shared by both modes), keyed by sequence hash,
+# reference hash and mafft version & options.
+ref_fasta_path = Path('..') / 'sars-cov-2-lemieux' / 'scratch' / 'ref.fasta'
+alignmentCache = AlignmentCache(ref_fasta_path, cache_dir=Path('alignment_cache'), path_to_mafft=path_to_mafft)
+subprocess.run([
+    path_to_mafft.as_posix(),
+    "--version"
+])
+
+# Align every distinct genome up front, in one (sharded) mafft run, so that the per-week alignments below only
+# need to look them up in the cache
+distinctSequences = SequenceGroups(sequences.items())
+numAligned = align_missing(alignmentCache, distinctSequences.seq_by_hash, path_to_mafft)
+print(f'INFO: {distinctSequences.num_distinct} distinct sequences out of {distinctSequences.num_records}, '
+      + f'aligned {numAligned} new ones')
+
+for mode in modes:
+    inputs_path = inputsPaths[mode]
+    print(f'INFO: Preparing inputs by {mode} in {inputs_path.as_posix()}')
+
+    # Split out sequences into CDC epi weeks according to submission or collection date (precomputed in the cache)
+    epiWeekKey = 'submissionEpiWeek' if mode == MODE_SUBMITTED_BY_DATE else 'collectionEpiWeek'
+    modeAccessionIDs = interestingAccessionIDsByMode[mode] & interestingAccessionIDs  # Minus those dropped by QC
+    interestingAccessionIDsByEpiWeek = defaultdict(set)  # Key: Epi week, e.g., 202043; Value: set of accession IDs
+    for accessionId in modeAccessionIDs:
+        interestingAccessionIDsByEpiWeek[metadata[accessionId][epiWeekKey]].add(accessionId)
+
+    for week in sorted(interestingAccessionIDsByEpiWeek.keys()):
+        seq_type = 'submissions' if mode == MODE_SUBMITTED_BY_DATE else 'collections'
+        print(f'INFO: In epi week {week}, there were {len(interestingAccessionIDsByEpiWeek[week])} {seq_type}')
+
+    # Produce unaligned FASTA and metadata files for all the weeks
+    #
+    # The inputs for each week are cumulative, so they're built incrementally: copy the previous week's files (a
+    # cheap reflink or in-kernel copy where the filesystem supports it) and append only the sequences new to this week.
+    # Within each week, sequences are sorted by accession ID so that the outputs are reproducible.
+    prevWeekPaths = None
+    for week in sorted(interestingAccessionIDsByEpiWeek.keys()):
+        print(f'INFO: Preparing data for epi week {week}')
+        week_path = inputs_path / f'to_epi_week_{week}'
+        week_path.mkdir(parents=True, exist_ok=False)  # Bail out if exists
+
+        unaligned_fasta_path = week_path / f'to_epi_week_{week}_unaligned.fasta'
+        metadata_path = week_path / f'to_epi_week_{week}.tsv'
+        if prevWeekPaths is None:
+            with open(metadata_path, 'w') as fm:
+                fm.write('id\t' + '\t'.join(f'locLevel{n+1}' for n in range(6)) + '\n')
+        else:
+            prev_unaligned_fasta_path, prev_metadata_path = prevWeekPaths
+            copy_file(prev_unaligned_fasta_path, unaligned_fasta_path)
+            copy_file(prev_metadata_path, metadata_path)
+        prevWeekPaths = (unaligned_fasta_path, metadata_path)
+
+        newIds = sorted(accessionId
+                        for accessionId in interestingAccessionIDsByEpiWeek[week]
+                        if accessionId in sequences)
+        with FastaWriter(unaligned_fasta_path, mode='ab') as ff:
+            with open(metadata_path, 'a') as fm:
+                for accessionId in newIds:
+                    ff.write(f"{accessionId}|{metadata[accessionId]['collectionDate']}", sequences[accessionId])
             
-                locByLevel = metadata[accessionId]["location"].split(' / ')
-                fm.write(f'{accessionId}\t' + '\t'.join(' / '.join(locByLevel[:n+1]) for n in range(6)) + '\n')
+                    locByLevel = metadata[accessionId]["location"].split(' / ')
+                    fm.write(f'{accessionId}\t' + '\t'.join(' / '.join(locByLevel[:n+1]) for n in range(6)) + '\n')
 
     
-    # Leverage NC_045512.2 reference genome in sars-cov-2-lemieux
-    ref_fasta_path = Path('..') / 'sars-cov-2-lemieux' / 'scratch' / 'ref.fasta'
-    aligned_fasta_path = week_path / f'to_epi_week_{week}_aligned_but_not_masked.fasta'
-    print(f'INFO: Aligning sequences with mafft into {aligned_fasta_path.as_posix()}')
-    
-    subprocess.run([
-        path_to_mafft.as_posix(),
-        "--version"
-    ])
-
-    with open(aligned_fasta_path, 'w') as f:
-        subprocess.run([
-            path_to_mafft.as_posix(),
-            "--thread", "-1",
-            "--auto",
-            "--addfragments", unaligned_fasta_path.as_posix(),
-            "--keeplength",
-            ref_fasta_path.as_posix(),
-        ], stdout=f)
-    
-    # Mask tail ends naively (as in LeMieux et al 2021)
-    aligned_and_masked_fasta_path = week_path / f'to_epi_week_{week}.fasta'
-    print(f'INFO: Naive masking of tail ends into {aligned_and_masked_fasta_path.as_posix()}')
+        # Align to the NC_045512.2 reference genome, reusing earlier alignments of the same genomes
+        #
+        # The intermediate alignment only holds each distinct genome once, under the id of the first sequence with it
+        # (the others are listed in the identical-groups file); only the final, masked FASTA has every sequence
+        aligned_fasta_path = week_path / f'to_epi_week_{week}_aligned_but_not_masked.fasta'
+        print(f'INFO: Aligning sequences with mafft into {aligned_fasta_path.as_posix()}')
+        identical_groups_path = week_path / f'to_epi_week_{week}_identical_groups.tsv'
+        groups, numAligned = align_to_reference(read_fasta(unaligned_fasta_path), alignmentCache,
+                                                aligned_fasta_path, path_to_mafft,
+                                                identical_groups_path=identical_groups_path, distinct_only=True)
+        print(f'INFO: {groups.num_records} sequences, {groups.num_distinct} distinct '
+              + f'(groups of identical sequences in {identical_groups_path.as_posix()})')
+        print(f'INFO: Aligned {numAligned} new sequences, {len(alignmentCache) - 1} in alignment cache')
     
-    with open(aligned_fasta_path, 'r') as r:
-        with open(aligned_and_masked_fasta_path, 'w') as w:
-            for fastaId, seq in read_fasta(r):
-                # NOTE: NC_045512.2 isn't in GISAID (it differs in two sites from EPI_ISL_406798)
-                # and I'm not sure of its collection date, so remove it from the dataset
-                if fastaId.startswith('NC_045512.2'):
-                    #fastaId = 'NC_045512.2|2019-12-26'
-                    continue
-                w.write(f'>{fastaId}\n')
-                w.write('-' * num_initial_masked_sites)
-                w.write(seq[num_initial_masked_sites:-num_final_masked_sites])
-                w.write('-' * num_final_masked_sites)
-                w.write('\n')
+        # Mask tail ends naively (as in LeMieux et al 2021)
+        aligned_and_masked_fasta_path = week_path / f'to_epi_week_{week}.fasta'
+        print(f'INFO: Naive masking of tail ends into {aligned_and_masked_fasta_path.as_posix()}')
     
+        # NOTE: NC_045512.2 isn't in GISAID (it differs in two sites from EPI_ISL_406798)
+        # and I'm not sure of its collection date, so remove it from the dataset
+        distinct_masked_fasta_path = week_path / f'to_epi_week_{week}_distinct_masked.fasta'
+        mask_fasta(aligned_fasta_path, distinct_masked_fasta_path,
+                   mask=lambda num_sites: mask_tails(num_sites, num_initial_masked_sites, num_final_masked_sites),
+                   include=lambda fastaId: not fastaId.startswith('NC_045512.2'))
+        with FastaWriter(aligned_and_masked_fasta_path) as w:
+            w.write_all(groups.expand_representatives(read_fasta(distinct_masked_fasta_path)))
+        distinct_masked_fasta_path.unlink()
@@ -3,7 +3,17 @@
 import argparse
 from pathlib import Path
 import datetime
-import subprocess
+import functools
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))  # For `paper_tools`
+from paper_tools.autotune import tune_threads
+from paper_tools.delphy_runs import (DelphyRun, TIMING_COLUMNS, journaled_as_done, run_journaled_batch,
+                                     write_all_timing)
+from paper_tools.run_journal import RunJournal
+from paper_tools.work_queue import WorkQueue
+from paper_tools.warm_start import (INITIAL_TREE_FLAG, WARM_START_TIMING_COLUMNS, check_initial_tree_support,
+                                    warm_num_steps, warm_start_timing_fields, write_initial_tree)
 
 MODE_SUBMITTED_BY_DATE = 'submissionDate'
 MODE_COLLECTED_BY_DATE = 'collectionDate'
@@ -13,12 +23,39 @@ parser.add_argument('--mode', help='Include samples in run if _this_ date is on
                     required=True, choices=[MODE_SUBMITTED_BY_DATE, MODE_COLLECTED_BY_DATE])
 parser.add_argument('--batch', help='Batch ID (a or b)',
                     required=True, choices=['a', 'b'])
+parser.add_argument('--max-threads', help='Run epi weeks concurrently, packed onto this many cores '
+                    + '(default: one epi week at a time, as for the timings in the paper)',
+                    required=False, type=int)
+parser.add_argument('--warm-start', help="Start each epi week's run from the last tree of the previous week's, "
+                    + 'with a correspondingly shorter run (outputs go to a separate `..._warm` folder)',
+                    action='store_true')
+parser.add_argument('--enqueue', help='Instead of running the epi weeks here, add them to this work queue folder, '
+                    + 'for workers on any machine sharing it (see paper_tools/work_queue.py)',
+                    required=False)
+parser.add_argument('--collect', help='Instead of running the epi weeks, record those that workers of this work '
+                    + 'queue folder finished in the journal of the batch, and assemble all_timing.tsv',
+                    required=False)
+parser.add_argument('--autotune', help='Pick the number of threads of each epi week from short calibration runs '
+                    + 'instead of the rule of thumb, reusing curves for similar sizes in thread_curves.json '
+                    + '(see paper_tools/autotune.py)',
+                    action='store_true')
 
 args = parser.parse_args()
+if (args.enqueue or args.collect) and args.warm_start:
+    parser.error('--warm-start runs depend on each other, so they cannot be spread over a work queue')
+if args.enqueue and args.collect:
+    parser.error('--enqueue and --collect cannot be combined')
+if args.collect and not Path(args.collect).exists():
+    parser.error(f'Work queue folder {args.collect} not found')
 
 path_to_delphy = Path("../delphy")
+if args.warm_start:
+    check_initial_tree_support(path_to_delphy)
 
-# Prepare folders (BAIL if it's there instead of overwriting data)
+# Prepare folders
+#
+# Re-invoking the same batch resumes it: runs recorded as done in the batch's journal (with unchanged inputs)
+# are skipped, and only interrupted or failed ones are redone
 batch = args.batch
 if args.mode == MODE_SUBMITTED_BY_DATE:
     inputs_path = Path('inputs_by_submission_date')
@@ -26,110 +63,138 @@ if args.mode == MODE_SUBMITTED_BY_DATE:
 else:
     inputs_path = Path('inputs_by_collection_date')
     outputs_path = Path(f'outputs_by_collection_date_{batch}')
+if args.warm_start:
+    outputs_path = outputs_path.with_name(outputs_path.name + '_warm')
 
 if not inputs_path.exists():
     raise SystemExit(f'Inputs folder {inputs_path.as_posix()} not found')
-outputs_path.mkdir(parents=True, exist_ok=False)  # Bail out if this exists
-
-# Go over each epi week
-with open(outputs_path / 'all_timing.tsv', mode='wt', encoding='utf-8') as all_timing_f:
-    all_timing_f.write(
-        '\t'.join([
-            'Epi week',
-            'Number of sequences',
-            'Start time',
-            'End time',
-            'Total time (s)',
-            'Total steps',
-            'Number of threads',
-            'Steps / s'
-        ]) + '\n')
-    
-    epiweek_dirs = [d for d in inputs_path.iterdir()]
-    epiweek_dirs.sort(key=lambda d : d.name)
-    for epiweek_inputs_path in epiweek_dirs:
-        epiweek_str = epiweek_inputs_path.name[-len('202001'):]
-        epiweek = int(epiweek_str)
-        if epiweek < 202001:
-            # Epi weeks before 2020 are too sparse
-            continue
-        
-        start_time = datetime.datetime.now()
-        print(f'- {start_time.isoformat()}: Running epi week {epiweek}')
-    
-        epiweek_outputs_path = outputs_path / f'to_epi_week_{epiweek}'
-        epiweek_outputs_path.mkdir(parents=True, exist_ok=False)  # Bail out if this exists
-        
-        # Count sequences
-        input_fasta_path = epiweek_inputs_path / f'to_epi_week_{epiweek}.fasta'
-        num_seqs = 0
-        with open(input_fasta_path, mode='rt', encoding='utf-8') as f:
-            for line in f:
-                if line.startswith('>'):
-                    num_seqs += 1
-        print(f'  Found {num_seqs} sequences')
-    
-        # Decide on number of steps, sampling rate and number of threads
-        # Rough heuristics:
-        #  - 5,000,000 steps per sequence
-        #  - 200 samples in .dphy file & trees file
-        #  - 10,000 samples in log file
-        #  - At least 100 samples per thread
-        #  - At least 1 thread, no more than 32 threads
-    
-        steps_per_seq = 5_000_000
-        num_steps = num_seqs * steps_per_seq
-        steps_per_sample = num_steps // 200
-        steps_per_log = num_steps // 10_000
-        num_threads = max(1, min(32, num_seqs // 100))
-    
-        # Build delphy command line
-        output_log_path = epiweek_outputs_path / f'to_epi_week_{epiweek}.log'
-        output_trees_path = epiweek_outputs_path / f'to_epi_week_{epiweek}.trees'
-        output_dphy_path = epiweek_outputs_path / f'to_epi_week_{epiweek}.dphy'
-        delphy_cli = [
-            path_to_delphy.as_posix(),
-            "--v0-in-fasta", input_fasta_path.as_posix(),
-            "--v0-threads", str(num_threads),
-            "--v0-steps", str(num_steps),
-            "--v0-out-log-file", output_log_path.as_posix(),
-            "--v0-log-every", str(steps_per_log),
-            "--v0-out-trees-file", output_trees_path.as_posix(),
-            "--v0-tree-every", str(steps_per_sample),
-            "--v0-out-delphy-file", output_dphy_path.as_posix(),
-            "--v0-delphy-snapshot-every", str(steps_per_sample),
-        ]
-    
-        # Record command
-        cmd_path = epiweek_outputs_path / 'run.sh'
-        with open(cmd_path, mode='wt', encoding='utf-8') as f:
-            f.write(" ".join(delphy_cli) + '\n')  # Ignore quoting subtleties
-    
-        # Run Delphy
-        subprocess.run(delphy_cli)
-    
-        # Finish timing info
-        end_time = datetime.datetime.now()
-    
-        time_for_run = end_time - start_time
-        steps_per_second = num_steps / time_for_run.total_seconds()
-    
-        # Record timing
-        timing_path = epiweek_outputs_path / 'timing.tsv'
-        timing_str = (
-            '\t'.join([
-                f'{epiweek}',
-                f'{num_seqs}',
-                f'{start_time.isoformat()}',
-                f'{end_time.isoformat()}',
-                f'{time_for_run.total_seconds()}',
-                f'{num_steps}',
-                f'{num_threads}',
-                f'{steps_per_second}'
-            ]) + '\n'
-        )
-        with open(timing_path, mode='wt', encoding='utf-8') as f:
-            f.write(timing_str)
-        all_timing_f.write(timing_str)
+outputs_path.mkdir(parents=True, exist_ok=True)
+journal = RunJournal(outputs_path / 'journal.tsv')
+
+# Prepare a Delphy run for each epi week
+runs = []
+epiweek_dirs = [d for d in inputs_path.iterdir()]
+epiweek_dirs.sort(key=lambda d : d.name)
+for epiweek_inputs_path in epiweek_dirs:
+    epiweek_str = epiweek_inputs_path.name[-len('202001'):]
+    epiweek = int(epiweek_str)
+    if epiweek < 202001:
+        # Epi weeks before 2020 are too sparse
+        continue
+
+    epiweek_outputs_path = outputs_path / f'to_epi_week_{epiweek}'
+    epiweek_outputs_path.mkdir(parents=True, exist_ok=True)
     
-        print(f'  {end_time.isoformat()}: Finished {epiweek}, took {time_for_run.total_seconds()} s = {steps_per_second} steps / s')
+    # Count sequences
+    input_fasta_path = epiweek_inputs_path / f'to_epi_week_{epiweek}.fasta'
+    fasta_ids = set()
+    with open(input_fasta_path, mode='rt', encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('>'):
+                fasta_ids.add(line[1:].strip())
+    num_seqs = len(fasta_ids)
+    print(f'- Epi week {epiweek}: found {num_seqs} sequences')
+
+    # Decide on number of steps, sampling rate and number of threads
+    # Rough heuristics:
+    #  - 5,000,000 steps per sequence
+    #  - 200 samples in .dphy file & trees file
+    #  - 10,000 samples in log file
+    #  - At least 100 samples per thread
+    #  - At least 1 thread, no more than 32 threads
+
+    steps_per_seq = 5_000_000
+    num_steps = num_seqs * steps_per_seq
+    cold_num_steps = num_steps
+    prev_run = runs[-1] if args.warm_start and runs else None
+    if prev_run is not None:
+        num_inherited_seqs = len(fasta_ids & prev_fasta_ids)
+        num_steps = warm_num_steps(cold_num_steps, steps_per_seq, num_inherited_seqs)
+        print(f'  Warm start from epi week {prev_run.key}: {num_inherited_seqs} sequences inherited, '
+              + f'{num_steps} steps instead of {cold_num_steps}')
+    prev_fasta_ids = fasta_ids
+    steps_per_sample = num_steps // 200
+    steps_per_log = num_steps // 10_000
+    num_threads = max(1, min(32, num_seqs // 100))
+
+    # Build delphy command line
+    output_log_path = epiweek_outputs_path / f'to_epi_week_{epiweek}.log'
+    output_trees_path = epiweek_outputs_path / f'to_epi_week_{epiweek}.trees'
+    output_dphy_path = epiweek_outputs_path / f'to_epi_week_{epiweek}.dphy'
+    delphy_cli = [
+        path_to_delphy.as_posix(),
+        "--v0-in-fasta", input_fasta_path.as_posix(),
+        "--v0-threads", str(num_threads),
+        "--v0-steps", str(num_steps),
+        "--v0-out-log-file", output_log_path.as_posix(),
+        "--v0-log-every", str(steps_per_log),
+        "--v0-out-trees-file", output_trees_path.as_posix(),
+        "--v0-tree-every", str(steps_per_sample),
+        "--v0-out-delphy-file", output_dphy_path.as_posix(),
+        "--v0-delphy-snapshot-every", str(steps_per_sample),
+    ]
+    if prev_run is not None:
+        initial_tree_path = epiweek_outputs_path / f'to_epi_week_{epiweek}_initial.nwk'
+        delphy_cli.extend([
+            INITIAL_TREE_FLAG, initial_tree_path.as_posix(),
+        ])
+    run = DelphyRun(epiweek, delphy_cli, num_seqs, num_steps, num_threads, epiweek_outputs_path)
+    if args.warm_start:
+        run.extra_timing_fields = functools.partial(
+            warm_start_timing_fields, '' if prev_run is None else prev_run.key, cold_num_steps, num_steps,
+            output_log_path)
+    if prev_run is not None:
+        # The initial tree is built from the previous week's trees once that run is done
+        prev_trees_path = next(p for p in prev_run.output_paths if p.suffix == '.trees')
+        run.after = prev_run
+        run.prepare = functools.partial(write_initial_tree, prev_trees_path, input_fasta_path, initial_tree_path)
+        run.prepared_paths = [initial_tree_path]
+
+    # Runs done already keep the number of threads they were run with (as recorded in their run.sh)
+    done = args.autotune and journaled_as_done(run, journal)
+    if args.autotune and not done:
+        tune_threads(run, Path('thread_curves.json'), max_threads=32)
+
+    # Record command
+    if not done:
+        run.write_cmd()
+    runs.append(run)
+
+if args.enqueue:
+    job_ids = WorkQueue(args.enqueue).enqueue(runs)
+    print(f'Enqueued {len(job_ids)} jobs in {args.enqueue}')
+    sys.exit(0)
+
+# Run Delphy for every epi week, recording timing info as each run finishes
+all_timing_path = outputs_path / 'all_timing.tsv'
+timing_columns = TIMING_COLUMNS + (WARM_START_TIMING_COLUMNS if args.warm_start else [])
+
+if args.collect:
+    collected = WorkQueue(args.collect).collect(runs, journal)
+    write_all_timing(all_timing_path, runs, journal, timing_columns)
+    print(f'Collected {len(collected)} of {len(runs)} epi weeks finished in {args.collect} '
+          + f'into {journal.path.as_posix()} and {all_timing_path.as_posix()}')
+    sys.exit(0)
+
+def on_skip(run):
+    print(f'- Skipping epi week {run.key}, already done')
+
+def on_start(run):
+    print(f'- {datetime.datetime.now().isoformat()}: Running epi week {run.key} '
+          + f'({run.num_seqs} sequences, {run.num_threads} threads)')
+
+def on_finish(run, start_time, end_time, returncode):
+    if returncode is None:
+        print(f'  {end_time.isoformat()}: SKIPPED {run.key}, since epi week {run.after.key} failed')
+        return
+    if returncode != 0:
+        print(f'  {end_time.isoformat()}: FAILED {run.key} (exit code {returncode}); re-run this script to retry')
+        return
+    write_all_timing(all_timing_path, runs, journal, timing_columns)
+    time_for_run = end_time - start_time
+    steps_per_second = run.num_steps / time_for_run.total_seconds()
+    print(f'  {end_time.isoformat()}: Finished {run.key}, took {time_for_run.total_seconds()} s = {steps_per_second} steps / s')
+
+run_journaled_batch(runs, journal, max_threads=args.max_threads,
+                    on_start=on_start, on_finish=on_finish, on_skip=on_skip)
+write_all_timing(all_timing_path, runs, journal, timing_columns)
@@ -7,6 +7,12 @@ import sys, os
 from pathlib import Path
 import subprocess
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))  # For `paper_tools`
+from paper_tools.align import run_mafft_sharded
+from paper_tools.dates import parse_genbank_date, unparse_date_range
+from paper_tools.fasta import read_fasta
+from paper_tools.masking import mask_fasta, mask_tails
+
 if len(sys.argv) != 2:
     sys.stderr.write("Usage: ./00_prepare_runs.py <email-address-for-Entrez>\n")
     sys.exit(1)
@@ -128,96 +134,6 @@ if scratch_raw_genomes_fasta_path.exists() and scratch_ref_fasta_path.exists():
     do_convert = False
     print(f'[SKIPPING] {scratch_raw_genomes_fasta_path} and {scratch_ref_fasta_path} already exist')
 
-def parse_genbank_date(gb_date):
-    """
-    Parses a date from GenBank to a pair of min and max dates, encoded as ((yyyy, mm, dd), (yyyy, mm, dd)) min-max tuples.
-    
-    Formats recognized from GenBank:
-    * 1978
-    * 09-Nov-2017
-    * Nov-2017
-    * 2019-01-16
-    * 2018-08
-    """
-    
-    months = {
-        'jan': 1,
-        'feb': 2,
-        'mar': 3,
-        'apr': 4,
-        'may': 5,
-        'jun': 6,
-        'jul': 7,
-        'aug': 8,
-        'sep': 9,
-        'oct': 10,
-        'nov': 11,
-        'dec': 12
-    }
-    
-    # 1978
-    if m := re.match(r'^(\d\d\d\d)$', gb_date):
-        yyyy = int(m[1])
-        return ((yyyy, 1, 1), (yyyy+1, 1, 1))
-        
-    # Nov-2017
-    if m := re.match(r'^(\w\w\w)-(\d\d\d\d)$', gb_date):
-        if m[1].lower() in months:
-            yyyy = int(m[2])
-            mm = months[m[1].lower()]
-            min_date = (yyyy, mm, 1)
-            if mm < 12:
-                max_date = (yyyy, mm+1, 1)
-            else:
-                max_date = (yyyy+1, 1, 1)
-            return (min_date, max_date)
-        
-    # 09-Nov-2017
-    if m := re.match(r'^(\d\d)-(\w\w\w)-(\d\d\d\d)$', gb_date):
-        if m[2].lower() in months:
-            yyyy = int(m[3])
-            mm = months[m[2].lower()]
-            dd = int(m[1])
-            return ((yyyy, mm, dd), (yyyy, mm, dd))
-        
-    # 2019-01-16
-    if m := re.match(r'^(\d\d\d\d)-(\d\d)-(\d\d)$', gb_date):
-        yyyy = int(m[1])
-        mm = int(m[2])
-        dd = int(m[3])
-        return ((yyyy, mm, dd), (yyyy, mm, dd))
-        
-    # 2018-08
-    if m := re.match(r'^(\d\d\d\d)-(\d\d)$', gb_date):
-        yyyy = int(m[1])
-        mm = int(m[2])
-        min_date = (yyyy, mm, 1)
-        if mm < 12:
-            max_date = (yyyy, mm+1, 1)
-        else:
-            max_date = (yyyy+1, 1, 1)
-        return (min_date, max_date)
-        
-    # Nothing
-    return ((1900, 1, 1), (1900, 1, 1))
-
-def unparse_date_range(date_range):
-    (min_date, max_date) = date_range
-    (yyyy1, mm1, dd1) = min_date
-    (yyyy2, mm2, dd2) = max_date
-
-    if min_date == max_date:
-        return f'{yyyy1:04d}-{mm1:02d}-{dd1:02d}'
-
-    if min_date == (yyyy1, 1, 1) and max_date == (yyyy1+1, 1, 1):
-        return f'{yyyy1:04d}'
-
-    if ((min_date == (yyyy1, mm1, 1) and max_date == (yyyy1, mm1+1, 1)) or
-        (min_date == (yyyy1, 12, 1) and max_date == (yyyy1+1, 1, 1))):
-        return f'{yyyy1:04d}-{mm1:02d}'
-
-    return f'{yyyy1:04d}-{mm1:02d}-{dd1:02d}/{yyyy2:04d}-{mm2:02d}-{dd2:02d}'
-
 def gb_to_fasta(in_gb_xml_f, out_fasta_f, default_assembly_name='UNKNOWN'):
     records = Entrez.parse(in_gb_xml_f)
     for record in records:
@@ -270,15 +186,8 @@ if do_align:
         "--version"
     ])
 
-    with open(scratch_aligned_fasta_path, 'w') as f:
-        subprocess.run([
-            path_to_mafft.as_posix(),
-            "--thread", "-1",
-            "--auto",
-            "--addfragments", scratch_raw_genomes_fasta_path.as_posix(),
-            "--keeplength",
-            scratch_ref_fasta_path.as_posix(),
-        ], stdout=f)
+    # Several mafft processes side by side, each on a shard of the genomes
+    run_mafft_sharded(path_to_mafft, scratch_raw_genomes_fasta_path, scratch_ref_fasta_path, scratch_aligned_fasta_path)
 
 # Trim UTRs as in LeMieux et al (2021)
 # ====================================
@@ -291,34 +200,14 @@ if input_fasta_path.exists():
     do_trim = False
     print(f'[SKIPPING] {input_fasta_path} already exist')
 
-def read_fasta(path):
-    seqs = []
-    current_seq_id = ''
-    current_seq = ''
-    with open(path, 'r') as raw_f:
-        for line in raw_f:
-            if line.startswith('>'):
-                if current_seq:
-                    seqs.append((current_seq_id, current_seq))
-                current_seq_id = line[1:].strip()
-                current_seq = ''
-            else:
-                current_seq += line.strip()
-        if current_seq:
-            seqs.append((current_seq_id, current_seq))
-    return seqs
-
 if do_trim:
-    aligned_seqs = read_fasta(scratch_aligned_fasta_path)
-    print(f'Alignment has {len(aligned_seqs)} sequences')
-    print(f'First sequence is {aligned_seqs[0][0]}, with {len(aligned_seqs[0][1])} bases')
-
-    with open(input_fasta_path, 'w') as out_f:
-        for seq_id, seq in aligned_seqs:
-            if not seq_id.startswith(ref_acc_id):
-                seq = '-'*267 + seq[267:-230] + '-'*230  # Only mask out non-ref seqs
-            out_f.write(f'>{seq_id}\n')
-            out_f.write(f'{seq}\n')
+    first_seq_id, first_seq = next(read_fasta(scratch_aligned_fasta_path))
+    print(f'First sequence is {first_seq_id}, with {len(first_seq)} bases')
+
+    num_aligned_seqs = mask_fasta(scratch_aligned_fasta_path, input_fasta_path,
+                                  mask=mask_tails(len(first_seq), 267, 230),
+                                  exempt=lambda seq_id: seq_id.startswith(ref_acc_id))  # Only mask out non-ref seqs
+    print(f'Alignment has {num_aligned_seqs} sequences')
 
     print(f'Trimmed and aligned sequences written to {input_fasta_path}')
 
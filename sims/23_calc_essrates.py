@@ -30,7 +30,7 @@ def analyse_sim(sim_name, burnin=0.30, log_filename=None, timing_filename=None):
     analysis = analyse_log(log_filename, burnin)
     with open(timing_filename, 'r') as f:
         for line in f:
-            _, num_seqs, start_time, end_time, wallclock_seconds, num_steps, num_threads, steps_per_second = line.strip().split('\t')
+            _, num_seqs, start_time, end_time, wallclock_seconds, num_steps, num_threads, steps_per_second = line.strip().split('\t')[:8]
             num_seqs = int(num_seqs)
             wallclock_seconds = float(wallclock_seconds)
             num_steps = int(num_steps)
@@ -3,101 +3,135 @@
 import argparse
 from pathlib import Path
 import datetime
-import subprocess
 import json
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))  # For `paper_tools`
+from paper_tools.autotune import tune_threads
+from paper_tools.delphy_runs import DelphyRun, journaled_as_done, run_journaled_batch
+from paper_tools.run_journal import RunJournal
+from paper_tools.work_queue import WorkQueue
 
 parser = argparse.ArgumentParser(description="Driver for Delphy runs for simulated data")
-parser.add_argument('--sim', help='Name of simulation (e.g., const_10000)', required=True)
+parser.add_argument('--sim', help='Name of simulation (e.g., const_10000); may be repeated to run several',
+                    required=True, action='append')
 parser.add_argument('--rep', help='Name of replica (e.g., a or b)', required=True)
 parser.add_argument('--coal-cells', help='Target number of coal prior cells (default = 400)', required=False, type=int)
+parser.add_argument('--max-threads', help='Run the simulations concurrently, packed onto this many cores '
+                    + '(default: one at a time, as for the timings in the paper)',
+                    required=False, type=int)
+parser.add_argument('--enqueue', help='Instead of running the simulations here, add them to this work queue folder, '
+                    + 'for workers on any machine sharing it (see paper_tools/work_queue.py)',
+                    required=False)
+parser.add_argument('--collect', help='Instead of running the simulations, record those that workers of this work '
+                    + 'queue folder finished in the journal of the replica',
+                    required=False)
+parser.add_argument('--autotune', help='Pick the number of threads of the simulations from short calibration runs '
+                    + 'instead of the rule of thumb, reusing curves for similar sizes in thread_curves.json '
+                    + '(see paper_tools/autotune.py)',
+                    action='store_true')
 
 args = parser.parse_args()
+if args.enqueue and args.collect:
+    parser.error('--enqueue and --collect cannot be combined')
+if args.collect and not Path(args.collect).exists():
+    parser.error(f'Work queue folder {args.collect} not found')
 
 path_to_delphy = Path("../delphy")
 
-sim_path = Path(args.sim)
-ground_truth_path = sim_path / 'ground_truth'
-inputs_path = sim_path / 'inputs'
-delphy_outputs_path = sim_path / f'delphy_outputs_{args.rep}'
-delphy_outputs_path.mkdir(parents=True, exist_ok=True)
+# Re-invoking the script resumes the batch: simulations recorded as done for this replica (with unchanged inputs)
+# are skipped, and only interrupted or failed ones are redone
+journal = RunJournal(Path(f'journal_{args.rep}.tsv'))
 
-if not sim_path.exists():
-    raise SystemExit(f'Simulation folder {sim_path.as_posix()} not found')
-input_maple_path = inputs_path / f'{args.sim}.maple'
+def prepare_run(sim):
+    sim_path = Path(sim)
+    ground_truth_path = sim_path / 'ground_truth'
+    inputs_path = sim_path / 'inputs'
+    delphy_outputs_path = sim_path / f'delphy_outputs_{args.rep}'
+    delphy_outputs_path.mkdir(parents=True, exist_ok=True)
 
-start_time = datetime.datetime.now()
-print(f'- {start_time.isoformat()}: Running simulation {args.sim} rep {args.rep}')
+    if not sim_path.exists():
+        raise SystemExit(f'Simulation folder {sim_path.as_posix()} not found')
+    input_maple_path = inputs_path / f'{sim}.maple'
 
-with open(ground_truth_path / f'{args.sim}_info.json', 'rt', encoding='utf-8') as f:
-    info = json.load(f)
+    with open(ground_truth_path / f'{sim}_info.json', 'rt', encoding='utf-8') as f:
+        info = json.load(f)
 
-num_seqs = info['sampling_strategy']['num_samples']
-print(f'  Simulation has {num_seqs} sequences')
-    
-# Decide on number of steps, sampling rate and number of threads
-# Rough heuristics:
-#  - 5,000,000 steps per sequence
-#  - 200 samples in .dphy file & trees file
-#  - 10,000 samples in log file
-#  - At least 20 sequences per thread (~40 nodes per partition)
-#  - At least 1 thread, no more than 2*96 threads
-
-steps_per_seq = 5_000_000
-num_steps = num_seqs * steps_per_seq
-steps_per_sample = num_steps // 200
-steps_per_log = num_steps // 10_000
-num_threads = max(1, min(2*96, num_seqs // 20))
-
-# Build delphy command line
-output_log_path = delphy_outputs_path / f'{args.sim}.log'
-output_trees_path = delphy_outputs_path / f'{args.sim}.trees'
-output_dphy_path = delphy_outputs_path / f'{args.sim}.dphy'
-delphy_cli = [
-    path_to_delphy.as_posix(),
-    "--v0-in-maple", input_maple_path.as_posix(),
-    "--v0-threads", str(num_threads),
-    "--v0-steps", str(num_steps),
-    "--v0-out-log-file", output_log_path.as_posix(),
-    "--v0-log-every", str(steps_per_log),
-    "--v0-out-trees-file", output_trees_path.as_posix(),
-    "--v0-tree-every", str(steps_per_sample),
-    "--v0-out-delphy-file", output_dphy_path.as_posix(),
-    "--v0-delphy-snapshot-every", str(steps_per_sample),
-]
-if args.coal_cells:
-    delphy_cli.extend([
-        "--v0-target-coal-prior-cells", str(args.coal_cells),
-    ])
-
-# Record command
-cmd_path = delphy_outputs_path / 'run.sh'
-with open(cmd_path, mode='wt', encoding='utf-8') as f:
-    f.write(" ".join(delphy_cli) + '\n')  # Ignore quoting subtleties
+    num_seqs = info['sampling_strategy']['num_samples']
+    print(f'- Simulation {sim} has {num_seqs} sequences')
     
-# Run Delphy
-subprocess.run(delphy_cli)
+    # Decide on number of steps, sampling rate and number of threads
+    # Rough heuristics:
+    #  - 5,000,000 steps per sequence
+    #  - 200 samples in .dphy file & trees file
+    #  - 10,000 samples in log file
+    #  - At least 20 sequences per thread (~40 nodes per partition)
+    #  - At least 1 thread, no more than 2*96 threads
 
-# Finish timing info
-end_time = datetime.datetime.now()
+    steps_per_seq = 5_000_000
+    num_steps = num_seqs * steps_per_seq
+    steps_per_sample = num_steps // 200
+    steps_per_log = num_steps // 10_000
+    num_threads = max(1, min(2*96, num_seqs // 20))
 
-time_for_run = end_time - start_time
-steps_per_second = num_steps / time_for_run.total_seconds()
-    
-# Record timing
-timing_path = delphy_outputs_path / 'timing.tsv'
-timing_str = (
-    '\t'.join([
-        f'{args.sim}',
-        f'{num_seqs}',
-        f'{start_time.isoformat()}',
-        f'{end_time.isoformat()}',
-        f'{time_for_run.total_seconds()}',
-        f'{num_steps}',
-        f'{num_threads}',
-        f'{steps_per_second}'
-    ]) + '\n'
-)
-with open(timing_path, mode='wt', encoding='utf-8') as f:
-    f.write(timing_str)
-    
-print(f'  {end_time.isoformat()}: Finished {args.sim} rep {args.rep}, took {time_for_run.total_seconds()} s = {steps_per_second} steps / s')
+    # Build delphy command line
+    output_log_path = delphy_outputs_path / f'{sim}.log'
+    output_trees_path = delphy_outputs_path / f'{sim}.trees'
+    output_dphy_path = delphy_outputs_path / f'{sim}.dphy'
+    delphy_cli = [
+        path_to_delphy.as_posix(),
+        "--v0-in-maple", input_maple_path.as_posix(),
+        "--v0-threads", str(num_threads),
+        "--v0-steps", str(num_steps),
+        "--v0-out-log-file", output_log_path.as_posix(),
+        "--v0-log-every", str(steps_per_log),
+        "--v0-out-trees-file", output_trees_path.as_posix(),
+        "--v0-tree-every", str(steps_per_sample),
+        "--v0-out-delphy-file", output_dphy_path.as_posix(),
+        "--v0-delphy-snapshot-every", str(steps_per_sample),
+    ]
+    if args.coal_cells:
+        delphy_cli.extend([
+            "--v0-target-coal-prior-cells", str(args.coal_cells),
+        ])
+    run = DelphyRun(sim, delphy_cli, num_seqs, num_steps, num_threads, delphy_outputs_path)
+
+    # Runs done already keep the number of threads they were run with (as recorded in their run.sh)
+    done = args.autotune and journaled_as_done(run, journal)
+    if args.autotune and not done:
+        tune_threads(run, Path('thread_curves.json'), max_threads=2*96)
+
+    # Record command
+    if not done:
+        run.write_cmd()
+    return run
+
+runs = [prepare_run(sim) for sim in args.sim]
+
+if args.enqueue:
+    job_ids = WorkQueue(args.enqueue).enqueue(runs)
+    print(f'Enqueued {len(job_ids)} jobs in {args.enqueue}')
+    sys.exit(0)
+
+if args.collect:
+    collected = WorkQueue(args.collect).collect(runs, journal)
+    print(f'Collected {len(collected)} of {len(runs)} simulations finished in {args.collect} '
+          + f'into {journal.path.as_posix()}')
+    sys.exit(0)
+
+def on_skip(run):
+    print(f'- Skipping simulation {run.key} rep {args.rep}, already done')
+
+def on_start(run):
+    print(f'- {datetime.datetime.now().isoformat()}: Running simulation {run.key} rep {args.rep}')
+
+def on_finish(run, start_time, end_time, returncode):
+    if returncode != 0:
+        print(f'  {end_time.isoformat()}: FAILED {run.key} rep {args.rep} (exit code {returncode}); re-run this script to retry')
+        return
+    time_for_run = end_time - start_time
+    steps_per_second = run.num_steps / time_for_run.total_seconds()
+    print(f'  {end_time.isoformat()}: Finished {run.key} rep {args.rep}, took {time_for_run.total_seconds()} s = {steps_per_second} steps / s')
+
+run_journaled_batch(runs, journal, max_threads=args.max_threads,
+                    on_start=on_start, on_finish=on_finish, on_skip=on_skip)
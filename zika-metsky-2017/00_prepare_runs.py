@@ -5,8 +5,9 @@ import requests
 from pathlib import Path
 import subprocess
 import shutil
-import xml.etree.ElementTree as ET
-import re
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))  # For `paper_tools`
+from paper_tools.beast_xml import read_beast_xml, check_same_taxa_order
 
 if len(sys.argv) != 1:
     sys.stderr.write("Usage: ./00_prepare_runs.py\n")
@@ -68,16 +69,13 @@ if do_unzip:
 # regions of this sequence (sites 108-10379, inclusive).  Mercifully, that portion is aligned to KX197192.1 and is what appears in the BEAST files, unscrambled.
 
 print("\nReading sequence data from BEAST XML file...")
-beastXml = ET.parse(beast_file_path.as_posix())
-xmlTaxa = [taxon for taxon in beastXml.find("taxa")]
-xmlAlignments = beastXml.findall("alignment")
+xmlTaxa, xmlAlignments = read_beast_xml(beast_file_path)
+xmlAlignments = list(xmlAlignments.values())
 print(f'Found {len(xmlAlignments)} alignments and {len(xmlTaxa)} taxa')
 
 # Check that taxa are listed in the same order in <taxa> section and in alignment
-taxaIds = [taxon.get('id') for taxon in xmlTaxa]
-alignmentIdRefs = [s.find('taxon').get('idref') for s in xmlAlignments[0].findall('sequence')]
-if taxaIds != alignmentIdRefs:
-    raise ValueError('Taxa are listed in different order in <taxa> section and in alignment')
+taxaIds = [taxon.taxon_id for taxon in xmlTaxa]
+check_same_taxa_order(taxaIds, xmlAlignments[0])
 
 # Prepare fasta with all the sequences
 # ====================================
@@ -91,13 +89,12 @@ if input_fasta_path.exists():
 
 if do_reassembly:
     with open(input_fasta_path, 'w') as f:
-        for (taxon, s) in zip(xmlTaxa,
-                              xmlAlignments[0].findall('sequence')):
-            taxonId = taxon.get('id')
+        for (taxon, s) in zip(xmlTaxa, xmlAlignments[0]):
+            taxonId = taxon.taxon_id
             gbId, geo, date = taxonId.split('|')
             
             # "Align" CDS to reference KX197192.1 (UTRs at both ends are just masked)
-            finalSeq = ('N'*107) + re.sub(r"\s+", "", ''.join(s.itertext())) + ('N'*428)
+            finalSeq = ('N'*107) + s.seq + ('N'*428)
             
             f.write('>')
             f.write(f'{gbId}|{date}')
@@ -120,7 +117,7 @@ if do_metadata:
     with open(input_metadata_path, 'w') as f:
         f.write('id,Geo\n')
         for taxon in xmlTaxa:
-            taxonId = taxon.get('id')
+            taxonId = taxon.taxon_id
             gbId, geo, date = taxonId.split('|')
         
             f.write(f'{gbId},{geo}\n')